@@ -2,28 +2,63 @@
 
 Minimal runtime entrypoint that composes helpers and exposes required
 endpoints. Keep other logic in sibling modules (logging_setup.py,
-auth.py, solver.py, rules.py, scorer.py, metrics.py).
+auth.py, codec.py, wire.py, timing.py, profiling.py, pipeline.py,
+delta.py, solver_pool.py, solver.py, distance_providers.py, roadgraph.py,
+pair_cache.py, candidates.py, decompose.py, rules.py, scorer.py, cache.py,
+metrics.py).
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import os
-import json
 import time
 from datetime import datetime
 
-from logging_setup import logger, LOG_DIR
+from logging_setup import logger, LOG_PATH, LOG_BACKUP_COUNT
+from codec import (
+    InvalidJSON,
+    compact_batch,
+    compact_response,
+    json_response,
+    parse_request,
+    wants_compact,
+)
+from audit_log import parse_time, query_events
 from metrics import (
     REQ_COUNTER,
     REQ_DURATION,
-    SOLVER_DURATION,
-    generate_latest,
+    render_metrics,
     CONTENT_TYPE_LATEST,
 )
+from wire import WireFormatError
+from timing import phase, request_timer
+from profiling import (
+    DEFAULT_SAMPLE_INTERVAL_MS,
+    MAX_PROFILE_REQUESTS,
+    PROFILE_MODES,
+    arm as arm_profile,
+    claim as claim_profile,
+    disarm as disarm_profile,
+    profile_call,
+    profiling_enabled,
+    report as profile_report,
+    status as profile_status,
+)
 from auth import rate_limit_key, authenticate_service_request
-from solver import compute_distance_matrix, solve_tsp_distance_matrix
-from rules import enforce_rules, MAX_LOCATIONS
-from scorer import score_route
+from pipeline import run_optimize, prepare_problem
+from decompose import wants_decomposition
+from delta import run_delta
+from portfolio import resolve_portfolio
+from streaming import stream_optimize, NDJSON_MIMETYPE, SSE_MIMETYPE
+from cache import build_result_cache
+from batch import run_batch, MAX_BATCH_PROBLEMS
+from jobs import build_job_manager, QueueFullError
+from solver_pool import (
+    build_solver_pool,
+    SolverCrashed,
+    SolverDeadlineExceeded,
+    SolverOverloaded,
+)
 
 from flask_limiter import Limiter
 
@@ -41,6 +76,24 @@ else:
 
 limiter = Limiter(key_func=rate_limit_key, app=app, default_limits=["1000/day"])
 
+# Pre-started solver processes for POST /optimize (None: solve in the
+# request thread, ROUTE_SOLVER_WORKERS=0).
+SOLVER_POOL = build_solver_pool()
+
+# Per-process optimize result cache (optionally backed by a shared on-disk
+# store via ROUTE_CACHE_PATH). It shares the solver pool's store, so
+# /optimize/delta finds routes solved in pool processes. None when
+# ROUTE_CACHE_ENABLED=false.
+RESULT_CACHE = build_result_cache(
+    path=SOLVER_POOL.cache_path if SOLVER_POOL is not None else None
+)
+
+# Background executor for POST /optimize/jobs.
+JOB_MANAGER = build_job_manager(cache=RESULT_CACHE, pool=SOLVER_POOL)
+
+# /debug/profile captures (ROUTE_PROFILING_ENABLED=false turns them off).
+PROFILING_ENABLED = profiling_enabled()
+
 
 @app.route("/health", methods=["GET"])
 def health():
@@ -55,7 +108,7 @@ def metrics():
     ok, reason = authenticate_service_request()
     if not ok:
         return jsonify({"error": "unauthorized", "reason": reason}), 401
-    return generate_latest(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+    return render_metrics(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
 
 
 @limiter.limit("10/minute")
@@ -65,31 +118,22 @@ def audit_previous_token_usage():
     if not ok:
         return jsonify({"error": "unauthorized", "reason": reason}), 401
 
-    log_path = os.path.join(LOG_DIR, "route_optimizer.log")
-    summary = {"count": 0, "entries": []}
-    max_entries = min(int(request.args.get("limit", 50)), 200)
-
-    if not os.path.exists(log_path):
-        return jsonify(summary)
+    try:
+        max_entries = max(1, min(int(request.args.get("limit", 50)), 200))
+    except ValueError:
+        return jsonify({"error": "invalid limit"}), 400
+    since = parse_time(request.args.get("since"))
+    until = parse_time(request.args.get("until"))
+    if (request.args.get("since") and since is None) or (request.args.get("until") and until is None):
+        return jsonify({"error": "since/until must be ISO 8601 timestamps"}), 400
 
+    summary = {"count": 0, "entries": []}
     try:
-        with open(log_path, "r", encoding="utf-8") as f:
-            for line in reversed(f.readlines()):
-                if "previous_token_used" in line:
-                    idx = line.find("{")
-                    if idx != -1:
-                        maybe = line[idx:]
-                        try:
-                            obj = json.loads(maybe)
-                        except Exception:
-                            obj = {"raw": maybe}
-                    else:
-                        obj = {"raw": line}
-
-                    summary["entries"].append(obj)
-                    summary["count"] += 1
-                    if len(summary["entries"]) >= max_entries:
-                        break
+        entries, source = query_events(
+            LOG_PATH, "previous_token_used", limit=max_entries, since=since, until=until,
+            backup_count=LOG_BACKUP_COUNT,
+        )
+        summary = {"count": len(entries), "entries": entries, "source": source}
     except Exception:
         logger.exception("failed to read audit log")
 
@@ -102,113 +146,390 @@ def optimize():
     REQ_COUNTER.inc()
     request_started_at = time.monotonic()
 
-    with REQ_DURATION.time():
+    with REQ_DURATION.time(), request_timer() as timer:
+        try:
+            return _optimize(request_started_at, timer)
+        finally:
+            timer.observe()
+
+
+def _optimize(request_started_at, timer):
+    with phase("auth"):
         ok, reason = authenticate_service_request()
-        if not ok:
-            logger.info(json.dumps({
-                "event": "auth_failed",
-                "reason": reason,
-                "trace_id": request.headers.get("X-Trace-Id"),
-            }))
-            return jsonify({"error": "unauthorized", "reason": reason}), 401
-
-        payload = request.get_json(force=True) or {}
-        trace_id = request.headers.get("X-Trace-Id") or (datetime.utcnow().isoformat() + "Z")
-
-        # Hard input-size limit (defence in depth; proxy enforces 80).
-        locations_raw = payload.get("locations") or []
-        if len(locations_raw) > MAX_LOCATIONS:
-            logger.info(json.dumps({
-                "trace_id": trace_id,
-                "event": "bad_request",
-                "reason": f"too_many_locations:{len(locations_raw)}",
-            }))
-            return jsonify({
-                "error": "too_many_locations",
-                "max": MAX_LOCATIONS,
-                "received": len(locations_raw),
-            }), 400
-
-        locations, warnings = enforce_rules(payload)
-        start_index = int(payload.get("start_index", 0))
-        preferences = payload.get("preferences") or {}
-
-        if not locations:
-            logger.info(json.dumps({"trace_id": trace_id, "event": "bad_request", "reason": "no locations"}))
-            return jsonify({"error": "no locations provided"}), 400
-
-        if start_index < 0 or start_index >= len(locations):
-            warnings.append("start_index_clamped")
-            start_index = 0
-
-        matrix = compute_distance_matrix(locations, preferences=preferences)
-
-        # --- Solver ---------------------------------------------------------
-        solver_t0 = time.monotonic()
-        route_indices, solver_status = solve_tsp_distance_matrix(
-            matrix,
-            start_index=start_index,
-            preferences=preferences,
-        )
-        solver_elapsed_s = time.monotonic() - solver_t0
-        SOLVER_DURATION.observe(solver_elapsed_s)
-        # --------------------------------------------------------------------
+    if not ok:
+        logger.info({
+            "event": "auth_failed",
+            "reason": reason,
+            "trace_id": request.headers.get("X-Trace-Id"),
+        })
+        return jsonify({"error": "unauthorized", "reason": reason}), 401
 
-        if solver_status != "solved":
-            warnings.append("solver_fallback: route is unoptimized (returned in input order)")
+    try:
+        payload = parse_request(request, binary=True)
+    except InvalidJSON:
+        return jsonify({"error": "invalid_json"}), 400
+    except WireFormatError as exc:
+        return jsonify({"error": "invalid_binary_payload", "detail": str(exc)}), 400
+    if not isinstance(payload, dict):
+        return jsonify({"error": "body must be a JSON object"}), 400
+    trace_id = request.headers.get("X-Trace-Id") or (datetime.utcnow().isoformat() + "Z")
+    profile = claim_profile() if PROFILING_ENABLED else None
+
+    if SOLVER_POOL is None:
+        if profile is None:
+            body, status = run_optimize(
+                payload, trace_id, started_at=request_started_at, cache=RESULT_CACHE, timings=True
+            )
+        else:
+            body, status = profile_call(
+                profile, run_optimize, payload, trace_id,
+                started_at=request_started_at, cache=RESULT_CACHE, timings=True,
+            )
+        return _optimize_response(payload, body, status, timer)
 
-        ordered = [locations[i] for i in route_indices]
+    preferences = payload.get("preferences")
+    if not isinstance(preferences, dict):
+        preferences = None
+    rejected = _budget_rejection(preferences)
+    if rejected is not None:
+        return rejected
 
-        # Total route distance in real metres (sum of consecutive haversine legs).
-        distance_meters = 0
-        if len(route_indices) > 1:
-            distance_meters = sum(
-                matrix[route_indices[i]][route_indices[i + 1]]
-                for i in range(len(route_indices) - 1)
+    try:
+        if wants_decomposition(preferences) or resolve_portfolio(preferences)[0]:
+            body, status = _run_in_worker(payload, trace_id, request_started_at, profile)
+        else:
+            body, status = SOLVER_POOL.run(
+                payload, trace_id, started_at=request_started_at, profile=profile
             )
-        distance_km = round(distance_meters / 1000.0, 3)
-
-        score = score_route(ordered, distance_meters=distance_meters)
-
-        # Duration feasibility check using real units.
-        max_duration = preferences.get("max_duration_minutes")
-        if isinstance(max_duration, (int, float)) and max_duration > 0:
-            # 15 km/h average = 250 m/min
-            max_distance_for_duration = max_duration * 250.0
-            if distance_meters > max_distance_for_duration:
-                warnings.append("max_duration_exceeded")
-
-        total_elapsed_s = time.monotonic() - request_started_at
-
-        response = {
-            "route": ordered,
-            "metrics": {
-                "locations_count": len(locations),
-                "distance_meters": distance_meters,
-                "distance_km": distance_km,
-            },
-            "score": score,
-            "solver_status": solver_status,
-            "solver_time_seconds": round(solver_elapsed_s, 3),
-            "solver_time_limit_applied": True,
-            "warnings": warnings,
-            "solver_version": "ortools-9.6",
+    except SolverOverloaded as exc:
+        return _overloaded_response(exc, trace_id)
+    except SolverDeadlineExceeded:
+        logger.warning({"trace_id": trace_id, "event": "solver_deadline_exceeded"})
+        return jsonify({
+            "error": "solver_deadline_exceeded",
+            "deadline_seconds": SOLVER_POOL.deadline_seconds,
             "trace_id": trace_id,
-        }
+        }), 504
+    except SolverCrashed:
+        return jsonify({"error": "solver_worker_crashed", "trace_id": trace_id}), 500
+    return _optimize_response(payload, body, status, timer)
 
-        logger.info(json.dumps({
-            "trace_id": trace_id,
-            "event": "optimize",
-            "solver_status": solver_status,
-            "solver_time_s": round(solver_elapsed_s, 3),
-            "total_time_s": round(total_elapsed_s, 3),
-            "request_count": len(locations_raw),
-            "final_count": len(locations),
-            "distance_meters": distance_meters,
-            "warnings": warnings,
-        }))
-
-        return jsonify(response)
+
+def _budget_rejection(preferences):
+    budget_error = SOLVER_POOL.budget_error(preferences)
+    if budget_error is None:
+        return None
+    return jsonify({
+        "error": "invalid_solver_budget",
+        "detail": budget_error,
+        "deadline_seconds": SOLVER_POOL.deadline_seconds,
+    }), 400
+
+
+def _overloaded_response(exc, trace_id):
+    logger.info({
+        "trace_id": trace_id,
+        "event": "solver_rejected",
+        "reason": exc.reason,
+    })
+    return jsonify({
+        "error": "solver_overloaded",
+        "reason": exc.reason,
+        "trace_id": trace_id,
+    }), 503, {"Retry-After": str(exc.retry_after)}
+
+
+def _run_in_worker(payload, trace_id, request_started_at, profile):
+    # Pool processes are daemonic: decomposition would solve every cluster
+    # serially there and a portfolio could not start its runners. Here both
+    # fan out over the batch process pool. The solve holds a solver slot for
+    # admission and stops at the pool deadline instead of being killed.
+    past_deadline = SOLVER_POOL.stop_at_deadline(request_started_at)
+
+    with SOLVER_POOL.reserve():
+        if profile is None:
+            return run_optimize(
+                payload, trace_id, started_at=request_started_at, cache=RESULT_CACHE,
+                should_stop=past_deadline, timings=True,
+            )
+        return profile_call(
+            profile, run_optimize, payload, trace_id,
+            started_at=request_started_at, cache=RESULT_CACHE,
+            should_stop=past_deadline, timings=True,
+        )
+
+
+def _optimize_response(payload, body, status, timer):
+    # Phases measured by the pipeline (possibly in a pool process).
+    timer.merge_ms(body.pop("timings", None))
+    if status == 200 and wants_compact(payload):
+        body = compact_response(body, payload.get("locations"))
+    if payload.get("timings") is True:
+        # Serialization is timed after the body is built: Server-Timing only.
+        body["timings"] = timer.milliseconds()
+    return json_response(body, status, request=request)
+
+
+@limiter.limit("120/minute")
+@app.route("/optimize/delta", methods=["POST"])
+def optimize_delta():
+    REQ_COUNTER.inc()
+    request_started_at = time.monotonic()
+
+    with REQ_DURATION.time(), request_timer() as timer:
+        try:
+            return _optimize_delta(request_started_at)
+        finally:
+            timer.observe()
+
+
+def _optimize_delta(request_started_at):
+    with phase("auth"):
+        ok, reason = authenticate_service_request()
+    if not ok:
+        logger.info({
+            "event": "auth_failed",
+            "reason": reason,
+            "trace_id": request.headers.get("X-Trace-Id"),
+        })
+        return jsonify({"error": "unauthorized", "reason": reason}), 401
+
+    try:
+        payload = parse_request(request)
+    except InvalidJSON:
+        return jsonify({"error": "invalid_json"}), 400
+    if not isinstance(payload, dict):
+        return jsonify({"error": "body must be a JSON object"}), 400
+    trace_id = request.headers.get("X-Trace-Id") or (datetime.utcnow().isoformat() + "Z")
+
+    # Edits are cheap and latency-bound: they run in the request thread
+    # rather than queueing behind full solves in the solver pool.
+    body, status = run_delta(payload, trace_id, started_at=request_started_at, cache=RESULT_CACHE)
+    return json_response(body, status, request=request)
+
+
+@limiter.limit("30/minute")
+@app.route("/optimize/stream", methods=["POST"])
+def optimize_stream():
+    REQ_COUNTER.inc()
+    request_started_at = time.monotonic()
+
+    ok, reason = authenticate_service_request()
+    if not ok:
+        logger.info({
+            "event": "auth_failed",
+            "reason": reason,
+            "trace_id": request.headers.get("X-Trace-Id"),
+        })
+        return jsonify({"error": "unauthorized", "reason": reason}), 401
+
+    try:
+        payload = parse_request(request, binary=True)
+    except InvalidJSON:
+        return jsonify({"error": "invalid_json"}), 400
+    except WireFormatError as exc:
+        return jsonify({"error": "invalid_binary_payload", "detail": str(exc)}), 400
+    if not isinstance(payload, dict):
+        return jsonify({"error": "body must be a JSON object"}), 400
+    trace_id = request.headers.get("X-Trace-Id") or (datetime.utcnow().isoformat() + "Z")
+
+    # Validate before the stream starts so bad input still gets a 4xx.
+    problem, error = prepare_problem(payload, trace_id)
+    if error is not None:
+        body, status = error
+        return jsonify(body), status
+
+    # Streams need the on_solution hook, so the search runs in this worker
+    # under a held solver slot and stops at the pool deadline.
+    should_stop = release = None
+    if SOLVER_POOL is not None:
+        rejected = _budget_rejection(problem["preferences"])
+        if rejected is not None:
+            return rejected
+        try:
+            release = SOLVER_POOL.hold()
+        except SolverOverloaded as exc:
+            return _overloaded_response(exc, trace_id)
+        should_stop = SOLVER_POOL.stop_at_deadline(request_started_at)
+
+    sse = SSE_MIMETYPE in (request.headers.get("Accept") or "")
+    events = stream_optimize(
+        problem, trace_id, started_at=request_started_at, cache=RESULT_CACHE, sse=sse,
+        should_stop=should_stop, on_done=release,
+    )
+    return Response(
+        stream_with_context(events),
+        mimetype=SSE_MIMETYPE if sse else NDJSON_MIMETYPE,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@limiter.limit("10/minute")
+@app.route("/optimize/batch", methods=["POST"])
+def optimize_batch():
+    with request_timer() as timer:
+        try:
+            return _optimize_batch()
+        finally:
+            timer.observe()
+
+
+def _optimize_batch():
+    ok, reason = authenticate_service_request()
+    if not ok:
+        logger.info({
+            "event": "auth_failed",
+            "reason": reason,
+            "trace_id": request.headers.get("X-Trace-Id"),
+        })
+        return jsonify({"error": "unauthorized", "reason": reason}), 401
+
+    try:
+        payload = parse_request(request)
+    except InvalidJSON:
+        return jsonify({"error": "invalid_json"}), 400
+    trace_id = request.headers.get("X-Trace-Id") or (datetime.utcnow().isoformat() + "Z")
+
+    if not isinstance(payload, dict):
+        return jsonify({"error": "body must be a JSON object"}), 400
+    problems = payload.get("problems")
+    if not isinstance(problems, list) or not problems:
+        return jsonify({"error": "no problems provided"}), 400
+    if len(problems) > MAX_BATCH_PROBLEMS:
+        return jsonify({
+            "error": "too_many_problems",
+            "max": MAX_BATCH_PROBLEMS,
+            "received": len(problems),
+        }), 400
+
+    with phase("batch"):
+        body = run_batch(problems, trace_id, deadline_seconds=payload.get("deadline_seconds"))
+    if wants_compact(payload):
+        body = compact_batch(body, problems)
+    return json_response(body, request=request)
+
+
+@limiter.limit("30/minute")
+@app.route("/optimize/jobs", methods=["POST"])
+def submit_optimize_job():
+    ok, reason = authenticate_service_request()
+    if not ok:
+        logger.info({
+            "event": "auth_failed",
+            "reason": reason,
+            "trace_id": request.headers.get("X-Trace-Id"),
+        })
+        return jsonify({"error": "unauthorized", "reason": reason}), 401
+
+    try:
+        payload = parse_request(request, binary=True)
+    except InvalidJSON:
+        return jsonify({"error": "invalid_json"}), 400
+    except WireFormatError as exc:
+        return jsonify({"error": "invalid_binary_payload", "detail": str(exc)}), 400
+    if not isinstance(payload, dict):
+        return jsonify({"error": "body must be a JSON object"}), 400
+    trace_id = request.headers.get("X-Trace-Id") or (datetime.utcnow().isoformat() + "Z")
+
+    if SOLVER_POOL is not None:
+        preferences = payload.get("preferences")
+        rejected = _budget_rejection(preferences if isinstance(preferences, dict) else None)
+        if rejected is not None:
+            return rejected
+        # Jobs take their solver slot when they start; turn them away now
+        # if the pool would reject them anyway.
+        try:
+            SOLVER_POOL.check_admission()
+        except SolverOverloaded as exc:
+            return _overloaded_response(exc, trace_id)
+
+    try:
+        job = JOB_MANAGER.submit(payload, trace_id)
+    except QueueFullError:
+        return jsonify({
+            "error": "job_queue_full",
+            "max_pending": JOB_MANAGER.max_pending,
+        }), 429, {"Retry-After": "5"}
+
+    job["status_url"] = f"/optimize/jobs/{job['job_id']}"
+    return jsonify(job), 202, {"Location": job["status_url"]}
+
+
+@limiter.limit("240/minute")
+@app.route("/optimize/jobs/<job_id>", methods=["GET", "DELETE"])
+def optimize_job(job_id):
+    ok, reason = authenticate_service_request()
+    if not ok:
+        return jsonify({"error": "unauthorized", "reason": reason}), 401
+
+    if request.method == "DELETE":
+        job = JOB_MANAGER.cancel(job_id)
+        if job is None:
+            return jsonify({"error": "job_not_found"}), 404
+        if job["status"] != "cancelled":
+            return jsonify({"error": "job_already_finished", "job": job}), 409
+        return jsonify(job)
+
+    job = JOB_MANAGER.get(job_id)
+    if job is None:
+        return jsonify({"error": "job_not_found"}), 404
+    return jsonify(job)
+
+
+@limiter.limit("10/minute")
+@app.route("/debug/profile", methods=["GET", "POST", "DELETE"])
+def debug_profile():
+    """Arm (POST), inspect (GET) or clear (DELETE) an /optimize profiling session."""
+    ok, reason = authenticate_service_request()
+    if not ok:
+        return jsonify({"error": "unauthorized", "reason": reason}), 401
+    if not PROFILING_ENABLED:
+        return jsonify({"error": "profiling_disabled"}), 404
+
+    if request.method == "DELETE":
+        disarm_profile()
+        return jsonify({"status": "cleared"})
+    if request.method == "GET":
+        session = profile_status()
+        if session is None:
+            return jsonify({"error": "no_profile_session"}), 404
+        return jsonify(session)
+
+    body = request.get_json(force=True, silent=True) or {}
+    mode = body.get("mode", "sample")
+    if mode not in PROFILE_MODES:
+        return jsonify({"error": "invalid mode", "allowed": list(PROFILE_MODES)}), 400
+    try:
+        count = int(body.get("requests", 10))
+        interval_ms = float(body.get("interval_ms", DEFAULT_SAMPLE_INTERVAL_MS))
+    except (TypeError, ValueError):
+        return jsonify({"error": "requests and interval_ms must be numbers"}), 400
+    if not 1 <= count <= MAX_PROFILE_REQUESTS or not 1 <= interval_ms <= 1000:
+        return jsonify({
+            "error": "out of range",
+            "requests": [1, MAX_PROFILE_REQUESTS],
+            "interval_ms": [1, 1000],
+        }), 400
+    session = arm_profile(mode, count, interval_ms)
+    logger.info({"event": "profile_armed", "session": session["session"], "mode": mode, "requests": count})
+    return jsonify(session), 202
+
+
+@limiter.limit("10/minute")
+@app.route("/debug/profile/download", methods=["GET"])
+def debug_profile_download():
+    ok, reason = authenticate_service_request()
+    if not ok:
+        return jsonify({"error": "unauthorized", "reason": reason}), 401
+    if not PROFILING_ENABLED:
+        return jsonify({"error": "profiling_disabled"}), 404
+    captured = profile_report(request.args.get("format"))
+    if captured is None:
+        return jsonify({"error": "no_profile_captured"}), 404
+    data, mimetype, filename = captured
+    return Response(data, mimetype=mimetype, headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    })
 
 
 # The /decision endpoint has been intentionally removed.
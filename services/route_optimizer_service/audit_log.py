@@ -0,0 +1,238 @@
+"""Audit queries over the service log without loading it.
+
+Audit events (AUDIT_EVENTS, e.g. previous_token_used) are logged with
+extra={"audit_event": name}. The file handler in logging_setup then appends
+a fixed-size record (created time, file inode, byte offset) to a sidecar
+index next to the log, <log>.<event>.idx. A query reads that index backwards
+in blocks, finds the file by inode among the active log and its rotated
+backups, and reads one line per match. The index is only a hint: every line
+is checked for the event name before it is returned. Appends and compaction
+take an exclusive flock on <index>.lock, so workers sharing the log never
+drop each other's records.
+
+Without an index (logs written before it existed), queries fall back to
+tailing the active and rotated files backwards in fixed-size blocks. Either
+way, memory stays constant and a query stops as soon as it has `limit`
+entries or passes `since`.
+"""
+import fcntl
+import json
+import os
+import struct
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+AUDIT_EVENTS = ("previous_token_used",)
+
+# created (epoch seconds), inode, byte offset of the line.
+_INDEX_RECORD = struct.Struct("<dQQ")
+# Rewrite an index above this size, keeping the newest half of its records.
+MAX_INDEX_BYTES = 4 * 1024 * 1024
+
+_BLOCK_BYTES = 64 * 1024
+_INDEX_BLOCK_RECORDS = 4096
+# Longest log line returned for an indexed entry.
+_MAX_LINE_BYTES = 64 * 1024
+_ASCTIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def index_path(log_path, event):
+    return f"{log_path}.{event}.idx"
+
+
+@contextmanager
+def _locked_index(path):
+    # Appends and compaction from every worker serialise on a sidecar lock
+    # file; the index itself is replaced by compaction, so it can't hold one.
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield path
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def append_index(log_path, event, created, inode, offset):
+    """Record one event line; called by the log handler after the write."""
+    with _locked_index(index_path(log_path, event)) as path:
+        with open(path, "ab") as fh:
+            fh.write(_INDEX_RECORD.pack(created, inode, offset))
+            size = fh.tell()
+        if size > MAX_INDEX_BYTES:
+            _compact_index(path)
+
+
+def _compact_index(path):
+    # Caller holds _locked_index(path).
+    keep = (MAX_INDEX_BYTES // 2) // _INDEX_RECORD.size * _INDEX_RECORD.size
+    with open(path, "rb") as fh:
+        fh.seek(-keep, os.SEEK_END)
+        tail = fh.read()
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(tail)
+    os.replace(tmp, path)
+
+
+def log_files(log_path, backup_count):
+    """Existing log files, newest first, as (path, inode)."""
+    files = []
+    for n in range(backup_count + 1):
+        path = log_path if n == 0 else f"{log_path}.{n}"
+        try:
+            files.append((path, os.stat(path).st_ino))
+        except OSError:
+            continue
+    return files
+
+
+def parse_time(value):
+    """ISO 8601 string -> epoch seconds (naive values are UTC); None if invalid."""
+    if not value:
+        return None
+    text = str(value).strip()
+    if text.endswith("Z"):
+        text = text[:-1]
+        if not text.endswith("+00:00"):
+            text += "+00:00"
+    try:
+        parsed = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def _entry(line):
+    text = line.decode("utf-8", errors="replace").rstrip("\r\n")
+    idx = text.find("{")
+    if idx == -1:
+        return {"raw": text}
+    try:
+        return json.loads(text[idx:])
+    except ValueError:
+        return {"raw": text[idx:]}
+
+
+def _line_time(line):
+    # Lines start with the formatter's asctime, in local time.
+    try:
+        return time.mktime(time.strptime(line[:19].decode("ascii"), _ASCTIME_FORMAT))
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+def _reverse_index(path):
+    """Index records newest first, read in blocks."""
+    try:
+        fh = open(path, "rb")
+    except OSError:
+        return
+    with fh:
+        end = fh.seek(0, os.SEEK_END)
+        end -= end % _INDEX_RECORD.size
+        block = _INDEX_BLOCK_RECORDS * _INDEX_RECORD.size
+        while end > 0:
+            start = max(0, end - block)
+            fh.seek(start)
+            data = fh.read(end - start)
+            for pos in range(len(data) - _INDEX_RECORD.size, -1, -_INDEX_RECORD.size):
+                yield _INDEX_RECORD.unpack_from(data, pos)
+            end = start
+
+
+def _reverse_lines(path):
+    """Lines of a file from last to first, reading fixed-size blocks."""
+    try:
+        fh = open(path, "rb")
+    except OSError:
+        return
+    with fh:
+        end = fh.seek(0, os.SEEK_END)
+        carry = b""
+        while end > 0:
+            start = max(0, end - _BLOCK_BYTES)
+            fh.seek(start)
+            data = fh.read(end - start) + carry
+            lines = data.split(b"\n")
+            # The first piece may continue in the previous block.
+            carry = lines[0] if start > 0 else b""
+            if len(carry) > _MAX_LINE_BYTES:
+                carry = b""
+            for line in reversed(lines[1:] if start > 0 else lines):
+                if line:
+                    yield line
+            end = start
+
+
+def _query_index(log_path, event, limit, since, until, backup_count):
+    paths = {inode: path for path, inode in reversed(log_files(log_path, backup_count))}
+    needle = event.encode("utf-8")
+    entries = []
+    handles = {}
+    try:
+        for created, inode, offset in _reverse_index(index_path(log_path, event)):
+            if since is not None and created < since:
+                break
+            if until is not None and created > until:
+                continue
+            path = paths.get(inode)
+            if path is None:
+                # Rotated out of the retained backups.
+                continue
+            fh = handles.get(path)
+            if fh is None:
+                fh = handles[path] = open(path, "rb")
+            fh.seek(offset)
+            line = fh.readline(_MAX_LINE_BYTES)
+            if needle not in line:
+                continue
+            entries.append(_entry(line))
+            if len(entries) >= limit:
+                break
+    finally:
+        for fh in handles.values():
+            fh.close()
+    return entries
+
+
+def _query_scan(log_path, event, limit, since, until, backup_count):
+    needle = event.encode("utf-8")
+    entries = []
+    for path, _ in log_files(log_path, backup_count):
+        for line in _reverse_lines(path):
+            if needle not in line:
+                continue
+            created = _line_time(line)
+            if created is not None:
+                if since is not None and created < since:
+                    return entries
+                if until is not None and created > until:
+                    continue
+            entries.append(_entry(line))
+            if len(entries) >= limit:
+                return entries
+    return entries
+
+
+def query_events(log_path, event, limit=50, since=None, until=None, backup_count=5):
+    """Newest-first entries for event as (entries, source).
+
+    since/until are epoch seconds (inclusive). source is "index" when the
+    sidecar index answered the query and "scan" for the block-wise tail.
+    """
+    if os.path.exists(index_path(log_path, event)):
+        return _query_index(log_path, event, limit, since, until, backup_count), "index"
+    return _query_scan(log_path, event, limit, since, until, backup_count), "scan"
+
+
+__all__ = [
+    "AUDIT_EVENTS",
+    "append_index",
+    "index_path",
+    "log_files",
+    "parse_time",
+    "query_events",
+]
@@ -1,6 +1,5 @@
 import os
 import hashlib
-import json
 from datetime import datetime, UTC
 from flask import request
 from logging_setup import logger
@@ -52,11 +51,11 @@ def authenticate_service_request():
     if allow_prev and previous and token == previous:
         # Audit usage of the previous token
         try:
-            logger.warning(json.dumps({
+            logger.warning({
                 "event": "previous_token_used",
                 "remote_addr": request.headers.get("x-forwarded-for") or request.remote_addr,
                 "time": datetime.now(UTC).isoformat() + "Z",
-            }))
+            }, extra={"audit_event": "previous_token_used"})
         except Exception:
             logger.exception("failed to log previous-token usage")
         return True, "previous_token"
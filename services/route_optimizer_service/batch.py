@@ -0,0 +1,176 @@
+"""Batch optimization across a pool of worker processes.
+
+Each problem in a batch is an independent /optimize payload. Problems are
+fanned out over a ProcessPoolExecutor (one OR-Tools search per core) and run
+through pipeline.run_optimize, so every item gets exactly the response shape
+of /optimize. The pool is created lazily per gunicorn worker and uses the
+"spawn" start method: forking a threaded server process is unsafe.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from solver import DEFAULT_SOLVER_TIME_LIMIT_SECONDS
+
+logger = logging.getLogger("route_optimizer")
+
+# Hard cap on problems per batch request.
+MAX_BATCH_PROBLEMS = 50
+
+# Overall wall-clock deadline for a batch (seconds). Callers may ask for less
+# via "deadline_seconds" but never more than MAX_BATCH_DEADLINE_SECONDS.
+DEFAULT_BATCH_DEADLINE_SECONDS = 30.0
+MAX_BATCH_DEADLINE_SECONDS = 120.0
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def process_pool_size():
+    configured = os.environ.get("ROUTE_BATCH_WORKERS")
+    if configured:
+        return max(1, int(configured))
+    return max(1, os.cpu_count() or 1)
+
+
+def _init_worker():
+    # Attach the service log handlers inside the child process.
+    import logging_setup  # noqa: F401
+
+
+def _solve_item(payload, trace_id):
+    from pipeline import run_optimize
+
+    return run_optimize(payload, trace_id)
+
+
+def get_process_pool():
+    """Process pool shared by batch items, decomposed solves and portfolio runners."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=process_pool_size(),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return _pool
+
+
+def reset_process_pool(pool):
+    """Drop a broken pool so the next caller gets a fresh one."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _resolve_deadline(value):
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0:
+        return DEFAULT_BATCH_DEADLINE_SECONDS
+    return min(float(value), MAX_BATCH_DEADLINE_SECONDS)
+
+
+def _bounded_payload(payload, deadline_seconds):
+    """Cap the item's solver budget at the batch deadline."""
+    preferences = dict(payload.get("preferences") or {})
+    limit = preferences.get("solver_time_limit_seconds")
+    if not isinstance(limit, (int, float)) or limit <= 0:
+        limit = DEFAULT_SOLVER_TIME_LIMIT_SECONDS
+    if limit > deadline_seconds:
+        preferences["solver_time_limit_seconds"] = deadline_seconds
+        return {**payload, "preferences": preferences}
+    return payload
+
+
+def run_batch(problems, trace_id, deadline_seconds=None):
+    """Solve independent problems in parallel and return the batch response.
+
+    Every result entry has "index" and "status" ("ok", "error" or
+    "timeout"). Successful entries carry the /optimize response under
+    "result"; invalid problems carry their /optimize error body and status.
+    Problems still running at the deadline are reported as "timeout".
+    """
+    started_at = time.monotonic()
+    deadline_seconds = _resolve_deadline(deadline_seconds)
+    results = [None] * len(problems)
+    futures = {}
+
+    pool = get_process_pool()
+    for index, payload in enumerate(problems):
+        if not isinstance(payload, dict):
+            results[index] = {"index": index, "status": "error", "http_status": 400,
+                              "error": "problem must be an object"}
+            continue
+        item_trace_id = f"{trace_id}:{index}"
+        try:
+            future = pool.submit(_solve_item, _bounded_payload(payload, deadline_seconds), item_trace_id)
+        except BrokenProcessPool:
+            reset_process_pool(pool)
+            pool = get_process_pool()
+            future = pool.submit(_solve_item, _bounded_payload(payload, deadline_seconds), item_trace_id)
+        futures[future] = index
+
+    remaining = deadline_seconds - (time.monotonic() - started_at)
+    done, not_done = wait(list(futures), timeout=max(0.0, remaining))
+
+    broken = False
+    for future in done:
+        index = futures[future]
+        try:
+            body, status = future.result()
+        except BrokenProcessPool:
+            broken = True
+            results[index] = {"index": index, "status": "error", "http_status": 500,
+                              "error": "worker_crashed"}
+            continue
+        except Exception as exc:
+            logger.exception({"event": "batch_item_failed", "index": index})
+            results[index] = {"index": index, "status": "error", "http_status": 500,
+                              "error": type(exc).__name__}
+            continue
+        if status == 200:
+            results[index] = {"index": index, "status": "ok", "http_status": 200, "result": body}
+        else:
+            results[index] = {"index": index, "status": "error", "http_status": status,
+                              "error": body.get("error"), "detail": body}
+
+    for future in not_done:
+        # Queued items are dropped; items already running finish in the
+        # background and their results are discarded.
+        future.cancel()
+        index = futures[future]
+        results[index] = {"index": index, "status": "timeout", "http_status": 504,
+                          "error": "batch_deadline_exceeded"}
+
+    if broken:
+        reset_process_pool(pool)
+
+    elapsed = time.monotonic() - started_at
+    summary = {
+        "total": len(problems),
+        "succeeded": sum(1 for r in results if r["status"] == "ok"),
+        "failed": sum(1 for r in results if r["status"] == "error"),
+        "timed_out": sum(1 for r in results if r["status"] == "timeout"),
+        "deadline_seconds": deadline_seconds,
+        "elapsed_seconds": round(elapsed, 3),
+        "workers": process_pool_size(),
+    }
+    logger.info({"trace_id": trace_id, "event": "optimize_batch", **summary})
+    return {"results": results, "summary": summary, "trace_id": trace_id}
+
+
+__all__ = [
+    "run_batch",
+    "MAX_BATCH_PROBLEMS",
+    "DEFAULT_BATCH_DEADLINE_SECONDS",
+    "MAX_BATCH_DEADLINE_SECONDS",
+    "get_process_pool",
+    "process_pool_size",
+    "reset_process_pool",
+]
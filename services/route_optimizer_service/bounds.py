@@ -0,0 +1,116 @@
+"""Cheap lower bounds on the optimal tour length.
+
+The solver uses these to report (and stop on) its optimality gap. The bound
+is the Held-Karp 1-tree bound: a minimum spanning tree over every node but
+the root plus the root's two cheapest edges, tightened by a few rounds of
+subgradient ascent on node penalties. Any tour is a 1-tree, so the value is
+a valid lower bound for every penalty vector. Asymmetric matrices (edge
+penalties) are bounded through their elementwise min(m, m.T).
+"""
+import time
+
+import numpy as np
+
+DEFAULT_ASCENT_ITERATIONS = 50
+
+
+def _one_tree(weights, root):
+    """Return (cost, degrees) of the minimum 1-tree for a symmetric matrix."""
+    size = weights.shape[0]
+    others = np.delete(np.arange(size), root)
+    sub = weights[np.ix_(others, others)]
+    count = others.size
+    degrees = np.zeros(size, dtype=np.int64)
+
+    # Prim over the non-root nodes, O(N^2) with one vector op per step.
+    in_tree = np.zeros(count, dtype=bool)
+    in_tree[0] = True
+    best = sub[0].copy()
+    parent = np.zeros(count, dtype=np.int64)
+    best[0] = np.inf
+    cost = 0.0
+    for _ in range(count - 1):
+        j = int(np.argmin(best))
+        cost += best[j]
+        degrees[others[j]] += 1
+        degrees[others[parent[j]]] += 1
+        in_tree[j] = True
+        best[j] = np.inf
+        closer = (sub[j] < best) & ~in_tree
+        best[closer] = sub[j][closer]
+        parent[closer] = j
+
+    root_edges = weights[root, others]
+    two = np.argpartition(root_edges, 1)[:2]
+    cost += float(root_edges[two].sum())
+    degrees[root] = 2
+    degrees[others[two]] += 1
+    return cost, degrees
+
+
+def _nearest_neighbour_cost(matrix, start=0):
+    """Cost of the greedy nearest-neighbour tour (an upper bound)."""
+    size = matrix.shape[0]
+    unvisited = np.ones(size, dtype=bool)
+    unvisited[start] = False
+    current = start
+    cost = 0.0
+    for _ in range(size - 1):
+        j = int(np.argmin(np.where(unvisited, matrix[current], np.inf)))
+        cost += matrix[current, j]
+        unvisited[j] = False
+        current = j
+    return cost + matrix[current, start]
+
+
+def one_tree_lower_bound(distance_matrix, root=0, iterations=DEFAULT_ASCENT_ITERATIONS,
+                         time_budget_seconds=None, upper_bound=None):
+    """Held-Karp lower bound on the closed tour through every node.
+
+    Subgradient ascent stops after iterations rounds, when the 1-tree is a
+    tour (the bound is then optimal), or once time_budget_seconds is spent.
+    upper_bound (any tour cost) sets the step size; a nearest-neighbour tour
+    is used when omitted. Returns an int (metres, rounded down).
+    """
+    matrix = np.asarray(distance_matrix, dtype=np.float64)
+    size = matrix.shape[0]
+    if size < 2:
+        return 0
+    symmetric = np.minimum(matrix, matrix.T)
+    if size == 2:
+        return int(2 * symmetric[0, 1])
+
+    deadline = None
+    if time_budget_seconds is not None:
+        deadline = time.monotonic() + time_budget_seconds
+
+    if upper_bound is None:
+        upper_bound = _nearest_neighbour_cost(symmetric, root)
+
+    penalties = np.zeros(size)
+    best_bound = -np.inf
+    step_scale = 2.0
+    stale = 0
+    for _ in range(max(1, int(iterations))):
+        weights = symmetric + penalties[:, None] + penalties[None, :]
+        cost, degrees = _one_tree(weights, root)
+        bound = cost - 2.0 * penalties.sum()
+        if bound > best_bound:
+            best_bound = bound
+            stale = 0
+        else:
+            stale += 1
+            if stale >= 4:
+                step_scale *= 0.5
+                stale = 0
+        subgradient = degrees - 2
+        norm = float(subgradient @ subgradient)
+        if norm == 0 or (deadline is not None and time.monotonic() >= deadline):
+            break
+        # Polyak step: scale * (upper - current) / |subgradient|^2.
+        step = step_scale * max(0.0, upper_bound - bound) / norm
+        penalties += step * subgradient
+    return int(max(0.0, best_bound))
+
+
+__all__ = ["one_tree_lower_bound", "DEFAULT_ASCENT_ITERATIONS"]
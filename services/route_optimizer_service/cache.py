@@ -0,0 +1,279 @@
+"""Result cache for /optimize.
+
+Identical problems (same normalized locations, start_index and preferences,
+including edge penalties) always produce the same response, so solved
+responses are kept in an in-process LRU with a TTL and a byte budget.
+Setting ROUTE_CACHE_PATH adds a second tier: a local SQLite file that every
+gunicorn worker on the host reads and writes, so one worker's solve serves
+the others.
+
+Cached values are stored as serialized JSON; every hit returns a fresh copy
+that callers may mutate.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import CACHE_ENTRIES, CACHE_HITS, CACHE_MISSES, CACHE_EVICTIONS
+
+logger = logging.getLogger("route_optimizer")
+
+# Bump when the response shape changes so stale entries are never replayed.
+FINGERPRINT_VERSION = 9
+
+DEFAULT_CACHE_MAX_ENTRIES = 256
+DEFAULT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_CACHE_TTL_SECONDS = 900
+
+
+def _json_default(value):
+    # Binary edge penalties: hash the cells; str() elides large arrays.
+    if isinstance(value, np.ndarray):
+        digest = hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()
+        return {"dtype": value.dtype.str, "shape": list(value.shape), "sha256": digest}
+    return str(value)
+
+
+def _canonical_json(value):
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), default=_json_default)
+
+
+def problem_fingerprint(
+    locations,
+    start_index,
+    preferences,
+    distance_provider=None,
+    merge_radius_meters=None,
+    riders=None,
+):
+    """SHA-256 over the canonical form of a normalized problem.
+
+    locations must be the output of enforce_rules (coordinates already
+    floats, duplicates removed) so equivalent payloads hash identically.
+    distance_provider is the provider's cache_key (None for great-circle),
+    so a rebuilt road graph never replays routes solved on the old one.
+    With proximity merging, locations and start_index are the full
+    (pre-merge) ones and merge_radius_meters the radius applied. riders is
+    the problem's rider list for multi-rider solves.
+    """
+    canonical = _canonical_json({
+        "v": FINGERPRINT_VERSION,
+        "locations": locations,
+        "start_index": int(start_index),
+        "preferences": preferences or {},
+        "distance_provider": distance_provider,
+        "merge_radius_meters": merge_radius_meters,
+        "riders": riders,
+    })
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class _SqliteStore:
+    """Shared on-disk tier; safe for concurrent use by several processes."""
+
+    def __init__(self, path, max_entries, name):
+        self.path = path
+        self.max_entries = max_entries
+        self.name = name
+        # One table per cache name so caches sharing a file evict independently.
+        self.table = f"{name}_entries"
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} ("
+            " key TEXT PRIMARY KEY, expires_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL, value BLOB NOT NULL)"
+        )
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table}(accessed_at)"
+        )
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, now):
+        conn = self._conn()
+        row = conn.execute(
+            f"SELECT expires_at, value FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None, None
+        expires_at, value = row
+        if expires_at <= now:
+            conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            conn.commit()
+            CACHE_EVICTIONS.labels(cache=self.name, tier="disk", reason="expired").inc()
+            return None, None
+        conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+        conn.commit()
+        return expires_at, bytes(value)
+
+    def put(self, key, value, expires_at, now):
+        conn = self._conn()
+        conn.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, expires_at, accessed_at, value)"
+            " VALUES (?, ?, ?, ?)",
+            (key, expires_at, now, value),
+        )
+        expired = conn.execute(
+            f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,)
+        ).rowcount
+        overflow = conn.execute(
+            f"DELETE FROM {self.table} WHERE key IN ("
+            f" SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        conn.commit()
+        if expired > 0:
+            CACHE_EVICTIONS.labels(cache=self.name, tier="disk", reason="expired").inc(expired)
+        if overflow > 0:
+            CACHE_EVICTIONS.labels(cache=self.name, tier="disk", reason="capacity").inc(overflow)
+
+
+class ResultCache:
+    """Thread-safe LRU + TTL cache of JSON-serializable values.
+
+    Used for /optimize responses ("result") and remembered routes
+    ("route_hint"); name labels the metrics and the SQLite table.
+
+    Memory is bounded by both max_entries and max_bytes (size of the stored
+    JSON). When path is set, misses fall through to the shared SQLite tier;
+    disk errors are logged and treated as misses so the cache can never fail
+    a request.
+    """
+
+    def __init__(
+        self,
+        max_entries=DEFAULT_CACHE_MAX_ENTRIES,
+        max_bytes=DEFAULT_CACHE_MAX_BYTES,
+        ttl_seconds=DEFAULT_CACHE_TTL_SECONDS,
+        path=None,
+        name="result",
+    ):
+        self.name = name
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = max(1, int(max_bytes))
+        self.ttl_seconds = float(ttl_seconds)
+        self._entries = OrderedDict()  # key -> (expires_at, value_bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._store = None
+        if path:
+            try:
+                self._store = _SqliteStore(path, self.max_entries, name)
+            except sqlite3.Error:
+                logger.exception("result cache store unavailable; using memory only")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return a copy of the cached value for key, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    CACHE_HITS.labels(cache=self.name, tier="memory").inc()
+                    return json.loads(value)
+                self._remove(key)
+                CACHE_EVICTIONS.labels(cache=self.name, tier="memory", reason="expired").inc()
+
+        if self._store is not None:
+            try:
+                expires_at, value = self._store.get(key, now)
+            except sqlite3.Error:
+                logger.exception("result cache store read failed")
+                expires_at, value = None, None
+            if value is not None:
+                with self._lock:
+                    self._insert(key, value, expires_at)
+                CACHE_HITS.labels(cache=self.name, tier="disk").inc()
+                return json.loads(value)
+
+        CACHE_MISSES.labels(cache=self.name).inc()
+        return None
+
+    def put(self, key, response):
+        """Store a JSON-serializable value under key."""
+        value = _canonical_json(response).encode("utf-8")
+        if len(value) > self.max_bytes:
+            return
+        now = time.time()
+        expires_at = now + self.ttl_seconds
+        with self._lock:
+            self._insert(key, value, expires_at)
+        if self._store is not None:
+            try:
+                self._store.put(key, value, expires_at, now)
+            except sqlite3.Error:
+                logger.exception("result cache store write failed")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            CACHE_ENTRIES.labels(cache=self.name).set(0)
+
+    def _insert(self, key, value, expires_at):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, value)
+        self._bytes += len(value)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            CACHE_EVICTIONS.labels(cache=self.name, tier="memory", reason="capacity").inc()
+        CACHE_ENTRIES.labels(cache=self.name).set(len(self._entries))
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self._bytes -= len(value)
+        CACHE_ENTRIES.labels(cache=self.name).set(len(self._entries))
+
+
+def _env_flag(name, default):
+    return str(os.environ.get(name, default)).lower() in ("1", "true", "yes")
+
+
+def build_result_cache(path=None):
+    """Create the process-wide cache from ROUTE_CACHE_* env vars (None if disabled).
+
+    path overrides ROUTE_CACHE_PATH.
+    """
+    if not _env_flag("ROUTE_CACHE_ENABLED", "true"):
+        return None
+    return ResultCache(
+        max_entries=int(os.environ.get("ROUTE_CACHE_MAX_ENTRIES", DEFAULT_CACHE_MAX_ENTRIES)),
+        max_bytes=int(os.environ.get("ROUTE_CACHE_MAX_BYTES", DEFAULT_CACHE_MAX_BYTES)),
+        ttl_seconds=float(os.environ.get("ROUTE_CACHE_TTL_SECONDS", DEFAULT_CACHE_TTL_SECONDS)),
+        path=path or os.environ.get("ROUTE_CACHE_PATH") or None,
+    )
+
+
+__all__ = [
+    "ResultCache",
+    "build_result_cache",
+    "problem_fingerprint",
+    "DEFAULT_CACHE_MAX_ENTRIES",
+    "DEFAULT_CACHE_MAX_BYTES",
+    "DEFAULT_CACHE_TTL_SECONDS",
+]
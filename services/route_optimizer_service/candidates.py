@@ -0,0 +1,431 @@
+"""Sparse k-nearest-neighbour candidate graphs.
+
+Good cycling routes almost only use arcs between nearby stops, so the
+sparse mode (preferences["sparse"]) replaces the dense N*N matrix with a
+candidate graph:
+
+  - a uniform grid over the projected stops (about k stops per cell) finds
+    each stop's k nearest neighbours by scanning only nearby cells;
+  - the neighbour lists are symmetrised and stored CSR-style, and only
+    those arcs get distances up front;
+  - any other arc the solver asks for is computed on demand and memoized.
+
+solve_candidate_graph then improves a greedy seed tour with 2-opt and
+Or-opt moves, followed by double-bridge kicks until the search budget runs
+out. Moves are only searched from candidate arcs (neighbour lists with
+don't-look bits), but closing a move may price or add an off-graph arc,
+such as d(b, e) in 2-opt or the gap left by an Or-opt segment. Setup and
+the move search scale with N*k instead of N*N; applying a move is O(N), as
+a 2-opt reversal or an Or-opt rebuild of the tour and its positions.
+
+The preference multipliers of apply_preferences_to_matrix (avoid_traffic,
+weather_consideration, time_of_day, priority) and edge penalties are not
+applied: every arc is a great-circle distance.
+"""
+import logging
+import math
+import os
+import random
+import time
+from collections import deque
+
+import numpy as np
+
+from solver import (
+    EARTH_RADIUS_METERS,
+    coordinate_arrays,
+    pair_distances,
+    resolve_search_budget,
+)
+
+logger = logging.getLogger("route_optimizer")
+
+# Hard upper bound on locations accepted with preferences["sparse"].
+SPARSE_MAX_LOCATIONS = int(os.environ.get("ROUTE_SPARSE_MAX_LOCATIONS", 1000))
+
+# Neighbours per stop (preferences["candidate_neighbors"]).
+DEFAULT_CANDIDATE_NEIGHBORS = 10
+MIN_CANDIDATE_NEIGHBORS = 4
+MAX_CANDIDATE_NEIGHBORS = 50
+
+# Double-bridge kicks perturb a window of this many consecutive stops.
+KICK_WINDOW = 50
+
+
+def wants_sparse(preferences):
+    return bool((preferences or {}).get("sparse"))
+
+
+def resolve_candidate_neighbors(preferences):
+    value = (preferences or {}).get("candidate_neighbors")
+    if not isinstance(value, int) or isinstance(value, bool):
+        return DEFAULT_CANDIDATE_NEIGHBORS
+    return max(MIN_CANDIDATE_NEIGHBORS, min(MAX_CANDIDATE_NEIGHBORS, value))
+
+
+def _grid_knn(x, y, k):
+    """Approximate k nearest neighbours (excluding self) via a uniform grid.
+
+    Each cell's stops are compared against the surrounding ring of cells,
+    widened until it holds more than k stops, so results are exact except
+    when a nearer stop lies just outside the ring.
+    """
+    size = x.size
+    k = min(k, size - 1)
+    width = max(float(np.ptp(x)), 1.0)
+    height = max(float(np.ptp(y)), 1.0)
+    cell = max(1.0, math.sqrt(width * height * k / size))
+    cx = ((x - x.min()) // cell).astype(np.int64)
+    cy = ((y - y.min()) // cell).astype(np.int64)
+    columns = int(cx.max()) + 1
+    rows = int(cy.max()) + 1
+    cell_ids = cy * columns + cx
+
+    order = np.argsort(cell_ids, kind="stable")
+    ids, starts, counts = np.unique(cell_ids[order], return_index=True, return_counts=True)
+    buckets = {int(c): order[s:s + n] for c, s, n in zip(ids, starts, counts)}
+
+    neighbours = np.empty((size, k), dtype=np.int64)
+    for cell_id, members in buckets.items():
+        gx, gy = cell_id % columns, cell_id // columns
+        ring = 1
+        while True:
+            parts = [
+                buckets[yy * columns + xx]
+                for yy in range(max(0, gy - ring), min(rows, gy + ring + 1))
+                for xx in range(max(0, gx - ring), min(columns, gx + ring + 1))
+                if yy * columns + xx in buckets
+            ]
+            pool = np.concatenate(parts)
+            if pool.size > k or pool.size == size:
+                break
+            ring += 1
+        d = (x[members, None] - x[pool]) ** 2 + (y[members, None] - y[pool]) ** 2
+        d[members[:, None] == pool[None, :]] = np.inf
+        nearest = np.argpartition(d, k - 1, axis=1)[:, :k]
+        neighbours[members] = pool[nearest]
+    return neighbours
+
+
+class CandidateGraph:
+    """Symmetric kNN arc set with lazily computed off-graph distances."""
+
+    def __init__(self, locations, k=DEFAULT_CANDIDATE_NEIGHBORS, distance_mode=None):
+        self.size = len(locations)
+        self.distance_mode = distance_mode
+        self._phi, self._lam = coordinate_arrays(locations)
+        self._x = self._lam * (math.cos(float(self._phi.mean())) * EARTH_RADIUS_METERS)
+        self._y = self._phi * EARTH_RADIUS_METERS
+
+        self.k = min(k, self.size - 1)
+        knn = _grid_knn(self._x, self._y, self.k)
+        src = np.repeat(np.arange(self.size), self.k)
+        dst = knn.ravel()
+        # Symmetrise: j is a candidate of i whenever i is one of j's.
+        keys = np.unique(np.concatenate([src * self.size + dst, dst * self.size + src]))
+        src, dst = np.divmod(keys, self.size)
+        self.indptr = np.searchsorted(src, np.arange(self.size + 1))
+        self.indices = dst
+        self.data = pair_distances(self._phi, self._lam, src, dst, distance_mode)
+        self._rows = [
+            dict(zip(self.indices[a:b].tolist(), self.data[a:b].tolist()))
+            for a, b in zip(self.indptr[:-1], self.indptr[1:])
+        ]
+        # Candidates nearest-first, as (node, metres), for the local search.
+        self._ranked = [sorted(row.items(), key=lambda item: item[1]) for row in self._rows]
+        self.lazy_arcs = 0
+
+    @property
+    def arc_count(self):
+        return int(self.indices.size)
+
+    def neighbours(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def distance(self, i, j):
+        """Metres from i to j; off-graph arcs are computed once and memoized."""
+        row = self._rows[i]
+        value = row.get(j)
+        if value is None:
+            value = 0 if i == j else int(pair_distances(
+                self._phi, self._lam, [i], [j], self.distance_mode
+            )[0])
+            row[j] = value
+            self.lazy_arcs += 1
+        return value
+
+    def route_distance(self, route):
+        return sum(self.distance(a, b) for a, b in zip(route[:-1], route[1:]))
+
+    def seed_tour(self, start_index=0):
+        """Greedy nearest-neighbour tour (open, from start_index).
+
+        Follows candidate arcs while any leads to an unvisited stop, else
+        jumps to the nearest unvisited stop overall.
+        """
+        visited = np.zeros(self.size, dtype=bool)
+        visited[start_index] = True
+        tour = [start_index]
+        current = start_index
+        for _ in range(self.size - 1):
+            a, b = self.indptr[current], self.indptr[current + 1]
+            free = ~visited[self.indices[a:b]]
+            if free.any():
+                options = np.flatnonzero(free)
+                current = int(self.indices[a + options[int(np.argmin(self.data[a + options]))]])
+            else:
+                remaining = np.flatnonzero(~visited)
+                d = (self._x[remaining] - self._x[current]) ** 2 + (self._y[remaining] - self._y[current]) ** 2
+                current = int(remaining[int(np.argmin(d))])
+            visited[current] = True
+            tour.append(current)
+        return tour
+
+    def ranked(self, node):
+        return self._ranked[node]
+
+    def memory_bytes(self):
+        """Approximate size of the arc arrays (a dense int32 matrix is 4*N*N)."""
+        return int(self.indptr.nbytes + self.indices.nbytes + self.data.nbytes)
+
+
+class _CandidateSearch:
+    """2-opt / Or-opt over a cyclic tour, moves restricted to candidate arcs."""
+
+    def __init__(self, graph, tour):
+        self.graph = graph
+        self.d = graph.distance
+        self.tour = list(tour)
+        self.n = len(self.tour)
+        self.pos = [0] * self.n
+        for i, node in enumerate(self.tour):
+            self.pos[node] = i
+        self.cost = sum(self.d(a, b) for a, b in zip(self.tour, self.tour[1:] + self.tour[:1]))
+
+    def succ(self, node):
+        return self.tour[(self.pos[node] + 1) % self.n]
+
+    def pred(self, node):
+        return self.tour[self.pos[node] - 1]
+
+    def _reverse(self, i, j):
+        """Reverse the cyclic segment at positions i..j (the shorter side)."""
+        n, t, pos = self.n, self.tour, self.pos
+        length = (j - i) % n + 1
+        if 2 * length > n:
+            i, j, length = (j + 1) % n, (i - 1) % n, n - length
+        for k in range(length // 2):
+            a, b = (i + k) % n, (j - k) % n
+            t[a], t[b] = t[b], t[a]
+            pos[t[a]] = a
+            pos[t[b]] = b
+
+    def _two_opt(self, a):
+        d = self.d
+        for forward in (True, False):
+            b = self.succ(a) if forward else self.pred(a)
+            dab = d(a, b)
+            for c, dac in self.graph.ranked(a):
+                if dac >= dab:
+                    break
+                e = self.succ(c) if forward else self.pred(c)
+                if c == b or e == a:
+                    continue
+                delta = dac + d(b, e) - dab - d(c, e)
+                if delta < 0:
+                    if forward:
+                        self._reverse(self.pos[b], self.pos[c])
+                    else:
+                        self._reverse(self.pos[a], self.pos[e])
+                    self.cost += delta
+                    return (a, b, c, e)
+        return None
+
+    def _or_opt(self, a):
+        d, n = self.d, self.n
+        for length in (1, 2, 3):
+            if n < length + 3:
+                break
+            start = self.pos[a]
+            seg = [self.tour[(start + k) % n] for k in range(length)]
+            p, nx = self.pred(seg[0]), self.succ(seg[-1])
+            removal_gain = d(p, seg[0]) + d(seg[-1], nx) - d(p, nx)
+            if removal_gain <= 0:
+                continue
+            members = set(seg)
+            for end in (seg[0], seg[-1]):
+                for c, dc in self.graph.ranked(end):
+                    if dc >= removal_gain:
+                        break
+                    if c in members:
+                        continue
+                    for x, y in ((c, self.succ(c)), (self.pred(c), c)):
+                        if x in members or y in members or (x, y) == (p, nx):
+                            continue
+                        forward = d(x, seg[0]) + d(seg[-1], y)
+                        backward = d(x, seg[-1]) + d(seg[0], y)
+                        added = min(forward, backward) - d(x, y)
+                        if added < removal_gain:
+                            self._move(seg, x, seg if forward <= backward else seg[::-1])
+                            self.cost += added - removal_gain
+                            return (p, nx, x, y, seg[0], seg[-1])
+        return None
+
+    def _move(self, seg, after, ordered):
+        members = set(seg)
+        rest = [node for node in self.tour if node not in members]
+        at = rest.index(after) + 1
+        self.tour = rest[:at] + list(ordered) + rest[at:]
+        for i, node in enumerate(self.tour):
+            self.pos[node] = i
+
+    def optimize(self, nodes, deadline=None):
+        """Run moves from the queued nodes until no move improves."""
+        queue = deque(nodes)
+        queued = set(queue)
+        steps = 0
+        while queue:
+            a = queue.popleft()
+            queued.discard(a)
+            touched = self._two_opt(a) or self._or_opt(a)
+            if touched:
+                for node in touched:
+                    if node not in queued:
+                        queue.append(node)
+                        queued.add(node)
+                if a not in queued:
+                    queue.append(a)
+                    queued.add(a)
+            steps += 1
+            if deadline is not None and steps % 256 == 0 and time.monotonic() >= deadline:
+                return False
+        return True
+
+    def kick(self, rng):
+        """Double-bridge within a window; returns the nodes to re-examine."""
+        n, t, d = self.n, self.tour, self.d
+        window = min(KICK_WINDOW, n - 1)
+        i = rng.randrange(0, n - window)
+        p1, p2, p3 = sorted(rng.sample(range(i, i + window), 3))
+        a, b, c, e, f, g = t[p1], t[p1 + 1], t[p2], t[p2 + 1], t[p3], t[(p3 + 1) % n]
+        self.cost += d(a, e) + d(f, b) + d(c, g) - d(a, b) - d(c, e) - d(f, g)
+        t[p1 + 1:p3 + 1] = t[p2 + 1:p3 + 1] + t[p1 + 1:p2 + 1]
+        for k in range(p1 + 1, p3 + 1):
+            self.pos[t[k]] = k
+        return [a, b, c, e, f, g]
+
+    def snapshot(self):
+        return list(self.tour), self.cost
+
+    def restore(self, snapshot):
+        self.tour, self.cost = list(snapshot[0]), snapshot[1]
+        for i, node in enumerate(self.tour):
+            self.pos[node] = i
+
+    def route(self, start_index):
+        at = self.pos[start_index]
+        rotated = self.tour[at:] + self.tour[:at]
+        return rotated + [start_index]
+
+
+def solve_candidate_graph(graph, start_index=0, preferences=None, should_stop=None,
+                          on_solution=None, stats=None):
+    """Sparse-mode solve; returns (route_indices, solver_status).
+
+    Greedy seed tour, then candidate-restricted 2-opt/Or-opt, then
+    double-bridge kicks (iterated local search) until the search budget,
+    its plateau window or should_stop ends the search. Same statuses and
+    stats keys as solver.solve_tsp_distance_matrix, plus candidate_arcs,
+    lazy_arcs and kicks. The max_duration cap is not enforced here; the
+    pipeline reports it as a warning.
+    """
+    size = graph.size
+    if size == 0:
+        return [], "solved"
+    preferences = preferences or {}
+    if stats is None:
+        stats = {}
+    budget = resolve_search_budget(size, preferences)
+    started_at = time.monotonic()
+    deadline = started_at + budget["time_limit_seconds"]
+    plateau_seconds = budget["plateau_seconds"]
+    stop_reason = "completed"
+
+    search = _CandidateSearch(graph, graph.seed_tour(start_index))
+    if size > 3:
+        if not search.optimize(search.tour, deadline):
+            stop_reason = "time_limit"
+    best = search.snapshot()
+    if on_solution is not None:
+        on_solution(search.route(start_index), best[1])
+
+    kicks = 0
+    improvements = 1
+    last_improvement = time.monotonic()
+    rng = random.Random(size)
+    while size > 7 and stop_reason == "completed":
+        now = time.monotonic()
+        if now >= deadline:
+            stop_reason = "time_limit"
+        elif plateau_seconds is not None and now - last_improvement >= plateau_seconds:
+            stop_reason = "plateau"
+        elif should_stop is not None and should_stop():
+            stop_reason = "stopped"
+        if stop_reason != "completed":
+            break
+        kicks += 1
+        search.optimize(search.kick(rng), deadline)
+        if search.cost < best[1]:
+            best = search.snapshot()
+            improvements += 1
+            last_improvement = time.monotonic()
+            if on_solution is not None:
+                on_solution(search.route(start_index), best[1])
+        else:
+            search.restore(best)
+
+    search.restore(best)
+    route = search.route(start_index)
+    elapsed = time.monotonic() - started_at
+    stats.update({
+        "engine": "candidate_graph",
+        "time_limit_seconds": round(budget["time_limit_seconds"], 3),
+        "stop_reason": stop_reason,
+        "objective": best[1],
+        "lower_bound": None,
+        "gap": None,
+        "candidate_arcs": graph.arc_count,
+        "lazy_arcs": graph.lazy_arcs,
+        "kicks": kicks,
+        "improvements": improvements,
+    })
+    logger.info({
+        "event": "solver_outcome",
+        "status": "solved",
+        "engine": "candidate_graph",
+        "elapsed_s": round(elapsed, 3),
+        "size": size,
+        "stop_reason": stop_reason,
+        "kicks": kicks,
+    })
+    return route, "solved"
+
+
+def build_candidate_graph(locations, preferences=None):
+    preferences = preferences or {}
+    return CandidateGraph(
+        locations,
+        k=resolve_candidate_neighbors(preferences),
+        distance_mode=preferences.get("distance_mode"),
+    )
+
+
+__all__ = [
+    "CandidateGraph",
+    "build_candidate_graph",
+    "solve_candidate_graph",
+    "resolve_candidate_neighbors",
+    "wants_sparse",
+    "SPARSE_MAX_LOCATIONS",
+    "DEFAULT_CANDIDATE_NEIGHBORS",
+]
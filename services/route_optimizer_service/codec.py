@@ -0,0 +1,195 @@
+"""JSON encoding for the optimize endpoints.
+
+Request bodies are parsed and responses serialized with orjson when it is
+installed (json otherwise), outside Flask's jsonify. Responses of at least
+ROUTE_COMPRESS_MIN_BYTES are gzip-compressed for clients that accept it.
+Parsing, serializing and compressing are timed as request phases (see
+timing.py). /optimize, /optimize/stream and /optimize/jobs also accept the
+binary format in wire.py.
+
+"compact": true in an /optimize (or batch) body asks for a compact response:
+the route (each rider's route in multi-rider responses) becomes
+route_indices (positions in the request's locations list, null for an
+inserted rest stop) and route_ids, and the per-stop and preference-echo
+warnings are collapsed into counts.
+"""
+import gzip
+import json
+import os
+
+from flask import Response
+
+from timing import current_timer, phase
+from wire import BINARY_MIMETYPE, decode_request
+
+try:
+    import orjson
+except ImportError:  # optional: faster encoding only
+    orjson = None
+
+JSON_MIMETYPE = "application/json"
+
+DEFAULT_COMPRESS_MIN_BYTES = 1024
+COMPRESS_MIN_BYTES = int(os.environ.get("ROUTE_COMPRESS_MIN_BYTES", DEFAULT_COMPRESS_MIN_BYTES))
+# gzip level 5 compresses route JSON nearly as well as 9 at a fraction of the cost.
+COMPRESS_LEVEL = 5
+
+# Warnings repeated once per stop; compact responses report how many.
+_PER_STOP_WARNINGS = (
+    ("duplicate stop removed: ", "duplicate_stops_removed"),
+    ("invalid coordinates for stop ", "invalid_stops_skipped"),
+    ("stops merged into ", "merge_groups"),
+)
+_PREFERENCE_ECHO = "preference received: "
+
+
+class InvalidJSON(ValueError):
+    """The request body is not valid JSON."""
+
+
+def loads(data):
+    """Decode a JSON request body; empty bodies decode to None."""
+    if not data:
+        return None
+    try:
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+    except ValueError as exc:
+        raise InvalidJSON(str(exc)) from exc
+
+
+def dumps(value):
+    """Compact JSON bytes (numpy scalars and arrays included)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                value, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+            )
+        except TypeError:
+            pass
+    return json.dumps(value, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+
+def _json_default(value):
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def wants_compact(payload):
+    return isinstance(payload, dict) and payload.get("compact") is True
+
+
+def _location_key(loc):
+    try:
+        return (round(float(loc.get("lat")), 6), round(float(loc.get("lng")), 6))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def compact_warnings(warnings):
+    out = []
+    counts = {}
+    for warning in warnings or []:
+        if warning.startswith(_PREFERENCE_ECHO):
+            continue
+        for prefix, name in _PER_STOP_WARNINGS:
+            if warning.startswith(prefix):
+                counts[name] = counts.get(name, 0) + 1
+                break
+        else:
+            out.append(warning)
+    out.extend(f"{name}: {count}" for name, count in counts.items())
+    return out
+
+
+def _compact_route(route, positions):
+    return {
+        "route_indices": [positions.get(_location_key(loc)) for loc in route],
+        "route_ids": [loc.get("id") for loc in route],
+    }
+
+
+def compact_response(body, request_locations):
+    """Compact form of a successful /optimize body (other bodies unchanged)."""
+    if not isinstance(body, dict) or ("route" not in body and "routes" not in body):
+        return body
+    # rules.enforce_rules keeps the first stop per rounded coordinate.
+    positions = {}
+    for index, loc in enumerate(request_locations or []):
+        key = _location_key(loc)
+        if key is not None:
+            positions.setdefault(key, index)
+    compact = {k: v for k, v in body.items() if k not in ("route", "warnings")}
+    if "routes" in body:
+        compact["routes"] = [
+            {**{k: v for k, v in rider.items() if k != "route"}, **_compact_route(rider["route"], positions)}
+            for rider in body["routes"]
+        ]
+    else:
+        compact.update(_compact_route(body["route"], positions))
+    compact["warnings"] = compact_warnings(body.get("warnings"))
+    return compact
+
+
+def compact_batch(body, problems):
+    """Compact every successful item of a /optimize/batch response."""
+    for item in body.get("results") or []:
+        if item and item.get("status") == "ok":
+            problem = problems[item["index"]]
+            locations = problem.get("locations") if isinstance(problem, dict) else None
+            item["result"] = compact_response(item["result"], locations)
+    return body
+
+
+def json_response(body, status=200, headers=None, request=None):
+    """Serialize body into a Response, gzip it when worthwhile.
+
+    The phases of the current request timer, serialize and compress
+    included, are sent as a Server-Timing header.
+    """
+    with phase("serialize"):
+        data = dumps(body)
+
+    response_headers = dict(headers or {})
+    if len(data) >= COMPRESS_MIN_BYTES:
+        response_headers["Vary"] = "Accept-Encoding"
+        if request is not None and request.accept_encodings.quality("gzip") > 0:
+            with phase("compress"):
+                data = gzip.compress(data, compresslevel=COMPRESS_LEVEL)
+            response_headers["Content-Encoding"] = "gzip"
+    timer = current_timer()
+    if timer is not None:
+        response_headers["Server-Timing"] = timer.server_timing()
+    return Response(data, status=status, mimetype=JSON_MIMETYPE, headers=response_headers)
+
+
+def parse_request(request, binary=False):
+    """Decoded body of request (timed as the "parse" phase).
+
+    With binary=True, bodies sent as wire.BINARY_MIMETYPE are decoded by
+    wire.decode_request. Raises InvalidJSON or wire.WireFormatError; a JSON
+    null body decodes to {}.
+    """
+    with phase("parse"):
+        if binary and request.mimetype == BINARY_MIMETYPE:
+            payload = decode_request(request.get_data(cache=False))
+        else:
+            payload = loads(request.get_data(cache=False))
+    return payload or {}
+
+
+__all__ = [
+    "InvalidJSON",
+    "JSON_MIMETYPE",
+    "DEFAULT_COMPRESS_MIN_BYTES",
+    "loads",
+    "dumps",
+    "wants_compact",
+    "compact_warnings",
+    "compact_response",
+    "compact_batch",
+    "json_response",
+    "parse_request",
+]
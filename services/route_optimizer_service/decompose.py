@@ -0,0 +1,376 @@
+"""Spatial decomposition for routes with thousands of stops.
+
+A single RoutingModel over N stops needs an N*N matrix and a search whose
+cost grows much faster than N. Decomposition keeps every step bounded by
+the cluster size:
+
+  1. partition -- recursive median bisection of the projected coordinates
+                  (an adaptive grid) into clusters of at most cluster_size
+                  stops;
+  2. order     -- a tour over the cluster centroids, starting at the
+                  cluster that holds the start stop;
+  3. solve     -- per cluster, an open path from an entry stop (nearest the
+                  previous cluster's exit) to an exit stop (nearest the next
+                  cluster), fanned out over the batch process pool;
+  4. repair    -- 2-opt/Or-opt over a window of stops around every junction
+                  between consecutive clusters.
+
+Only cluster- and window-sized matrices are built, so memory and latency
+grow roughly linearly with stop count.
+"""
+import math
+import multiprocessing
+import os
+import time
+import logging
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from fastpath import local_search_tour
+from rules import MAX_LOCATIONS
+from solver import (
+    EARTH_RADIUS_METERS,
+    compute_distance_matrix,
+    coordinate_arrays,
+    pair_distances,
+    solve_route,
+)
+
+logger = logging.getLogger("route_optimizer")
+
+# Hard upper bound on locations accepted with preferences["decompose"].
+DECOMPOSE_MAX_LOCATIONS = int(os.environ.get("ROUTE_DECOMPOSE_MAX_LOCATIONS", 5000))
+
+# Stops per cluster (preferences["cluster_size"]); clusters end up between
+# half and all of this size.
+DEFAULT_CLUSTER_SIZE = 40
+MIN_CLUSTER_SIZE = 8
+
+# Stops re-optimized on each side of a junction between clusters.
+REPAIR_WINDOW = 10
+
+# Preferences forwarded to the per-cluster solves. Edge penalties and the
+# max_duration cap apply to the whole route and are not forwarded.
+_CLUSTER_PREFERENCE_KEYS = (
+    "distance_mode",
+    "priority",
+    "solver_engine",
+    "solver_budget",
+    "solver_time_limit_seconds",
+    "solver_plateau_seconds",
+    "solver_target_gap",
+)
+
+
+def wants_decomposition(preferences):
+    return bool((preferences or {}).get("decompose"))
+
+
+def resolve_cluster_size(preferences):
+    value = (preferences or {}).get("cluster_size")
+    if not isinstance(value, int) or isinstance(value, bool):
+        return DEFAULT_CLUSTER_SIZE
+    return max(MIN_CLUSTER_SIZE, min(MAX_LOCATIONS, value))
+
+
+def _projected(locations):
+    """Planar (x, y) metres around the mean latitude; fine for partitioning."""
+    phi, lam = coordinate_arrays(locations)
+    x = lam * (math.cos(float(phi.mean())) * EARTH_RADIUS_METERS)
+    y = phi * EARTH_RADIUS_METERS
+    return x, y
+
+
+def partition(x, y, cluster_size):
+    """Split stop indices at the median of the longer axis until every part
+    holds at most cluster_size stops. Returns a list of index arrays."""
+    clusters = []
+    pending = [np.arange(x.size)]
+    while pending:
+        indices = pending.pop()
+        if indices.size <= cluster_size:
+            clusters.append(indices)
+            continue
+        xs, ys = x[indices], y[indices]
+        axis = xs if np.ptp(xs) >= np.ptp(ys) else ys
+        order = indices[np.argsort(axis, kind="stable")]
+        half = order.size // 2
+        pending.append(order[half:])
+        pending.append(order[:half])
+    return clusters
+
+
+def _with_anchor(matrix, first, last):
+    """Append a dummy node joined at zero cost to first and last only.
+
+    A closed tour through the dummy is an open path between first and last,
+    and the matrix stays symmetric so every engine can solve it.
+    """
+    size = matrix.shape[0]
+    big = int(matrix.max()) * size + 1
+    extended = np.full((size + 1, size + 1), big, dtype=np.int64)
+    extended[:size, :size] = matrix
+    extended[size, size] = 0
+    extended[size, [first, last]] = 0
+    extended[[first, last], size] = 0
+    return extended
+
+
+def _anchored_path(route, size, first):
+    """Strip the dummy node from a closed tour and orient it from first."""
+    path = [node for node in route if node != size]
+    if path and path[0] != first:
+        path.reverse()
+    return path
+
+
+def solve_cluster_path(locations, entry, exit_, preferences):
+    """Shortest open path through locations from entry to exit_.
+
+    Returns (path, solver_status); a fallback keeps the input order between
+    the fixed endpoints.
+    """
+    size = len(locations)
+    if size == 1:
+        return [entry], "solved"
+    if size == 2:
+        return [entry, exit_], "solved"
+    matrix = _with_anchor(compute_distance_matrix(locations, preferences), entry, exit_)
+    route, status = solve_route(matrix, start_index=size, preferences=preferences)
+    path = _anchored_path(route, size, entry)
+    if status != "solved" or len(path) != size or path[-1] != exit_:
+        middle = [i for i in range(size) if i not in (entry, exit_)]
+        return [entry] + middle + [exit_], "fallback"
+    return path, status
+
+
+def _nearest(x, y, candidates, px, py):
+    d = (x[candidates] - px) ** 2 + (y[candidates] - py) ** 2
+    return int(candidates[int(np.argmin(d))])
+
+
+def _order_clusters(locations, clusters, start_cluster, preferences):
+    centroids = [
+        {
+            "lat": float(np.mean([locations[i]["lat"] for i in members])),
+            "lng": float(np.mean([locations[i]["lng"] for i in members])),
+        }
+        for members in clusters
+    ]
+    matrix = compute_distance_matrix(centroids, preferences)
+    route, _ = solve_route(
+        matrix,
+        start_index=start_cluster,
+        preferences={
+            "solver_engine": "heuristic",
+            "distance_mode": preferences.get("distance_mode"),
+        },
+    )
+    return route[:-1]
+
+
+def _in_pool_worker():
+    # Batch items already run inside pool workers; never nest pools.
+    return multiprocessing.parent_process() is not None
+
+
+def _solve_paths(tasks, should_stop):
+    """Run solve_cluster_path for every task; returns (results, stopped)."""
+    results = [None] * len(tasks)
+    stopped = False
+    if len(tasks) > 1 and not _in_pool_worker():
+        from batch import get_process_pool, reset_process_pool
+
+        pool = get_process_pool()
+        try:
+            futures = {pool.submit(solve_cluster_path, *task): i for i, task in enumerate(tasks)}
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[futures[future]] = future.result()
+                if pending and should_stop is not None and should_stop():
+                    for future in pending:
+                        future.cancel()
+                    stopped = True
+                    break
+        except BrokenProcessPool:
+            reset_process_pool(pool)
+            logger.warning({"event": "decompose_pool_broken", "fallback": "inline"})
+
+    for i, task in enumerate(tasks):
+        if results[i] is not None:
+            continue
+        if stopped or (should_stop is not None and should_stop()):
+            stopped = True
+            locations, entry, exit_, _ = task
+            middle = [j for j in range(len(locations)) if j not in (entry, exit_)]
+            path = [entry] + middle + ([exit_] if exit_ != entry else [])
+            results[i] = (path, "fallback")
+            continue
+        results[i] = solve_cluster_path(*task)
+    return results, stopped
+
+
+def _repair_junction(locations, tour, position, preferences):
+    """Re-optimize the stops around tour[position]; returns metres saved."""
+    lo = max(1, position - REPAIR_WINDOW)
+    hi = min(len(tour) - 1, position + REPAIR_WINDOW - 1)
+    return repair_window(locations, tour, lo, hi, preferences)
+
+
+def repair_window(locations, tour, lo, hi, preferences, time_limit_seconds=None):
+    """2-opt/Or-opt over tour[lo:hi + 1] in place; returns metres saved.
+
+    tour is an open list of indices into locations starting at the start
+    stop (lo >= 1); the stops just outside the window stay fixed, so only a
+    window-sized matrix is built.
+    """
+    size = len(tour)
+    first = tour[lo - 1]
+    last = tour[hi + 1] if hi + 1 < size else tour[0]
+    if hi - lo < 1 or first == last:
+        return 0
+    nodes = [first] + tour[lo:hi + 1] + [last]
+    matrix = compute_distance_matrix([locations[i] for i in nodes], preferences)
+    before = int(matrix[np.arange(len(nodes) - 1), np.arange(1, len(nodes))].sum())
+    anchored = _with_anchor(matrix, 0, len(nodes) - 1)
+    dummy = len(nodes)
+    route, _ = local_search_tour(
+        anchored, dummy, time_limit_seconds=time_limit_seconds,
+        initial_tour=[dummy] + list(range(len(nodes))),
+    )
+    path = _anchored_path(route, dummy, 0)
+    if len(path) != len(nodes) or path[-1] != len(nodes) - 1:
+        return 0
+    after = int(matrix[path[:-1], path[1:]].sum())
+    if after >= before:
+        return 0
+    tour[lo:hi + 1] = [nodes[i] for i in path[1:-1]]
+    return before - after
+
+
+def _route_distance(locations, route, preferences):
+    """Real metres along route: unscaled legs, as every mode reports, summed
+    without building a full matrix."""
+    if len(route) < 2:
+        return 0
+    phi, lam = coordinate_arrays(locations)
+    legs = pair_distances(phi, lam, route[:-1], route[1:], preferences.get("distance_mode"))
+    return int(legs.sum())
+
+
+def solve_decomposed(locations, start_index=0, preferences=None, should_stop=None,
+                     on_solution=None, stats=None):
+    """Solve a large route by clusters; returns (route_indices, solver_status).
+
+    Same contract as solver.solve_route. stats receives the usual solver
+    keys plus distance_meters and a "decomposition" summary.
+    """
+    preferences = preferences or {}
+    if stats is None:
+        stats = {}
+    t0 = time.monotonic()
+    cluster_size = resolve_cluster_size(preferences)
+    x, y = _projected(locations)
+
+    clusters = partition(x, y, cluster_size)
+    start_cluster = next(i for i, members in enumerate(clusters) if start_index in members)
+    order = _order_clusters(locations, clusters, start_cluster, preferences)
+    ordered = [clusters[i] for i in order]
+
+    cluster_preferences = {k: preferences[k] for k in _CLUSTER_PREFERENCE_KEYS if k in preferences}
+    tasks = []
+    previous_exit = None
+    for pos, members in enumerate(ordered):
+        if pos == 0:
+            entry = start_index
+        else:
+            entry = _nearest(x, y, members, x[previous_exit], y[previous_exit])
+        if pos + 1 < len(ordered):
+            target = ordered[pos + 1]
+            tx, ty = float(x[target].mean()), float(y[target].mean())
+        else:
+            tx, ty = x[start_index], y[start_index]
+        candidates = members[members != entry] if members.size > 1 else members
+        exit_ = _nearest(x, y, candidates, tx, ty)
+        local = {int(node): i for i, node in enumerate(members)}
+        tasks.append((
+            [locations[int(node)] for node in members],
+            local[entry],
+            local[exit_],
+            cluster_preferences,
+        ))
+        previous_exit = exit_
+    partitioned_s = time.monotonic() - t0
+
+    results, stopped = _solve_paths(tasks, should_stop)
+    tour = []
+    junctions = []
+    fallbacks = 0
+    for members, (path, status) in zip(ordered, results):
+        if tour:
+            junctions.append(len(tour))
+        tour.extend(int(members[i]) for i in path)
+        if status != "solved":
+            fallbacks += 1
+    junctions.append(len(tour))
+    solved_s = time.monotonic() - t0
+
+    repair_gain = 0
+    if not stopped:
+        for position in junctions:
+            repair_gain += _repair_junction(locations, tour, position, preferences)
+
+    route = tour + [start_index]
+    distance_meters = _route_distance(locations, route, preferences)
+    status = "solved" if fallbacks == 0 else "fallback"
+    if on_solution is not None and not stopped:
+        on_solution(route, distance_meters)
+
+    elapsed = time.monotonic() - t0
+    stats.update({
+        "engine": "decomposed",
+        "time_limit_seconds": preferences.get("solver_time_limit_seconds"),
+        "stop_reason": "stopped" if stopped else "completed",
+        "objective": distance_meters,
+        "lower_bound": None,
+        "gap": None,
+        "distance_meters": distance_meters,
+        "decomposition": {
+            "method": "bisection",
+            "clusters": len(clusters),
+            "cluster_size": cluster_size,
+            "largest_cluster": max(int(members.size) for members in clusters),
+            "fallback_clusters": fallbacks,
+            "junctions_repaired": len(junctions),
+            "repair_gain_meters": repair_gain,
+            "partition_seconds": round(partitioned_s, 3),
+            "solve_seconds": round(solved_s - partitioned_s, 3),
+            "repair_seconds": round(elapsed - solved_s, 3),
+        },
+    })
+    logger.info({
+        "event": "solver_outcome",
+        "status": status,
+        "engine": "decomposed",
+        "elapsed_s": round(elapsed, 3),
+        "size": len(locations),
+        "clusters": len(clusters),
+    })
+    return route, status
+
+
+__all__ = [
+    "solve_decomposed",
+    "solve_cluster_path",
+    "repair_window",
+    "partition",
+    "wants_decomposition",
+    "resolve_cluster_size",
+    "DECOMPOSE_MAX_LOCATIONS",
+    "DEFAULT_CLUSTER_SIZE",
+    "REPAIR_WINDOW",
+]
@@ -0,0 +1,311 @@
+"""Incremental route edits for POST /optimize/delta.
+
+Adding or removing a stop used to mean resubmitting the whole route to
+/optimize: a full N*N matrix and a fresh solver budget. A delta starts from
+a solved route instead, either a previous response's cache_key or the
+route inline, and then:
+
+  1. remove -- drops the listed stops, joining their neighbours directly;
+  2. insert -- places each new stop at its cheapest position, which needs
+               only the distances from the new stop to the route (one row
+               per stop; the distances are symmetric);
+  3. repair -- 2-opt/Or-opt over a window of REPAIR_WINDOW stops around
+               every stop that was inserted or lost a neighbour, within a
+               ROUTE_DELTA_REPAIR_SECONDS budget.
+
+Distances are great-circle (preferences["distance_mode"] applies); the
+response has the /optimize shape with solver_engine "delta". It is cached
+under its own cache_key, so edits can be chained.
+"""
+import hashlib
+import json
+import os
+import time
+import logging
+
+import numpy as np
+
+from decompose import DECOMPOSE_MAX_LOCATIONS, REPAIR_WINDOW, repair_window
+from metrics import SOLVER_DURATION, priority_label, size_bucket
+from pipeline import SOLVER_VERSION
+from rules import enforce_rules
+from scorer import score_route
+from solver import coordinate_arrays, pair_distances
+from timing import phase
+from warmstart import remember_route, stop_key
+
+logger = logging.getLogger("route_optimizer")
+
+# Largest edited route; every step is linear in the stop count.
+DELTA_MAX_LOCATIONS = DECOMPOSE_MAX_LOCATIONS
+
+DEFAULT_DELTA_REPAIR_SECONDS = 0.05
+DELTA_REPAIR_SECONDS = float(
+    os.environ.get("ROUTE_DELTA_REPAIR_SECONDS", DEFAULT_DELTA_REPAIR_SECONDS)
+)
+
+# Preferences a delta cannot honour without the full matrix.
+_UNSUPPORTED_PREFERENCES = ("edge_penalties", "distance_provider", "decompose", "sparse")
+
+
+def _coordinate_key(loc):
+    return (round(loc["lat"], 6), round(loc["lng"], 6))
+
+
+def _digest(value):
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _base_route(payload, cache):
+    """(locations, base_key) of the route to edit, or raise LookupError/ValueError."""
+    cache_key = payload.get("cache_key")
+    if cache_key is not None:
+        entry = cache.get(str(cache_key)) if cache is not None else None
+        if not entry or not isinstance(entry.get("route"), list):
+            raise LookupError(str(cache_key))
+        route = entry["route"]
+    elif isinstance(payload.get("route"), list):
+        route, _ = enforce_rules({"locations": payload["route"]})
+    else:
+        raise ValueError("send cache_key or route")
+    # Responses end with a return to the start stop.
+    if len(route) > 1 and _coordinate_key(route[0]) == _coordinate_key(route[-1]):
+        route = route[:-1]
+    base_key = str(cache_key) if cache_key is not None else _digest(route)
+    return route, base_key
+
+
+def delta_fingerprint(base_key, add, remove, preferences):
+    """Cache key of an edit: the base route plus the edits applied to it."""
+    return "delta:" + _digest({
+        "base": base_key,
+        "add": add,
+        "remove": remove,
+        "preferences": preferences or {},
+    })
+
+
+def _remove_stops(route, remove, warnings):
+    """Route without the stops in remove (ids or stop keys) and the survivors' neighbours."""
+    wanted = {str(key) for key in remove}
+    start_key = stop_key(route[0])
+    if start_key in wanted:
+        warnings.append(f"remove ignored: {start_key} is the start stop")
+        wanted.discard(start_key)
+    kept, touched = [], set()
+    found = set()
+    for loc in route:
+        key = stop_key(loc)
+        if key in wanted:
+            found.add(key)
+            if kept:
+                touched.add(len(kept) - 1)
+            touched.add(len(kept))
+            continue
+        kept.append(loc)
+    for key in sorted(wanted - found):
+        warnings.append(f"remove ignored: unknown stop {key}")
+    # The successor of a removed last stop is the start (position 0).
+    touched = {position % len(kept) for position in touched}
+    return kept, touched
+
+
+def _insert_stops(tour, new_nodes, phi, lam, distance_mode):
+    """Cheapest insertion of new_nodes into the open tour (in place).
+
+    Returns the number of distance pairs evaluated.
+    """
+    # legs[i] is the leg from tour[i] to the next stop (the last one closes
+    # the tour).
+    nodes = np.asarray(tour, dtype=np.int64)
+    legs = pair_distances(phi, lam, nodes, np.roll(nodes, -1), distance_mode)
+    pairs = len(tour)
+    for node in new_nodes:
+        size = len(tour)
+        row = pair_distances(phi, lam, np.full(size, node), tour, distance_mode)
+        pairs += size
+        i = int(np.argmin(row + np.roll(row, -1) - legs))
+        tour.insert(i + 1, node)
+        legs = np.concatenate((legs[:i], [row[i], row[(i + 1) % size]], legs[i + 1:]))
+    return pairs
+
+
+def _repair(locations, tour, affected, preferences, time_limit_seconds):
+    """Window repair around the affected stops; returns (metres saved, windows, stop reason)."""
+    size = len(tour)
+    deadline = time.monotonic() + time_limit_seconds
+    positions = {node: i for i, node in enumerate(tour)}
+    windows = []
+    for position in sorted(positions[node] for node in affected):
+        # The start stays first and its predecessor fixed, so a window never
+        # closes on itself.
+        lo = max(1, position - REPAIR_WINDOW)
+        hi = min(size - 2, position + REPAIR_WINDOW - 1)
+        if hi - lo < 1:
+            continue
+        if windows and lo <= windows[-1][1] + 1:
+            windows[-1][1] = max(windows[-1][1], hi)
+        else:
+            windows.append([lo, hi])
+    saved = 0
+    for count, (lo, hi) in enumerate(windows):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return saved, count, "time_limit"
+        saved += repair_window(locations, tour, lo, hi, preferences, time_limit_seconds=remaining)
+    return saved, len(windows), "local_optimum"
+
+
+def run_delta(payload, trace_id, started_at=None, cache=None):
+    """Apply a delta edit and return (response_body, status_code).
+
+    cache is the ResultCache holding the base route when payload names one
+    by cache_key; the edited route is stored there too.
+    """
+    if started_at is None:
+        started_at = time.monotonic()
+    preferences = payload.get("preferences") or {}
+    add = payload.get("add") or []
+    remove = payload.get("remove") or []
+    if not isinstance(add, list) or not isinstance(remove, list):
+        return {"error": "add and remove must be lists"}, 400
+
+    with phase("base"):
+        try:
+            route, base_key = _base_route(payload, cache)
+        except LookupError:
+            logger.info({"trace_id": trace_id, "event": "bad_request", "reason": "delta_base_not_found"})
+            return {"error": "base_route_not_found", "cache_key": payload.get("cache_key")}, 404
+        except ValueError as exc:
+            return {"error": "no base route", "detail": str(exc)}, 400
+    if not route:
+        return {"error": "no base route", "detail": "route has no valid stops"}, 400
+    if len(route) + len(add) > DELTA_MAX_LOCATIONS:
+        return {
+            "error": "too_many_locations",
+            "max": DELTA_MAX_LOCATIONS,
+            "received": len(route) + len(add),
+        }, 400
+
+    key = delta_fingerprint(base_key, add, remove, preferences)
+    use_cache = cache is not None and payload.get("cache", True) is not False
+    if use_cache:
+        with phase("cache"):
+            cached = cache.get(key)
+        if cached is not None:
+            cached["trace_id"] = trace_id
+            cached["cached"] = True
+            return cached, 200
+
+    warnings = [
+        f"{name} ignored: not supported with delta"
+        for name in _UNSUPPORTED_PREFERENCES
+        if preferences.get(name) not in (None, False, "great_circle")
+    ]
+    delta_t0 = time.monotonic()
+    with phase("rules"):
+        kept, touched = _remove_stops(route, remove, warnings)
+        added, add_warnings = enforce_rules({"locations": add})
+        warnings.extend(add_warnings)
+        on_route = {_coordinate_key(loc) for loc in kept}
+        new_stops = []
+        for loc in added:
+            if _coordinate_key(loc) in on_route:
+                warnings.append(f"duplicate stop removed: {loc.get('id')}")
+                continue
+            on_route.add(_coordinate_key(loc))
+            new_stops.append(loc)
+
+    locations = kept + new_stops
+    tour = list(range(len(kept)))
+    distance_mode = preferences.get("distance_mode")
+    phi, lam = coordinate_arrays(locations)
+    with phase("insert"):
+        pairs = _insert_stops(tour, range(len(kept), len(locations)), phi, lam, distance_mode)
+    # touched holds positions in kept, which are also their node indices;
+    # the start never moves.
+    affected = (touched | set(range(len(kept), len(locations)))) - {0}
+    saved, windows, stop_reason = 0, 0, "local_optimum"
+    if len(tour) > 3 and affected:
+        with phase("repair"):
+            saved, windows, stop_reason = _repair(
+                locations, tour, affected, preferences, DELTA_REPAIR_SECONDS
+            )
+    route_indices = tour + [tour[0]]
+    legs = pair_distances(phi, lam, route_indices[:-1], route_indices[1:], distance_mode)
+    distance_meters = int(legs.sum())
+    delta_elapsed_s = time.monotonic() - delta_t0
+
+    ordered = [locations[i] for i in route_indices]
+    with phase("score"):
+        score = score_route(ordered, distance_meters=distance_meters)
+    max_duration = preferences.get("max_duration_minutes")
+    if isinstance(max_duration, (int, float)) and max_duration > 0:
+        # 15 km/h average = 250 m/min
+        if distance_meters > max_duration * 250.0:
+            warnings.append("max_duration_exceeded")
+
+    SOLVER_DURATION.labels(
+        size=size_bucket(len(locations)),
+        priority=priority_label(preferences.get("priority")),
+        solver_status="solved",
+        engine="delta",
+    ).observe(delta_elapsed_s)
+
+    delta_stats = {
+        "base_stops": len(route),
+        "added": len(new_stops),
+        "removed": len(route) - len(kept),
+        "repair_windows": windows,
+        "repair_gain_meters": saved,
+        "distance_pairs": pairs + len(legs),
+    }
+    response = {
+        "route": ordered,
+        "metrics": {
+            "locations_count": len(locations),
+            "distance_meters": distance_meters,
+            "distance_km": round(distance_meters / 1000.0, 3),
+            "delta": delta_stats,
+        },
+        "score": score,
+        "solver_status": "solved",
+        "solver_time_seconds": round(delta_elapsed_s, 3),
+        "solver_time_limit_applied": True,
+        "solver_engine": "delta",
+        "solver_time_limit_seconds": DELTA_REPAIR_SECONDS,
+        "solver_stop_reason": stop_reason,
+        "solver_gap": None,
+        "warm_start": None,
+        "warnings": warnings,
+        "solver_version": SOLVER_VERSION,
+        "cached": False,
+        "cache_key": key if use_cache else None,
+        "trace_id": trace_id,
+    }
+    if use_cache:
+        with phase("cache"):
+            cache.put(key, response)
+    route_id = payload.get("route_id")
+    if route_id not in (None, ""):
+        remember_route(str(route_id), ordered)
+
+    logger.info({
+        "trace_id": trace_id,
+        "event": "optimize_delta",
+        "delta": delta_stats,
+        "solver_stop_reason": stop_reason,
+        "total_time_s": round(time.monotonic() - started_at, 3),
+        "distance_meters": distance_meters,
+        "warnings": warnings,
+    })
+    return response, 200
+
+
+__all__ = [
+    "run_delta",
+    "delta_fingerprint",
+    "DELTA_MAX_LOCATIONS",
+    "DEFAULT_DELTA_REPAIR_SECONDS",
+]
@@ -0,0 +1,232 @@
+"""Pluggable distance providers for the dense distance matrix.
+
+A provider turns normalized locations into an N*N int32 matrix of metres.
+preferences["distance_provider"] picks one by name, falling back to
+ROUTE_DISTANCE_PROVIDER and then "great_circle":
+
+  great_circle -- haversine (or equirectangular with distance_mode), built
+                  in and always available;
+  road         -- street distances from the graph in ROUTE_ROAD_GRAPH_PATH
+                  (see roadgraph.py / roadgraph_build.py).
+
+A distance_matrix sent with the request bypasses this lookup and is served
+by CallerMatrixProvider (name "caller").
+
+Providers expose name, cache_key (changes whenever the provider would return
+different distances, e.g. after a graph rebuild) and matrix(locations,
+preferences) -> (matrix, stats). Providers that set cacheable also expose
+block(origins, destinations, preferences) -> (matrix, stats) and are wrapped
+in a CachedProvider when the shared pair cache is configured, so recurring
+stop pairs are computed once per host. Other providers can be added with
+register_distance_provider.
+"""
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+
+from pair_cache import get_pair_cache, stop_keys
+from roadgraph import (
+    DEFAULT_MAX_SNAP_METERS,
+    open_road_graph,
+    road_distance_block,
+    road_distance_matrix,
+)
+
+logger = logging.getLogger("route_optimizer")
+
+GREAT_CIRCLE = "great_circle"
+ROAD = "road"
+CALLER = "caller"
+
+DEFAULT_DISTANCE_PROVIDER = os.environ.get("ROUTE_DISTANCE_PROVIDER", GREAT_CIRCLE)
+
+_factories = {}
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+class ProviderUnavailable(Exception):
+    """A provider cannot serve requests (missing config or unreadable data)."""
+
+
+class GreatCircleProvider:
+    """Built-in provider; solver.compute_distance_matrix computes it inline."""
+
+    name = GREAT_CIRCLE
+    cache_key = GREAT_CIRCLE
+    # Cheaper to recompute than to look up.
+    cacheable = False
+
+    def matrix(self, locations, preferences=None):
+        from solver import great_circle_matrix
+
+        return great_circle_matrix(locations, preferences), {}
+
+
+class RoadNetworkProvider:
+    """Street distances from a memory-mapped contraction hierarchy."""
+
+    name = ROAD
+    cacheable = True
+
+    def __init__(self, path, max_snap_meters=DEFAULT_MAX_SNAP_METERS, graph=None):
+        self.path = path
+        self.graph = graph if graph is not None else open_road_graph(path)
+        self.max_snap_meters = max_snap_meters
+        self.cache_key = f"{ROAD}:{self.graph.graph_id}:{max_snap_meters:g}"
+
+    def refresh(self):
+        """This provider, or a new one bound to the graph path now names."""
+        graph = open_road_graph(self.path)
+        if graph is self.graph:
+            return self
+        return RoadNetworkProvider(self.path, self.max_snap_meters, graph)
+
+    def matrix(self, locations, preferences=None):
+        return road_distance_matrix(self.graph, locations, self.max_snap_meters)
+
+    def block(self, origins, destinations, preferences=None):
+        return road_distance_block(self.graph, origins, destinations, self.max_snap_meters)
+
+
+class CallerMatrixProvider:
+    """Distances the caller sent with the request (distance_matrix)."""
+
+    name = CALLER
+    cacheable = False
+
+    def __init__(self, matrix):
+        self._matrix = matrix
+        digest = hashlib.sha256(np.ascontiguousarray(matrix).tobytes()).hexdigest()
+        self.cache_key = f"{CALLER}:{matrix.shape[0]}:{digest}"
+
+    def matrix(self, locations, preferences=None):
+        return self._matrix, {}
+
+
+class CachedProvider:
+    """Wraps a cacheable provider with the shared pair cache.
+
+    A matrix request looks up every ordered pair, then computes one block
+    covering the origins and destinations that still have unknown pairs.
+    """
+
+    def __init__(self, provider, pair_cache):
+        self.provider = provider
+        self.pair_cache = pair_cache
+        self.name = provider.name
+        self.cache_key = provider.cache_key
+
+    def matrix(self, locations, preferences=None):
+        keys = stop_keys(locations)
+        matrix, known = self.pair_cache.lookup(self.cache_key, keys)
+        missing = ~known
+        stats = {
+            "pair_cache_hits": int(known.sum()) - len(keys),
+            "pair_cache_misses": int(missing.sum()),
+        }
+        if not missing.any():
+            return matrix, stats
+        rows = np.flatnonzero(missing.any(axis=1))
+        cols = np.flatnonzero(missing.any(axis=0))
+        block, block_stats = self.provider.block(
+            [locations[i] for i in rows], [locations[j] for j in cols], preferences
+        )
+        cells = np.ix_(rows, cols)
+        matrix[cells] = np.where(missing[cells], block, matrix[cells])
+        self.pair_cache.store(
+            self.cache_key, [keys[i] for i in rows], [keys[j] for j in cols], block, missing[cells]
+        )
+        stats.update(block_stats)
+        return matrix, stats
+
+
+def _road_provider():
+    path = os.environ.get("ROUTE_ROAD_GRAPH_PATH")
+    if not path:
+        raise ProviderUnavailable("ROUTE_ROAD_GRAPH_PATH is not set")
+    max_snap = float(os.environ.get("ROUTE_ROAD_MAX_SNAP_METERS", DEFAULT_MAX_SNAP_METERS))
+    try:
+        return RoadNetworkProvider(path, max_snap)
+    except (OSError, ValueError, KeyError) as exc:
+        raise ProviderUnavailable(f"cannot open road graph: {exc}") from exc
+
+
+def register_distance_provider(name, factory):
+    """Register factory() -> provider under name (replaces any existing one).
+
+    The factory runs once per process, on first use; raise
+    ProviderUnavailable to make requests fall back to great_circle. A
+    provider with a refresh() method is asked for its current version on
+    every lookup (the previous one is kept if that fails), so each request
+    sees one cache_key and one set of distances.
+    """
+    with _providers_lock:
+        _factories[name] = factory
+        _providers.pop(name, None)
+
+
+def get_distance_provider(name):
+    """Provider registered as name; raises KeyError or ProviderUnavailable."""
+    with _providers_lock:
+        provider = _providers.get(name)
+        if provider is None:
+            provider = _factories[name]()
+        elif hasattr(provider, "refresh"):
+            try:
+                provider = provider.refresh()
+            except (OSError, ValueError, KeyError) as exc:
+                # A broken new build: keep serving the one already open.
+                logger.warning({
+                    "event": "distance_provider_refresh_failed",
+                    "provider": name,
+                    "error": str(exc),
+                })
+        _providers[name] = provider
+    if getattr(provider, "cacheable", False):
+        pair_cache = get_pair_cache()
+        if pair_cache is not None:
+            return CachedProvider(provider, pair_cache)
+    return provider
+
+
+def resolve_distance_provider(preferences):
+    """Provider for a request as (provider, warning).
+
+    provider is None for great_circle, which callers compute inline; warning
+    is None unless the requested provider was unknown or unavailable.
+    """
+    requested = (preferences or {}).get("distance_provider") or DEFAULT_DISTANCE_PROVIDER
+    if requested == GREAT_CIRCLE:
+        return None, None
+    try:
+        return get_distance_provider(requested), None
+    except KeyError:
+        return None, f"distance_provider ignored: unknown provider {requested!r}"
+    except ProviderUnavailable as exc:
+        logger.warning({
+            "event": "distance_provider_unavailable",
+            "provider": requested,
+            "error": str(exc),
+        })
+        return None, f"distance_provider ignored: {requested} unavailable"
+
+
+register_distance_provider(GREAT_CIRCLE, GreatCircleProvider)
+register_distance_provider(ROAD, _road_provider)
+
+
+__all__ = [
+    "GreatCircleProvider",
+    "RoadNetworkProvider",
+    "CachedProvider",
+    "CallerMatrixProvider",
+    "ProviderUnavailable",
+    "register_distance_provider",
+    "get_distance_provider",
+    "resolve_distance_provider",
+    "DEFAULT_DISTANCE_PROVIDER",
+]
@@ -0,0 +1,174 @@
+"""Fast-path TSP solvers for routes too small to justify OR-Tools.
+
+Building a RoutingModel and running guided local search has a fixed
+overhead that dominates for short routes. These solvers work directly on
+the NumPy matrix and return closed tours in the same shape as
+solve_tsp_distance_matrix (start node first and last):
+
+  held_karp         -- exact dynamic programme, O(2^N * N^2); used up to
+                       HELD_KARP_MAX_STOPS, so the route is provably optimal.
+  local_search_tour -- nearest neighbour + 2-opt + Or-opt; a fast heuristic
+                       for mid sizes, symmetric matrices only.
+"""
+import time
+
+import numpy as np
+
+# Largest route (including the start) solved exactly with Held-Karp.
+HELD_KARP_MAX_STOPS = 12
+
+
+def tour_cost(distance_matrix, route):
+    route = np.asarray(route)
+    return int(np.asarray(distance_matrix)[route[:-1], route[1:]].sum())
+
+
+def held_karp(distance_matrix, start_index=0):
+    """Exact minimum-cost closed tour from start_index; returns (route, cost).
+
+    Subsets are processed layer by layer (by popcount), so each layer costs
+    one vectorized min per destination node.
+    """
+    matrix = np.asarray(distance_matrix, dtype=np.float64)
+    size = matrix.shape[0]
+    if size == 1:
+        return [start_index, start_index], 0
+    others = np.array([i for i in range(size) if i != start_index], dtype=np.int64)
+    k = others.size
+    inner = matrix[np.ix_(others, others)]
+    full = (1 << k) - 1
+
+    dp = np.full((1 << k, k), np.inf)
+    parent = np.full((1 << k, k), -1, dtype=np.int16)
+    singles = 1 << np.arange(k)
+    dp[singles, np.arange(k)] = matrix[start_index, others]
+
+    masks = np.arange(1 << k)
+    popcount = np.zeros(1 << k, dtype=np.int64)
+    for bit in range(k):
+        popcount += (masks >> bit) & 1
+    for layer in range(2, k + 1):
+        layer_masks = masks[popcount == layer]
+        for j in range(k):
+            with_j = layer_masks[(layer_masks >> j) & 1 == 1]
+            candidates = dp[with_j ^ (1 << j)] + inner[:, j]
+            best = np.argmin(candidates, axis=1)
+            dp[with_j, j] = candidates[np.arange(with_j.size), best]
+            parent[with_j, j] = best
+
+    closing = dp[full] + matrix[others, start_index]
+    last = int(np.argmin(closing))
+    cost = closing[last]
+
+    order = []
+    mask = full
+    node = last
+    while node != -1:
+        order.append(int(others[node]))
+        prev = int(parent[mask, node])
+        mask ^= 1 << node
+        node = prev
+    order.reverse()
+    return [start_index] + order + [start_index], int(round(cost))
+
+
+def nearest_neighbour_tour(distance_matrix, start_index=0):
+    """Greedy tour as an open list of nodes starting at start_index."""
+    matrix = np.asarray(distance_matrix)
+    size = matrix.shape[0]
+    unvisited = np.ones(size, dtype=bool)
+    unvisited[start_index] = False
+    tour = [start_index]
+    current = start_index
+    for _ in range(size - 1):
+        current = int(np.argmin(np.where(unvisited, matrix[current], np.iinfo(np.int64).max)))
+        unvisited[current] = False
+        tour.append(current)
+    return tour
+
+
+def _two_opt_pass(matrix, tour):
+    """Apply the best improving 2-opt move per position; True if improved."""
+    size = len(tour)
+    improved = False
+    for i in range(size - 2):
+        nodes = np.asarray(tour)
+        succ = np.roll(nodes, -1)
+        a, b = nodes[i], succ[i]
+        # Reverse tour[i+1..j] for every j > i + 1 in one vector op.
+        js = np.arange(i + 2, size)
+        if i == 0:
+            js = js[js < size - 1] if size > 3 else js[:0]
+        if js.size == 0:
+            continue
+        c, d = nodes[js], succ[js]
+        delta = matrix[a, c] + matrix[b, d] - matrix[a, b] - matrix[c, d]
+        best = int(np.argmin(delta))
+        if delta[best] < 0:
+            j = int(js[best])
+            tour[i + 1:j + 1] = tour[i + 1:j + 1][::-1]
+            improved = True
+    return improved
+
+
+def _or_opt_pass(matrix, tour, max_segment=3):
+    """Relocate segments of 1..max_segment nodes; True if improved."""
+    improved = False
+    for length in range(1, max_segment + 1):
+        i = 1
+        while i + length <= len(tour):
+            size = len(tour)
+            segment = tour[i:i + length]
+            prev_node = tour[i - 1]
+            next_node = tour[(i + length) % size]
+            removal_gain = (
+                matrix[prev_node, segment[0]] + matrix[segment[-1], next_node]
+                - matrix[prev_node, next_node]
+            )
+            rest = tour[:i] + tour[i + length:]
+            nodes = np.asarray(rest)
+            succ = np.roll(nodes, -1)
+            insert_cost = (
+                matrix[nodes, segment[0]] + matrix[segment[-1], succ] - matrix[nodes, succ]
+            )
+            best = int(np.argmin(insert_cost))
+            if insert_cost[best] < removal_gain and best != i - 1:
+                tour[:] = rest[:best + 1] + segment + rest[best + 1:]
+                improved = True
+            i += 1
+    return improved
+
+
+def local_search_tour(distance_matrix, start_index=0, time_limit_seconds=None,
+                      initial_tour=None):
+    """Nearest neighbour + 2-opt + Or-opt; returns (route, cost).
+
+    Assumes a symmetric matrix (2-opt reverses segments). initial_tour (an
+    open node list starting at start_index) replaces the nearest-neighbour
+    construction. Stops at a local optimum or when time_limit_seconds is
+    exhausted.
+    """
+    matrix = np.asarray(distance_matrix, dtype=np.int64)
+    size = matrix.shape[0]
+    if initial_tour is not None:
+        tour = [int(node) for node in initial_tour]
+    else:
+        tour = nearest_neighbour_tour(matrix, start_index)
+    if size > 3:
+        deadline = None if time_limit_seconds is None else time.monotonic() + time_limit_seconds
+        while True:
+            improved = _two_opt_pass(matrix, tour)
+            improved = _or_opt_pass(matrix, tour) or improved
+            if not improved or (deadline is not None and time.monotonic() >= deadline):
+                break
+    route = tour + [start_index]
+    return route, tour_cost(matrix, route)
+
+
+__all__ = [
+    "held_karp",
+    "local_search_tour",
+    "nearest_neighbour_tour",
+    "tour_cost",
+    "HELD_KARP_MAX_STOPS",
+]
@@ -0,0 +1,348 @@
+"""Asynchronous optimize jobs.
+
+POST /optimize/jobs hands the payload to a small background executor and
+returns a job id straight away, so long solver budgets never hold a request
+thread. Job records live in a store: in-process by default, or a SQLite file
+(ROUTE_JOB_STORE_PATH) when several gunicorn workers must see the same jobs.
+With a shared store any worker can answer GET/DELETE; the worker running a
+job polls the store for cancellation.
+
+With a solver pool, a job takes a solver slot (SolverPool.reserve) before it
+solves and stops at the pool deadline, counted from when it started; a job
+the pool turns away fails with http_status 503 and the rejection as result.
+
+Job lifecycle: queued -> running -> succeeded | failed, or cancelled from
+queued/running. Finished records are kept for ROUTE_JOB_RETENTION_SECONDS.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import JOB_QUEUE_WAIT, JOB_RUN_DURATION, JOB_OUTCOMES
+from pipeline import run_optimize
+from solver_pool import SolverOverloaded
+
+logger = logging.getLogger("route_optimizer")
+
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_JOB_MAX_PENDING = 20
+DEFAULT_JOB_RETENTION_SECONDS = 600
+
+# Minimum interval between cancellation checks while a solve is running.
+_CANCEL_POLL_INTERVAL_SECONDS = 0.2
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+_ACTIVE_STATES = (JOB_QUEUED, JOB_RUNNING)
+
+
+class _MemoryJobStore:
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def insert(self, record):
+        with self._lock:
+            self._jobs[record["job_id"]] = dict(record)
+
+    def get(self, job_id):
+        with self._lock:
+            record = self._jobs.get(job_id)
+            return dict(record) if record is not None else None
+
+    def update(self, job_id, expected_states, **fields):
+        """Apply fields only if the job is in one of expected_states."""
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is None or record["status"] not in expected_states:
+                return False
+            record.update(fields)
+            return True
+
+    def count_active(self):
+        with self._lock:
+            return sum(1 for r in self._jobs.values() if r["status"] in _ACTIVE_STATES)
+
+    def purge_expired(self, now):
+        with self._lock:
+            expired = [
+                job_id for job_id, r in self._jobs.items()
+                if r.get("expires_at") is not None and r["expires_at"] <= now
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+
+class _SqliteJobStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY, status TEXT NOT NULL,"
+            " expires_at REAL, record TEXT NOT NULL)"
+        )
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=2.0, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def insert(self, record):
+        self._conn().execute(
+            "INSERT INTO jobs (job_id, status, expires_at, record) VALUES (?, ?, ?, ?)",
+            (record["job_id"], record["status"], record.get("expires_at"), json.dumps(record)),
+        )
+
+    def get(self, job_id):
+        row = self._conn().execute(
+            "SELECT record FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, job_id, expected_states, **fields):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT record FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return False
+            record = json.loads(row[0])
+            if record["status"] not in expected_states:
+                conn.execute("COMMIT")
+                return False
+            record.update(fields)
+            conn.execute(
+                "UPDATE jobs SET status = ?, expires_at = ?, record = ? WHERE job_id = ?",
+                (record["status"], record.get("expires_at"), json.dumps(record), job_id),
+            )
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def count_active(self):
+        row = self._conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", _ACTIVE_STATES
+        ).fetchone()
+        return int(row[0])
+
+    def purge_expired(self, now):
+        self._conn().execute(
+            "DELETE FROM jobs WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,)
+        )
+
+
+class QueueFullError(Exception):
+    """Raised by JobManager.submit when max_pending jobs are already active."""
+
+
+class JobManager:
+    """Bounded background executor plus job store for optimize jobs."""
+
+    def __init__(
+        self,
+        workers=DEFAULT_JOB_WORKERS,
+        max_pending=DEFAULT_JOB_MAX_PENDING,
+        retention_seconds=DEFAULT_JOB_RETENTION_SECONDS,
+        store_path=None,
+        cache=None,
+        pool=None,
+    ):
+        self.workers = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.retention_seconds = float(retention_seconds)
+        self.cache = cache
+        self.pool = pool
+        self._store = _SqliteJobStore(store_path) if store_path else _MemoryJobStore()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="optimize-job"
+        )
+        self._submit_lock = threading.Lock()
+
+    def submit(self, payload, trace_id):
+        """Queue a job and return its public record; raises QueueFullError."""
+        now = time.time()
+        with self._submit_lock:
+            self._store.purge_expired(now)
+            if self._store.count_active() >= self.max_pending:
+                JOB_OUTCOMES.labels(outcome="rejected").inc()
+                raise QueueFullError()
+            record = {
+                "job_id": uuid.uuid4().hex,
+                "status": JOB_QUEUED,
+                "trace_id": trace_id,
+                "submitted_at": now,
+                "started_at": None,
+                "finished_at": None,
+                "expires_at": None,
+                "http_status": None,
+                "result": None,
+            }
+            self._store.insert(record)
+        self._executor.submit(self._run, record["job_id"], payload, trace_id)
+        return self.describe(record)
+
+    def get(self, job_id):
+        self._store.purge_expired(time.time())
+        record = self._store.get(job_id)
+        return self.describe(record) if record is not None else None
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job.
+
+        Returns the job record, or None when the job is unknown. A job that
+        already finished is returned unchanged.
+        """
+        now = time.time()
+        self._store.update(
+            job_id,
+            _ACTIVE_STATES,
+            status=JOB_CANCELLED,
+            finished_at=now,
+            expires_at=now + self.retention_seconds,
+        )
+        return self.get(job_id)
+
+    def _cancel_requested(self, job_id):
+        last_check = [0.0]
+
+        def should_stop():
+            now = time.monotonic()
+            if now - last_check[0] < _CANCEL_POLL_INTERVAL_SECONDS:
+                return False
+            last_check[0] = now
+            record = self._store.get(job_id)
+            return record is None or record["status"] == JOB_CANCELLED
+
+        return should_stop
+
+    def _run(self, job_id, payload, trace_id):
+        started = time.time()
+        if not self._store.update(job_id, (JOB_QUEUED,), status=JOB_RUNNING, started_at=started):
+            # Cancelled (or purged) while waiting in the queue.
+            JOB_OUTCOMES.labels(outcome=JOB_CANCELLED).inc()
+            return
+        record = self._store.get(job_id) or {}
+        JOB_QUEUE_WAIT.observe(max(0.0, started - record.get("submitted_at", started)))
+
+        t0 = time.monotonic()
+        try:
+            body, status = self._solve(payload, trace_id, job_id, t0)
+            outcome = JOB_SUCCEEDED if status == 200 else JOB_FAILED
+        except SolverOverloaded as exc:
+            logger.info({
+                "trace_id": trace_id,
+                "event": "solver_rejected",
+                "reason": exc.reason,
+                "job_id": job_id,
+            })
+            body = {
+                "error": "solver_overloaded",
+                "reason": exc.reason,
+                "retry_after": exc.retry_after,
+                "trace_id": trace_id,
+            }
+            status, outcome = 503, JOB_FAILED
+        except Exception:
+            logger.exception({"event": "optimize_job_failed", "job_id": job_id})
+            body, status, outcome = {"error": "internal_error"}, 500, JOB_FAILED
+        JOB_RUN_DURATION.observe(time.monotonic() - t0)
+
+        finished = time.time()
+        stored = self._store.update(
+            job_id,
+            (JOB_RUNNING,),
+            status=outcome,
+            finished_at=finished,
+            expires_at=finished + self.retention_seconds,
+            http_status=status,
+            result=body,
+        )
+        JOB_OUTCOMES.labels(outcome=outcome if stored else JOB_CANCELLED).inc()
+        logger.info({
+            "trace_id": trace_id,
+            "event": "optimize_job",
+            "job_id": job_id,
+            "status": outcome if stored else JOB_CANCELLED,
+            "run_time_s": round(time.monotonic() - t0, 3),
+        })
+
+    def _solve(self, payload, trace_id, job_id, started_at):
+        cancelled = self._cancel_requested(job_id)
+        if self.pool is None:
+            return run_optimize(payload, trace_id, cache=self.cache, should_stop=cancelled)
+
+        past_deadline = self.pool.stop_at_deadline(started_at)
+
+        def should_stop():
+            return past_deadline() or cancelled()
+
+        with self.pool.reserve():
+            return run_optimize(
+                payload, trace_id, started_at=started_at, cache=self.cache, should_stop=should_stop
+            )
+
+    @staticmethod
+    def describe(record):
+        """Public view of a job record."""
+        out = {
+            "job_id": record["job_id"],
+            "status": record["status"],
+            "trace_id": record.get("trace_id"),
+            "submitted_at": record["submitted_at"],
+            "started_at": record.get("started_at"),
+            "finished_at": record.get("finished_at"),
+            "expires_at": record.get("expires_at"),
+        }
+        if record.get("started_at"):
+            out["queue_wait_seconds"] = round(record["started_at"] - record["submitted_at"], 3)
+        if record["status"] in (JOB_SUCCEEDED, JOB_FAILED):
+            out["http_status"] = record.get("http_status")
+            out["result"] = record.get("result")
+        return out
+
+
+def build_job_manager(cache=None, pool=None):
+    """Create the process-wide JobManager from ROUTE_JOB_* env vars; pool is
+    the SolverPool jobs take their slots from, if any."""
+    return JobManager(
+        workers=int(os.environ.get("ROUTE_JOB_WORKERS", DEFAULT_JOB_WORKERS)),
+        max_pending=int(os.environ.get("ROUTE_JOB_MAX_PENDING", DEFAULT_JOB_MAX_PENDING)),
+        retention_seconds=float(
+            os.environ.get("ROUTE_JOB_RETENTION_SECONDS", DEFAULT_JOB_RETENTION_SECONDS)
+        ),
+        store_path=os.environ.get("ROUTE_JOB_STORE_PATH") or None,
+        cache=cache,
+        pool=pool,
+    )
+
+
+__all__ = [
+    "JobManager",
+    "QueueFullError",
+    "build_job_manager",
+    "DEFAULT_JOB_WORKERS",
+    "DEFAULT_JOB_MAX_PENDING",
+    "DEFAULT_JOB_RETENTION_SECONDS",
+]
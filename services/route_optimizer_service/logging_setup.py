@@ -1,25 +1,228 @@
+"""Service logging: a bounded queue drained by one background writer.
+
+Callers log structured events as dicts, logger.info({"event": ..., ...}),
+never as hand-built JSON strings; dicts are not serialized on the calling
+thread (plain-text messages remain for a few failures). The
+"route_optimizer" logger has a single handler that puts the record on a
+bounded queue; when it is full, INFO records are dropped at once and
+warnings wait briefly for space before being dropped, all counted in
+route_opt_log_records_dropped_total. A daemon thread takes records off
+in batches, serializes dict messages with orjson when it is installed (json
+otherwise) and writes each batch to stdout and the rotating log file with
+one flush per batch.
+
+ROUTE_LOG_SAMPLE samples high-volume INFO events, e.g.
+"optimize=0.1,solver_outcome=0.25" keeps 10% / 25% of them; warnings and
+errors are always kept. Dicts handed to the logger must not be mutated
+afterwards.
+"""
+import atexit
+import fcntl
+import json
 import logging
 import logging.handlers
 import os
+import queue
+import random
 import sys
+import threading
+
+from audit_log import append_index
+from metrics import LOG_RECORDS_DROPPED
+
+try:
+    import orjson
+except ImportError:  # optional: faster serialization only
+    orjson = None
 
 LOG_DIR = os.environ.get("ROUTE_LOG_DIR", ".")
 os.makedirs(LOG_DIR, exist_ok=True)
+LOG_PATH = os.path.join(LOG_DIR, "route_optimizer.log")
+LOG_BACKUP_COUNT = 5
+
+LOG_QUEUE_SIZE = int(os.environ.get("ROUTE_LOG_QUEUE_SIZE", 10_000))
+LOG_BATCH_SIZE = 256
+# Warnings and errors (audit events included) wait this long for queue space
+# before being dropped; INFO records are dropped at once.
+WARNING_ENQUEUE_TIMEOUT_SECONDS = 1.0
 
 logger = logging.getLogger("route_optimizer")
 logger.setLevel(logging.INFO)
 
+
+def _parse_sample_rates(value):
+    rates = {}
+    for item in (value or "").split(","):
+        name, _, rate = item.partition("=")
+        try:
+            rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+SAMPLE_RATES = _parse_sample_rates(os.environ.get("ROUTE_LOG_SAMPLE"))
+
+
+def _event_name(record):
+    # Only dict events are sampled; plain-text messages are always kept.
+    if isinstance(record.msg, dict):
+        return record.msg.get("event")
+    return None
+
+
+def dumps(value):
+    """Compact JSON text for a log event (non-JSON values via str)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                value, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+            ).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(value, separators=(",", ":"), default=str)
+
+
+class _QueueHandler(logging.Handler):
+    """Enqueue records as-is; formatting happens on the writer thread."""
+
+    def __init__(self, records):
+        super().__init__()
+        self.records = records
+
+    def emit(self, record):
+        if record.levelno < logging.WARNING and SAMPLE_RATES:
+            rate = SAMPLE_RATES.get(_event_name(record))
+            if rate is not None and random.random() >= rate:
+                LOG_RECORDS_DROPPED.labels(reason="sampled").inc()
+                return
+        try:
+            if record.levelno >= logging.WARNING:
+                self.records.put(record, timeout=WARNING_ENQUEUE_TIMEOUT_SECONDS)
+            else:
+                self.records.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.labels(reason="queue_full").inc()
+
+
+class _BatchFlushMixin:
+    """Handlers flush once per batch instead of once per record."""
+
+    batching = False
+
+    def flush(self):
+        if not self.batching:
+            super().flush()
+
+    def flush_batch(self):
+        self.batching = False
+        self.flush()
+
+
+class BatchStreamHandler(_BatchFlushMixin, logging.StreamHandler):
+    pass
+
+
+class AuditIndexingFileHandler(_BatchFlushMixin, logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler that indexes records logged with extra={"audit_event": ...}."""
+
+    def emit(self, record):
+        event = getattr(record, "audit_event", None)
+        if event is None:
+            super().emit(record)
+            return
+        try:
+            data = (self.format(record) + self.terminator).encode(self.encoding or "utf-8")
+            if self.stream is None:
+                self.stream = self._open()
+            # Batched lines go out first so the file keeps record order.
+            self.stream.flush()
+            if self.maxBytes > 0:
+                self.stream.seek(0, os.SEEK_END)
+                if self.stream.tell() + len(data) >= self.maxBytes:
+                    self.doRollover()
+                    if self.stream is None:
+                        self.stream = self._open()
+            fd = self.stream.fileno()
+            # One write on the O_APPEND descriptor leaves it just past the
+            # line, whatever other processes append. The lock orders audit
+            # lines and their index entries the same way across processes.
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                os.write(fd, data)
+                offset = os.lseek(fd, 0, os.SEEK_CUR) - len(data)
+                append_index(self.baseFilename, event, record.created, os.fstat(fd).st_ino, offset)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        except Exception:
+            self.handleError(record)
+
+
+class _LogWriter(threading.Thread):
+    """Drains the record queue in batches into the output handlers."""
+
+    def __init__(self, records, handlers):
+        super().__init__(name="route-optimizer-log-writer", daemon=True)
+        self.records = records
+        self.handlers = handlers
+
+    def _write(self, batch):
+        for handler in self.handlers:
+            handler.batching = True
+        for record in batch:
+            if isinstance(record.msg, dict):
+                record.msg = dumps(record.msg)
+                record.args = None
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        for handler in self.handlers:
+            handler.flush_batch()
+
+    def run(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                return
+            batch = [record]
+            stop = False
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    record = self.records.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+            self._write(batch)
+            if stop:
+                return
+
+    def stop(self, timeout=5.0):
+        try:
+            self.records.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+
+formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+
 # Rotating file handler (fallback for local file captures)
-fh = logging.handlers.RotatingFileHandler(
-    os.path.join(LOG_DIR, "route_optimizer.log"), maxBytes=10_000_000, backupCount=5, encoding="utf-8"
+fh = AuditIndexingFileHandler(
+    LOG_PATH, maxBytes=10_000_000, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
 )
-formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
 fh.setFormatter(formatter)
 
 # Console handler for container stdout (preferred for orchestration)
-ch = logging.StreamHandler(stream=sys.stdout)
+ch = BatchStreamHandler(stream=sys.stdout)
 ch.setFormatter(formatter)
 
 if not logger.handlers:
-    logger.addHandler(ch)
-    logger.addHandler(fh)
+    _records = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    writer = _LogWriter(_records, [ch, fh])
+    writer.start()
+    logger.addHandler(_QueueHandler(_records))
+    # Drain what is queued when the process exits.
+    atexit.register(writer.stop)
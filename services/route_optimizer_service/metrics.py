@@ -1,18 +1,229 @@
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+"""Prometheus metrics for the optimizer service.
+
+gunicorn runs several worker processes (each with its solver pool), so a
+per-process registry would make /metrics report whichever process answered.
+When PROMETHEUS_MULTIPROC_DIR is set (the Docker image sets it, and
+gunicorn.conf.py empties it at startup) every process writes its samples to
+that directory and render_metrics() aggregates them across all processes.
+Gauges declare how they aggregate: "livesum" sums live processes only.
+
+Per-solve series are labeled by size (size_bucket of the location count),
+priority and solver_status so latency can be broken down by problem shape.
+"""
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+# Seconds; dense at the low end for the exact fast path, up to the largest
+# decomposed solves.
+SOLVE_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75,
+    1.0, 1.5, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0,
+)
+# Seconds; rules and matrix builds are milliseconds to ~1 s (road graphs).
+PHASE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Seconds; any request phase, from sub-millisecond steps to the solver.
+REQUEST_PHASE_BUCKETS = PHASE_BUCKETS + (5.0, 10.0, 30.0, 60.0)
+DISTANCE_BUCKETS = (1_000, 2_500, 5_000, 10_000, 20_000, 40_000, 80_000, 160_000, 500_000, 2_000_000)
+GAP_BUCKETS = (0.0, 0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5)
+
+# priority is client input: anything else is reported as "other".
+_PRIORITY_LABELS = frozenset(("duration", "efficiency", "coverage"))
+
+_SIZE_BUCKETS = ((2, "1-2"), (12, "3-12"), (30, "13-30"), (60, "31-60"), (100, "61-100"),
+                 (500, "101-500"), (1000, "501-1000"))
+
+
+def size_bucket(count):
+    """Location-count label for per-solve metrics."""
+    for upper, label in _SIZE_BUCKETS:
+        if count <= upper:
+            return label
+    return ">1000"
+
+
+def priority_label(priority):
+    """Bounded priority label for per-solve metrics."""
+    if not priority:
+        return "default"
+    return priority if priority in _PRIORITY_LABELS else "other"
+
 
 REQ_COUNTER = Counter("route_opt_requests_total", "Total optimize requests")
 REQ_DURATION = Histogram(
-    "route_opt_request_duration_seconds", "Total wall-clock duration of optimize requests"
+    "route_opt_request_duration_seconds",
+    "Total wall-clock duration of optimize requests",
+    buckets=SOLVE_BUCKETS,
 )
 SOLVER_DURATION = Histogram(
     "route_opt_solver_duration_seconds",
-    "Wall-clock time spent inside the OR-Tools solver only",
+    "Wall-clock time spent inside the solver only",
+    ["size", "priority", "solver_status", "engine"],
+    buckets=SOLVE_BUCKETS,
+)
+RULES_DURATION = Histogram(
+    "route_opt_rules_duration_seconds",
+    "Time spent validating and normalizing locations (enforce_rules)",
+    ["size"],
+    buckets=PHASE_BUCKETS,
+)
+MATRIX_DURATION = Histogram(
+    "route_opt_matrix_build_duration_seconds",
+    "Time spent building the distance matrix or candidate graph",
+    ["size", "provider"],
+    buckets=PHASE_BUCKETS,
+)
+ROUTE_DISTANCE = Histogram(
+    "route_opt_route_distance_meters",
+    "Objective value: total distance of returned routes",
+    ["size", "priority"],
+    buckets=DISTANCE_BUCKETS,
+)
+SOLVER_GAP = Histogram(
+    "route_opt_solver_gap_ratio",
+    "Relative gap to the lower bound at the end of a solve (when known)",
+    ["size", "engine"],
+    buckets=GAP_BUCKETS,
+)
+SOLVER_IMPROVEMENTS = Counter(
+    "route_opt_solver_improvements_total",
+    "Improving solutions found by the solver",
+    ["size", "engine"],
+)
+PORTFOLIO_RUNS = Counter(
+    "route_opt_portfolio_runs_total",
+    "Portfolio solves each search configuration took part in",
+    ["size", "config"],
+)
+PORTFOLIO_WINS = Counter(
+    "route_opt_portfolio_wins_total",
+    "Portfolio solves won (best objective) by each search configuration",
+    ["size", "config"],
+)
+SOLVES_IN_FLIGHT = Gauge(
+    "route_opt_solves_in_flight",
+    "Solves currently running",
+    multiprocess_mode="livesum",
 )
 
+PHASE_DURATION = Histogram(
+    "route_opt_phase_duration_seconds",
+    "Time per /optimize phase (auth, parse, rules, matrix, solver, serialize, ...)",
+    ["phase"],
+    buckets=REQUEST_PHASE_BUCKETS,
+)
+
+CACHE_HITS = Counter(
+    "route_opt_cache_hits_total", "Optimizer cache hits", ["cache", "tier"]
+)
+CACHE_MISSES = Counter(
+    "route_opt_cache_misses_total", "Optimizer cache misses", ["cache"]
+)
+CACHE_ENTRIES = Gauge(
+    "route_opt_cache_entries",
+    "Entries held in the in-memory cache tier",
+    ["cache"],
+    multiprocess_mode="livesum",
+)
+CACHE_EVICTIONS = Counter(
+    "route_opt_cache_evictions_total",
+    "Optimizer cache entries evicted (capacity) or expired (ttl)",
+    ["cache", "tier", "reason"],
+)
+
+JOB_QUEUE_WAIT = Histogram(
+    "route_opt_job_queue_wait_seconds",
+    "Time optimize jobs spend queued before a background worker starts them",
+)
+JOB_RUN_DURATION = Histogram(
+    "route_opt_job_run_duration_seconds",
+    "Wall-clock run time of background optimize jobs",
+)
+JOB_OUTCOMES = Counter(
+    "route_opt_jobs_total",
+    "Optimize jobs by outcome (succeeded, failed, cancelled, rejected)",
+    ["outcome"],
+)
+SOLVER_QUEUE_DEPTH = Gauge(
+    "route_opt_solver_queue_depth",
+    "Optimize requests waiting for an idle solver process",
+    multiprocess_mode="livesum",
+)
+SOLVER_QUEUE_WAIT = Histogram(
+    "route_opt_solver_queue_wait_seconds",
+    "Time optimize requests wait for an idle solver process",
+)
+SOLVER_REJECTIONS = Counter(
+    "route_opt_solver_rejections_total",
+    "Optimize requests rejected by solver admission control",
+    ["reason"],
+)
+SOLVER_WORKER_RESTARTS = Counter(
+    "route_opt_solver_worker_restarts_total",
+    "Solver processes killed and replaced (deadline, crashed, startup_timeout)",
+    ["reason"],
+)
+LOG_RECORDS_DROPPED = Counter(
+    "route_opt_log_records_dropped_total",
+    "Log records not written: sampled out or dropped because the log queue was full",
+    ["reason"],
+)
+
+
+def render_metrics():
+    """Exposition text for /metrics, aggregated across processes when enabled."""
+    if not MULTIPROCESS:
+        return generate_latest()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def mark_process_dead(pid):
+    """Drop a dead process's live gauges (no-op without multiprocess mode)."""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
+
+
 __all__ = [
     "REQ_COUNTER",
     "REQ_DURATION",
     "SOLVER_DURATION",
+    "RULES_DURATION",
+    "MATRIX_DURATION",
+    "ROUTE_DISTANCE",
+    "SOLVER_GAP",
+    "SOLVER_IMPROVEMENTS",
+    "PORTFOLIO_RUNS",
+    "PORTFOLIO_WINS",
+    "SOLVES_IN_FLIGHT",
+    "PHASE_DURATION",
+    "CACHE_ENTRIES",
+    "CACHE_HITS",
+    "CACHE_MISSES",
+    "CACHE_EVICTIONS",
+    "JOB_QUEUE_WAIT",
+    "JOB_RUN_DURATION",
+    "JOB_OUTCOMES",
+    "SOLVER_QUEUE_DEPTH",
+    "SOLVER_QUEUE_WAIT",
+    "SOLVER_REJECTIONS",
+    "SOLVER_WORKER_RESTARTS",
+    "LOG_RECORDS_DROPPED",
+    "size_bucket",
+    "priority_label",
+    "render_metrics",
+    "mark_process_dead",
     "generate_latest",
     "CONTENT_TYPE_LATEST",
 ]
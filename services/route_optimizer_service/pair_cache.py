@@ -0,0 +1,247 @@
+"""Shared cache of pairwise stop distances.
+
+Stops recur across routes, so distances from expensive providers (road
+networks) are kept per ordered stop pair in a local SQLite file that every
+gunicorn worker on the host reads and writes. Pairs are keyed by the
+provider's cache_key and the stop coordinates quantized to the 6 decimals
+enforce_rules rounds to; a matrix request then only computes the rows and
+columns that hold pairs never seen before.
+
+The table is bounded by ROUTE_PAIR_CACHE_MAX_ENTRIES. Its row count is kept
+in a one-row side table, updated in the same transaction as every insert,
+so writes never count the table. When a write takes it over the limit, the
+least recently used entries are deleted down to 90% of it as one range of
+the accessed_at index. Hits refresh accessed_at at most once per
+TOUCH_INTERVAL_SECONDS so reads stay read-only in the common case. Disk
+errors are logged and treated as misses.
+"""
+import logging
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+import numpy as np
+
+from metrics import CACHE_HITS, CACHE_MISSES, CACHE_EVICTIONS
+
+logger = logging.getLogger("route_optimizer")
+
+DEFAULT_PAIR_CACHE_MAX_ENTRIES = 2_000_000
+COORDINATE_SCALE = 1_000_000  # 6 decimals, as in rules.enforce_rules
+TOUCH_INTERVAL_SECONDS = 3600
+# SQLite's default bound-parameter limit is 999 on older builds.
+_QUERY_CHUNK = 900
+
+_PAIR = struct.Struct("<4i")
+
+
+def stop_keys(locations):
+    """Quantized (lat, lng) integers per stop."""
+    return [
+        (
+            int(round(float(loc["lat"]) * COORDINATE_SCALE)),
+            int(round(float(loc["lng"]) * COORDINATE_SCALE)),
+        )
+        for loc in locations
+    ]
+
+
+def _pair_key(origin, destination):
+    return _PAIR.pack(origin[0], origin[1], destination[0], destination[1])
+
+
+class PairDistanceCache:
+    """Ordered-pair distances (int metres) per provider namespace."""
+
+    table = "pair_distances"
+
+    def __init__(self, path, max_entries=DEFAULT_PAIR_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max(1, int(max_entries))
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} ("
+            " provider TEXT NOT NULL, pair BLOB NOT NULL, meters INTEGER NOT NULL,"
+            " accessed_at REAL NOT NULL, PRIMARY KEY (provider, pair)) WITHOUT ROWID"
+        )
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table}(accessed_at)"
+        )
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table}_count ("
+            " id INTEGER PRIMARY KEY CHECK (id = 0), rows INTEGER NOT NULL)"
+        )
+        # Counted once when the side table is new (e.g. a file written
+        # before it existed); afterwards every write keeps it current.
+        if conn.execute(f"SELECT 1 FROM {self.table}_count").fetchone() is None:
+            conn.execute(
+                f"INSERT OR IGNORE INTO {self.table}_count (id, rows)"
+                f" SELECT 0, COUNT(*) FROM {self.table}"
+            )
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0)
+            self._local.conn = conn
+        return conn
+
+    def lookup(self, provider, keys):
+        """Known cells of the len(keys)^2 matrix as (matrix, known_mask).
+
+        Diagonal cells count as known (0 m).
+        """
+        size = len(keys)
+        matrix = np.zeros((size, size), dtype=np.int32)
+        known = np.eye(size, dtype=bool)
+        cells = {}
+        for i, origin in enumerate(keys):
+            for j, destination in enumerate(keys):
+                if i != j:
+                    cells[_pair_key(origin, destination)] = (i, j)
+        if not cells:
+            return matrix, known
+
+        now = time.time()
+        stale = []
+        try:
+            conn = self._conn()
+            pairs = list(cells)
+            for k in range(0, len(pairs), _QUERY_CHUNK):
+                chunk = pairs[k:k + _QUERY_CHUNK]
+                rows = conn.execute(
+                    f"SELECT pair, meters, accessed_at FROM {self.table}"
+                    f" WHERE provider = ? AND pair IN ({','.join('?' * len(chunk))})",
+                    [provider, *chunk],
+                ).fetchall()
+                for pair, meters, accessed_at in rows:
+                    i, j = cells[bytes(pair)]
+                    matrix[i, j] = meters
+                    known[i, j] = True
+                    if accessed_at < now - TOUCH_INTERVAL_SECONDS:
+                        stale.append(bytes(pair))
+            for k in range(0, len(stale), _QUERY_CHUNK):
+                chunk = stale[k:k + _QUERY_CHUNK]
+                conn.execute(
+                    f"UPDATE {self.table} SET accessed_at = ?"
+                    f" WHERE provider = ? AND pair IN ({','.join('?' * len(chunk))})",
+                    [now, provider, *chunk],
+                )
+            if stale:
+                conn.commit()
+        except sqlite3.Error:
+            logger.exception("pair cache read failed")
+            return np.zeros((size, size), dtype=np.int32), np.eye(size, dtype=bool)
+
+        hits = int(known.sum()) - size
+        if hits:
+            CACHE_HITS.labels(cache="pair", tier="disk").inc(hits)
+        if len(cells) - hits:
+            CACHE_MISSES.labels(cache="pair").inc(len(cells) - hits)
+        return matrix, known
+
+    def store(self, provider, origin_keys, destination_keys, block, mask):
+        """Store block[r, c] for every cell where mask is set."""
+        now = time.time()
+        rows = [
+            (provider, _pair_key(origin_keys[r], destination_keys[c]), int(block[r, c]), now)
+            for r, c in zip(*np.nonzero(mask))
+        ]
+        if not rows:
+            return
+        try:
+            conn = self._conn()
+            before = conn.total_changes
+            # A pair another worker stored meanwhile has the same distance.
+            conn.executemany(
+                f"INSERT OR IGNORE INTO {self.table} (provider, pair, meters, accessed_at)"
+                " VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            inserted = conn.total_changes - before
+            conn.execute(f"UPDATE {self.table}_count SET rows = rows + ?", (inserted,))
+            evicted = self._evict(conn)
+            conn.commit()
+        except sqlite3.Error:
+            logger.exception("pair cache write failed")
+            return
+        if evicted > 0:
+            CACHE_EVICTIONS.labels(cache="pair", tier="disk", reason="capacity").inc(evicted)
+
+    def _evict(self, conn):
+        count = conn.execute(f"SELECT rows FROM {self.table}_count").fetchone()[0]
+        if count <= self.max_entries:
+            return 0
+        # Drop down to 90% so eviction runs once per many writes, not per write.
+        keep = self.max_entries * 9 // 10
+        excess = count - keep
+        cutoff = conn.execute(
+            f"SELECT accessed_at FROM {self.table} ORDER BY accessed_at LIMIT 1 OFFSET ?",
+            (excess - 1,),
+        ).fetchone()
+        evicted = 0
+        if cutoff is not None:
+            evicted = conn.execute(
+                f"DELETE FROM {self.table} WHERE accessed_at < ?", cutoff
+            ).rowcount
+            # Rows written together share accessed_at: take the rest of the
+            # excess from the cutoff timestamp only.
+            evicted += conn.execute(
+                f"DELETE FROM {self.table} WHERE (provider, pair) IN ("
+                f" SELECT provider, pair FROM {self.table} WHERE accessed_at = ? LIMIT ?)",
+                (cutoff[0], excess - evicted),
+            ).rowcount
+        if evicted < excess:
+            # The stored count drifted above the table (e.g. rows removed by
+            # hand): resynchronize it.
+            conn.execute(
+                f"UPDATE {self.table}_count SET rows = (SELECT COUNT(*) FROM {self.table})"
+            )
+        else:
+            conn.execute(f"UPDATE {self.table}_count SET rows = rows - ?", (evicted,))
+        return evicted
+
+
+_pair_cache = None
+_pair_cache_lock = threading.Lock()
+
+
+def get_pair_cache():
+    """Process-wide PairDistanceCache, or None when no cache path is configured.
+
+    Uses ROUTE_PAIR_CACHE_PATH, else the result cache file (ROUTE_CACHE_PATH);
+    ROUTE_PAIR_CACHE_ENABLED=false turns it off.
+    """
+    global _pair_cache
+    if str(os.environ.get("ROUTE_PAIR_CACHE_ENABLED", "true")).lower() not in ("1", "true", "yes"):
+        return None
+    path = os.environ.get("ROUTE_PAIR_CACHE_PATH") or os.environ.get("ROUTE_CACHE_PATH")
+    if not path:
+        return None
+    with _pair_cache_lock:
+        if _pair_cache is None:
+            try:
+                _pair_cache = PairDistanceCache(
+                    path,
+                    int(os.environ.get("ROUTE_PAIR_CACHE_MAX_ENTRIES", DEFAULT_PAIR_CACHE_MAX_ENTRIES)),
+                )
+            except sqlite3.Error:
+                logger.exception("pair cache store unavailable")
+                return None
+        return _pair_cache
+
+
+__all__ = [
+    "PairDistanceCache",
+    "get_pair_cache",
+    "stop_keys",
+    "DEFAULT_PAIR_CACHE_MAX_ENTRIES",
+]
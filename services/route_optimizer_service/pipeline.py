@@ -0,0 +1,689 @@
+"""Optimize pipeline shared by the HTTP endpoints.
+
+Runs rules -> distance matrix -> solver -> scoring for one /optimize payload
+without touching Flask, so the same code path serves request threads and any
+other caller that holds a decoded payload.
+"""
+import time
+import logging
+
+import numpy as np
+
+from metrics import (
+    MATRIX_DURATION,
+    ROUTE_DISTANCE,
+    RULES_DURATION,
+    SOLVER_DURATION,
+    SOLVER_GAP,
+    SOLVER_IMPROVEMENTS,
+    SOLVES_IN_FLIGHT,
+    priority_label,
+    size_bucket,
+)
+from solver import (
+    apply_preferences_to_matrix,
+    raw_distance_matrix,
+    solve_fleet_distance_matrix,
+    solve_route,
+)
+from fastpath import HELD_KARP_MAX_STOPS
+from rules import (
+    MAX_LOCATIONS,
+    enforce_rules,
+    expand_merged_route,
+    group_walk_meters,
+    merge_nearby_stops,
+    resolve_merge_radius,
+)
+from scorer import score_route
+from portfolio import resolve_portfolio
+from cache import problem_fingerprint
+from distance_providers import CallerMatrixProvider, resolve_distance_provider
+from timing import phase, request_timer
+from wire import distance_matrix_array, select_stops
+from warmstart import lookup_route, map_route_hint, remember_route
+from decompose import (
+    DECOMPOSE_MAX_LOCATIONS,
+    resolve_cluster_size,
+    solve_decomposed,
+    wants_decomposition,
+)
+from candidates import (
+    SPARSE_MAX_LOCATIONS,
+    build_candidate_graph,
+    solve_candidate_graph,
+    wants_sparse,
+)
+
+logger = logging.getLogger("route_optimizer")
+
+SOLVER_VERSION = "ortools-9.6"
+
+# Largest "riders" count accepted by /optimize.
+MAX_RIDERS = 20
+
+
+def _parse_riders(value, start_index, size):
+    """(riders, error) for a payload's "riders" value.
+
+    riders is None without the field, else a list of {"id", "start_index"};
+    a rider count gives every rider the problem's start_index.
+    """
+    if value is None:
+        return None, None
+    if isinstance(value, int) and not isinstance(value, bool) and 1 <= value <= MAX_RIDERS:
+        specs = [{}] * value
+    elif (
+        isinstance(value, list)
+        and 1 <= len(value) <= MAX_RIDERS
+        and all(isinstance(spec, dict) for spec in value)
+    ):
+        specs = value
+    else:
+        return None, f"expected a rider count or a list of 1-{MAX_RIDERS} rider objects"
+    riders = []
+    for number, spec in enumerate(specs, start=1):
+        rider_start = spec.get("start_index", start_index)
+        if (
+            isinstance(rider_start, bool)
+            or not isinstance(rider_start, int)
+            or not 0 <= rider_start < size
+        ):
+            return None, f"rider {number}: start_index out of range"
+        rider_id = spec.get("id")
+        riders.append({
+            "id": str(rider_id) if rider_id not in (None, "") else str(number),
+            "start_index": rider_start,
+        })
+    return riders, None
+
+
+def prepare_problem(payload, trace_id):
+    """Validate and normalize an /optimize payload.
+
+    Returns (problem, None) on success or (None, (error_body, status_code)).
+    problem is a dict with locations, warnings, start_index, preferences,
+    request_count (number of raw locations received), decompose, sparse,
+    the optional warm-start inputs initial_route and route_id, the
+    caller's distance_matrix (int32 array over locations, or None), merge
+    (see _merge_stops; None when no stops were merged) and riders (see
+    _parse_riders; None for a single-route solve).
+    """
+    # Hard input-size limit (defence in depth; proxy enforces 80). Decomposed
+    # and sparse solves never build a full matrix and have their own, larger
+    # limits.
+    locations_raw = payload.get("locations") or []
+    decompose = wants_decomposition(payload.get("preferences"))
+    sparse = not decompose and wants_sparse(payload.get("preferences"))
+    max_locations = MAX_LOCATIONS
+    if decompose:
+        max_locations = DECOMPOSE_MAX_LOCATIONS
+    elif sparse:
+        max_locations = SPARSE_MAX_LOCATIONS
+    if len(locations_raw) > max_locations:
+        logger.info({
+            "trace_id": trace_id,
+            "event": "bad_request",
+            "reason": f"too_many_locations:{len(locations_raw)}",
+        })
+        return None, ({
+            "error": "too_many_locations",
+            "max": max_locations,
+            "received": len(locations_raw),
+        }, 400)
+
+    rules_t0 = time.monotonic()
+    rule_stats = {}
+    with phase("rules"):
+        locations, warnings = enforce_rules(payload, stats=rule_stats)
+    RULES_DURATION.labels(size=size_bucket(len(locations_raw))).observe(time.monotonic() - rules_t0)
+    start_index = int(payload.get("start_index", 0))
+    preferences = payload.get("preferences") or {}
+
+    # Binary-format matrices are indexed like locations_raw: keep the rows
+    # and columns of the stops that survived the rules.
+    kept = rule_stats["kept_indices"]
+    edge_penalties = preferences.get("edge_penalties")
+    if isinstance(edge_penalties, np.ndarray):
+        factors = select_stops(edge_penalties, kept, len(locations_raw))
+        if factors is None:
+            warnings.append("edge_penalties invalid: shape mismatch")
+        elif len(kept) < len(locations):
+            # Neutral factors for the inserted rest stop.
+            factors = np.pad(factors, (0, len(locations) - len(kept)), constant_values=1.0)
+        preferences = {**preferences, "edge_penalties": factors}
+    distance_matrix = payload.get("distance_matrix")
+    if distance_matrix is not None:
+        distance_matrix = select_stops(
+            distance_matrix_array(distance_matrix), kept, len(locations_raw)
+        )
+        if distance_matrix is None:
+            warnings.append("distance_matrix invalid: expected N*N non-negative metres for locations")
+        elif len(kept) < len(locations):
+            warnings.append("distance_matrix ignored: rest stop inserted")
+            distance_matrix = None
+
+    if not locations:
+        logger.info({"trace_id": trace_id, "event": "bad_request", "reason": "no locations"})
+        return None, ({"error": "no locations provided"}, 400)
+
+    if start_index < 0 or start_index >= len(locations):
+        warnings.append("start_index_clamped")
+        start_index = 0
+
+    riders, riders_error = _parse_riders(payload.get("riders"), start_index, len(locations))
+    if riders_error is None and riders and (decompose or sparse):
+        riders_error = f"not supported with {'decompose' if decompose else 'sparse'}"
+    if riders_error is not None:
+        logger.info({"trace_id": trace_id, "event": "bad_request", "reason": "invalid_riders"})
+        return None, ({"error": "invalid_riders", "detail": riders_error}, 400)
+
+    merge = None
+    merge_radius, merge_warning = resolve_merge_radius(preferences)
+    if merge_warning:
+        warnings.append(merge_warning)
+    if merge_radius > 0:
+        with phase("rules"):
+            locations, start_index, preferences, distance_matrix, merge = _merge_stops(
+                locations, start_index, preferences, distance_matrix,
+                real_count=len(kept), radius=merge_radius, warnings=warnings,
+                fixed=[rider["start_index"] for rider in riders or ()],
+            )
+        if merge and riders:
+            # Rider starts lead their groups; index them among the leaders.
+            position = {group[0]: k for k, group in enumerate(merge["groups"])}
+            riders = [{**rider, "start_index": position[rider["start_index"]]} for rider in riders]
+
+    initial_route = payload.get("initial_route")
+    if initial_route is not None and not isinstance(initial_route, list):
+        warnings.append("initial_route invalid: expected list of stop ids")
+    route_id = payload.get("route_id")
+
+    return {
+        "locations": locations,
+        "warnings": warnings,
+        "start_index": start_index,
+        "preferences": preferences,
+        "request_count": len(locations_raw),
+        "use_cache": payload.get("cache", True) is not False,
+        "decompose": decompose,
+        "sparse": sparse,
+        "initial_route": initial_route if isinstance(initial_route, list) else None,
+        "route_id": str(route_id) if route_id not in (None, "") else None,
+        "distance_matrix": distance_matrix,
+        "merge": merge,
+        "riders": riders,
+    }, None
+
+
+def _merge_stops(
+    locations, start_index, preferences, distance_matrix, real_count, radius, warnings, fixed=()
+):
+    """Replace stops within radius of each other by one representative.
+
+    Only the first real_count stops (not an inserted rest stop) are merged;
+    the start and the stops in fixed always stay representatives.
+    Returns the reduced (locations, start_index, preferences,
+    distance_matrix, merge); merge keeps the full stop list, the original
+    start_index and the groups (indices into that list, leader first) that
+    solve_problem needs to expand the route again.
+    """
+    keep_index = start_index if start_index < real_count else 0
+    groups = merge_nearby_stops(
+        locations[:real_count], radius, keep_index=keep_index,
+        fixed=[i for i in fixed if i < real_count],
+    )
+    groups += [[i] for i in range(real_count, len(locations))]
+    if len(groups) == len(locations):
+        return locations, start_index, preferences, distance_matrix, None
+
+    leaders = [group[0] for group in groups]
+    for group in groups:
+        if len(group) > 1:
+            warnings.append(
+                f"stops merged into {locations[group[0]].get('id')}: "
+                + ", ".join(str(locations[i].get("id")) for i in group[1:])
+            )
+    edge_penalties = preferences.get("edge_penalties")
+    if isinstance(edge_penalties, np.ndarray):
+        index = np.asarray(leaders, dtype=np.intp)
+        preferences = {**preferences, "edge_penalties": edge_penalties[np.ix_(index, index)]}
+    elif edge_penalties is not None:
+        valid = isinstance(edge_penalties, list) and len(edge_penalties) == len(locations) and all(
+            isinstance(row, list) and len(row) == len(locations) for row in edge_penalties
+        )
+        # Invalid penalties were already reported; do not let them match the
+        # reduced size by accident.
+        preferences = {
+            **preferences,
+            "edge_penalties": [[edge_penalties[a][b] for b in leaders] for a in leaders] if valid else None,
+        }
+    if distance_matrix is not None:
+        index = np.asarray(leaders, dtype=np.intp)
+        distance_matrix = distance_matrix[np.ix_(index, index)]
+
+    merge = {
+        "locations": locations,
+        "start_index": start_index,
+        "groups": groups,
+        "radius_meters": radius,
+    }
+    # keep_index leads its group, so the start stays a representative.
+    return [locations[i] for i in leaders], leaders.index(start_index), preferences, distance_matrix, merge
+
+
+def solve_problem(
+    problem,
+    trace_id,
+    started_at=None,
+    cache=None,
+    should_stop=None,
+    on_solution=None,
+):
+    """Solve a prepared problem and return the /optimize response body.
+
+    When a ResultCache is supplied, solved responses are stored under the
+    problem fingerprint and identical problems are answered from it
+    (response field "cached": true); stored responses carry the fingerprint
+    as "cache_key" (null otherwise). should_stop and on_solution are
+    forwarded to the solver; routes from a search ended by should_stop are
+    never cached. When stops were merged, the solver sees one stop per group
+    (so do on_solution callbacks) and the returned route is expanded back to
+    every stop. With riders the body has "routes" (one entry per rider with
+    its route, distance and score) instead of "route", and on_solution is
+    not called.
+    """
+    if started_at is None:
+        started_at = time.monotonic()
+    locations = problem["locations"]
+    warnings = list(problem["warnings"])
+    start_index = problem["start_index"]
+    preferences = problem["preferences"]
+
+    # Routes larger than one cluster are solved by spatial decomposition and
+    # sparse routes over a kNN candidate graph; neither builds the full N*N
+    # matrix. Routes small enough for the exact fast path stay dense.
+    decomposed = problem["decompose"] and len(locations) > resolve_cluster_size(preferences)
+    sparse = problem["sparse"] and len(locations) > HELD_KARP_MAX_STOPS
+    mode = "decompose" if decomposed else "sparse" if sparse else None
+
+    # Only the dense matrix comes from a distance provider (or the caller's
+    # distance_matrix); the large-route modes always use great-circle
+    # distances.
+    provider = None
+    caller_matrix = problem.get("distance_matrix")
+    if mode is None and caller_matrix is not None:
+        provider = CallerMatrixProvider(caller_matrix)
+        if preferences.get("distance_provider") is not None:
+            warnings.append("distance_provider ignored: distance_matrix supplied")
+    elif mode is None:
+        provider, provider_warning = resolve_distance_provider(preferences)
+        if provider_warning:
+            warnings.append(provider_warning)
+    else:
+        if preferences.get("distance_provider") not in (None, "great_circle"):
+            warnings.append(f"distance_provider ignored: not supported with {mode}")
+        if caller_matrix is not None:
+            warnings.append(f"distance_matrix ignored: not supported with {mode}")
+
+    merge = problem.get("merge")
+    all_locations = merge["locations"] if merge else locations
+    riders = problem.get("riders")
+
+    cache_key = None
+    if cache is not None and problem["use_cache"]:
+        cache_key = problem_fingerprint(
+            all_locations,
+            merge["start_index"] if merge else start_index,
+            preferences,
+            distance_provider=provider.cache_key if provider is not None else None,
+            merge_radius_meters=merge["radius_meters"] if merge else None,
+            riders=riders,
+        )
+        with phase("cache"):
+            cached = cache.get(cache_key)
+        if cached is not None:
+            cached["trace_id"] = trace_id
+            cached["cached"] = True
+            logger.info({
+                "trace_id": trace_id,
+                "event": "optimize",
+                "cached": True,
+                "solver_status": cached.get("solver_status"),
+                "total_time_s": round(time.monotonic() - started_at, 3),
+                "request_count": problem["request_count"],
+                "final_count": len(all_locations),
+            })
+            if problem["route_id"] and cached.get("solver_status") == "solved" and "route" in cached:
+                remember_route(problem["route_id"], cached["route"])
+            return cached
+
+    size_label = size_bucket(len(locations))
+    matrix = None
+    metres = None
+    graph = None
+    provider_stats = {}
+    matrix_t0 = time.monotonic()
+    if mode is not None:
+        if preferences.get("edge_penalties") is not None:
+            warnings.append(f"edge_penalties ignored: not supported with {mode}")
+        # Both modes price great-circle legs; the apply_preferences_to_matrix
+        # multipliers need the full matrix, so they do not steer the search.
+        multipliers = [
+            key for key in ("avoid_traffic", "weather_consideration") if preferences.get(key)
+        ]
+        if preferences.get("time_of_day") in ("peak", "evening", "midday"):
+            multipliers.append("time_of_day")
+        if preferences.get("priority") in ("duration", "efficiency", "coverage"):
+            multipliers.append("priority")
+        if multipliers:
+            warnings.append(
+                f"distance multipliers ignored: not supported with {mode} ({', '.join(multipliers)})"
+            )
+        if sparse:
+            with phase("matrix"):
+                graph = build_candidate_graph(locations, preferences)
+            MATRIX_DURATION.labels(size=size_label, provider="candidate_graph").observe(
+                time.monotonic() - matrix_t0
+            )
+    else:
+        # The solver searches the preference-scaled matrix; reported
+        # distances are summed over the real metres.
+        metres = raw_distance_matrix(
+            locations, preferences=preferences, provider=provider, stats=provider_stats
+        )
+        with phase("preferences"):
+            matrix = apply_preferences_to_matrix(metres, preferences)
+        MATRIX_DURATION.labels(
+            size=size_label, provider=provider.name if provider is not None else "great_circle"
+        ).observe(time.monotonic() - matrix_t0)
+
+    # Warm start: caller hint first, else the last route solved for route_id.
+    initial_route = None
+    warm_start = None
+    hint, hint_source = problem["initial_route"], "initial_route"
+    if hint is None and problem["route_id"] and mode is None and not riders:
+        with phase("warm_start"):
+            hint, hint_source = lookup_route(problem["route_id"]), "route_id"
+    if hint and riders:
+        warnings.append("warm_start_ignored: not supported with riders")
+    elif hint and mode is not None:
+        warnings.append(f"warm_start_ignored: not supported with {mode}")
+    elif hint:
+        with phase("warm_start"):
+            initial_route, stats = map_route_hint(hint, locations, start_index, matrix)
+        if initial_route is not None:
+            warm_start = {"source": hint_source, **stats}
+        else:
+            warnings.append("warm_start_ignored: too few known stops")
+
+    # Portfolio: race several search configurations on the dense matrix.
+    portfolio, portfolio_warning = resolve_portfolio(preferences)
+    if portfolio_warning:
+        warnings.append(portfolio_warning)
+    if portfolio and (mode is not None or riders):
+        if preferences.get("solver_portfolio") is not None:
+            warnings.append(f"solver_portfolio ignored: not supported with {mode or 'riders'}")
+        portfolio = None
+
+    # Track caller-requested early stops: such routes are not cached.
+    stopped_early = []
+    solver_should_stop = None
+    if should_stop is not None:
+        def solver_should_stop():
+            if should_stop():
+                stopped_early.append(True)
+                return True
+            return False
+
+    # --- Solver -------------------------------------------------------------
+    solver_t0 = time.monotonic()
+    solver_stats = {}
+    SOLVES_IN_FLIGHT.inc()
+    try:
+        with phase("solver"):
+            if decomposed:
+                route_indices, solver_status = solve_decomposed(
+                    locations,
+                    start_index=start_index,
+                    preferences=preferences,
+                    should_stop=solver_should_stop,
+                    on_solution=on_solution,
+                    stats=solver_stats,
+                )
+            elif sparse:
+                route_indices, solver_status = solve_candidate_graph(
+                    graph,
+                    start_index=start_index,
+                    preferences=preferences,
+                    should_stop=solver_should_stop,
+                    on_solution=on_solution,
+                    stats=solver_stats,
+                )
+            elif riders:
+                rider_routes, solver_status = solve_fleet_distance_matrix(
+                    matrix,
+                    [rider["start_index"] for rider in riders],
+                    preferences=preferences,
+                    should_stop=solver_should_stop,
+                    stats=solver_stats,
+                )
+            else:
+                route_indices, solver_status = solve_route(
+                    matrix,
+                    start_index=start_index,
+                    preferences=preferences,
+                    should_stop=solver_should_stop,
+                    on_solution=on_solution,
+                    initial_route=initial_route,
+                    stats=solver_stats,
+                    portfolio=portfolio,
+                )
+    finally:
+        SOLVES_IN_FLIGHT.dec()
+    solver_elapsed_s = time.monotonic() - solver_t0
+    engine = solver_stats.get("engine") or "unknown"
+    SOLVER_DURATION.labels(
+        size=size_label,
+        priority=priority_label(preferences.get("priority")),
+        solver_status=solver_status,
+        engine=engine,
+    ).observe(solver_elapsed_s)
+    if solver_stats.get("improvements"):
+        SOLVER_IMPROVEMENTS.labels(size=size_label, engine=engine).inc(solver_stats["improvements"])
+    if solver_stats.get("gap") is not None:
+        SOLVER_GAP.labels(size=size_label, engine=engine).observe(solver_stats["gap"])
+    # ------------------------------------------------------------------------
+
+    if solver_status != "solved":
+        if decomposed:
+            warnings.append("solver_fallback: some clusters are unoptimized (input order)")
+        elif riders:
+            warnings.append("solver_fallback: stops split across riders in input order")
+        else:
+            warnings.append("solver_fallback: route is unoptimized (returned in input order)")
+
+    # Route distance in real metres, per rider route when there are several:
+    # unscaled matrix legs (dense), candidate-graph legs (sparse) or
+    # great-circle legs (decomposed). Preference multipliers and edge
+    # penalties only steer the search.
+    paths = rider_routes if riders else [route_indices]
+    if decomposed:
+        path_meters = [solver_stats["distance_meters"]]
+    elif sparse:
+        path_meters = [graph.route_distance(route_indices)]
+    else:
+        path_meters = [int(metres[path[:-1], path[1:]].sum()) if len(path) > 1 else 0 for path in paths]
+
+    if merge:
+        # Walk each merged group in place; the walks are great-circle.
+        groups = merge["groups"]
+        expanded = set()
+        ordered_paths = []
+        for k, path in enumerate(paths):
+            path_meters[k] += sum(
+                group_walk_meters(all_locations, groups[g]) for g in set(path) - expanded
+            )
+            ordered_paths.append(
+                [all_locations[i] for i in expand_merged_route(path, groups, seen=expanded)]
+            )
+    else:
+        ordered_paths = [[locations[i] for i in path] for path in paths]
+    distance_meters = sum(path_meters)
+    distance_km = round(distance_meters / 1000.0, 3)
+    if solver_status == "solved":
+        ROUTE_DISTANCE.labels(
+            size=size_label, priority=priority_label(preferences.get("priority"))
+        ).observe(distance_meters)
+
+    with phase("score"):
+        if not riders:
+            score = score_route(ordered_paths[0], distance_meters=distance_meters)
+        else:
+            # Fleet totals over every rider's stops (closing returns excluded).
+            score = score_route(
+                [loc for path in ordered_paths for loc in path[:-1]],
+                distance_meters=distance_meters,
+            )
+            rider_results = [
+                {
+                    "rider": rider["id"],
+                    "route": path,
+                    "stops": max(0, len(path) - 1),
+                    "distance_meters": meters,
+                    "distance_km": round(meters / 1000.0, 3),
+                    "score": score_route(path, distance_meters=meters),
+                }
+                for rider, path, meters in zip(riders, ordered_paths, path_meters)
+            ]
+
+    # Duration feasibility check using real units; the cap is per rider.
+    max_duration = preferences.get("max_duration_minutes")
+    if isinstance(max_duration, (int, float)) and max_duration > 0:
+        # 15 km/h average = 250 m/min
+        max_distance_for_duration = max_duration * 250.0
+        if max(path_meters) > max_distance_for_duration:
+            warnings.append("max_duration_exceeded")
+
+    total_elapsed_s = time.monotonic() - started_at
+
+    metrics = {
+        "locations_count": len(all_locations),
+        "distance_meters": distance_meters,
+        "distance_km": distance_km,
+    }
+    if provider is not None:
+        metrics["distance_provider"] = {"name": provider.name, **provider_stats}
+    if riders:
+        metrics["riders"] = {
+            "count": len(riders),
+            "longest_route_meters": max(path_meters),
+            "shortest_route_meters": min(path_meters),
+        }
+    if merge:
+        metrics["merge"] = {
+            "radius_meters": merge["radius_meters"],
+            "groups": sum(1 for group in merge["groups"] if len(group) > 1),
+            "merged_stops": len(all_locations) - len(locations),
+            "solver_stops": len(locations),
+        }
+    if solver_stats.get("portfolio"):
+        metrics["portfolio"] = solver_stats["portfolio"]
+    if decomposed:
+        metrics["decomposition"] = solver_stats["decomposition"]
+    if sparse:
+        metrics["candidate_graph"] = {
+            "neighbors": graph.k,
+            "arcs": graph.arc_count,
+            "lazy_arcs": graph.lazy_arcs,
+            "dense_arcs": graph.size * graph.size,
+            "memory_bytes": graph.memory_bytes(),
+        }
+
+    # Only real solutions are worth replaying; fallbacks should be retried.
+    store = cache_key is not None and solver_status == "solved" and not stopped_early
+    if riders:
+        response = {"routes": rider_results}
+    else:
+        response = {"route": ordered_paths[0]}
+    response.update({
+        "metrics": metrics,
+        "score": score,
+        "solver_status": solver_status,
+        "solver_time_seconds": round(solver_elapsed_s, 3),
+        "solver_time_limit_applied": True,
+        "solver_engine": solver_stats.get("engine"),
+        "solver_time_limit_seconds": solver_stats.get("time_limit_seconds"),
+        "solver_stop_reason": solver_stats.get("stop_reason"),
+        "solver_gap": solver_stats.get("gap"),
+        "warm_start": warm_start,
+        "warnings": warnings,
+        "solver_version": SOLVER_VERSION,
+        "cached": False,
+        "cache_key": cache_key if store else None,
+        "trace_id": trace_id,
+    })
+
+    if store:
+        with phase("cache"):
+            cache.put(cache_key, response)
+    if problem["route_id"] and solver_status == "solved" and not riders:
+        remember_route(problem["route_id"], ordered_paths[0])
+
+    logger.info({
+        "trace_id": trace_id,
+        "event": "optimize",
+        "solver_status": solver_status,
+        "solver_time_s": round(solver_elapsed_s, 3),
+        "solver_engine": solver_stats.get("engine"),
+        "solver_time_limit_s": solver_stats.get("time_limit_seconds"),
+        "solver_stop_reason": solver_stats.get("stop_reason"),
+        "solver_gap": solver_stats.get("gap"),
+        "lower_bound": solver_stats.get("lower_bound"),
+        "total_time_s": round(total_elapsed_s, 3),
+        "request_count": problem["request_count"],
+        "final_count": len(all_locations),
+        "distance_meters": distance_meters,
+        "merge": metrics.get("merge"),
+        "riders": metrics.get("riders"),
+        "warm_start": warm_start,
+        "decomposition": solver_stats.get("decomposition"),
+        "portfolio": solver_stats.get("portfolio"),
+        "distance_provider": metrics.get("distance_provider"),
+        "warnings": warnings,
+    })
+
+    return response
+
+
+def run_optimize(
+    payload, trace_id, started_at=None, cache=None, should_stop=None, timings=False
+):
+    """Run the optimize pipeline and return (response_body, status_code).
+
+    started_at is the caller's time.monotonic() at request start and is only
+    used for the total_time_s log field. See solve_problem for cache and
+    should_stop. With timings=True the body gets a "timings" dict of phase
+    durations in milliseconds (see timing.py).
+    """
+    if not timings:
+        return _run_optimize(payload, trace_id, started_at, cache, should_stop)
+    with request_timer() as timer:
+        body, status = _run_optimize(payload, trace_id, started_at, cache, should_stop)
+    body["timings"] = timer.milliseconds()
+    return body, status
+
+
+def _run_optimize(payload, trace_id, started_at, cache, should_stop):
+    if started_at is None:
+        started_at = time.monotonic()
+    problem, error = prepare_problem(payload, trace_id)
+    if error is not None:
+        return error
+    response = solve_problem(
+        problem, trace_id, started_at=started_at, cache=cache, should_stop=should_stop
+    )
+    return response, 200
+
+
+__all__ = ["run_optimize", "prepare_problem", "solve_problem", "SOLVER_VERSION"]
@@ -0,0 +1,338 @@
+"""Portfolio solving: several OR-Tools search configurations raced on one matrix.
+
+A single search commits to one first-solution strategy and one metaheuristic
+(see solver.default_search_config), and which combination finds the best
+route within the budget varies from problem to problem. A portfolio solve
+runs one search per configuration in solver.SEARCH_CONFIGS on the same
+distance matrix, all at once and within the same budget:
+
+  - runners are processes in the batch process pool (batch.get_process_pool),
+    one search per core. OR-Tools holds the GIL while it searches, so
+    threads would take turns on a single core. Pool processes (the solver
+    pool, batch items) cannot own a pool, so there the portfolio is ignored;
+    app.py solves portfolio requests in the gunicorn worker instead;
+  - the 1-tree lower bound is computed once and shared. All runners stop
+    once one of them is within the target gap of it, or when the caller's
+    should_stop fires. The signal is a stop file that every runner polls at
+    each accepted solution. Otherwise each runner stops at its plateau or at
+    the shared deadline; a runner that waited for a free process only gets
+    what is left;
+  - the route with the lowest objective wins (ties go to the configuration
+    listed first).
+
+stats["portfolio"] names the winning configuration and each runner's
+outcome; route_opt_portfolio_runs_total and route_opt_portfolio_wins_total
+count runs and wins per configuration, for tuning the single-search default.
+"""
+import multiprocessing
+import os
+import tempfile
+import time
+import logging
+import uuid
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from bounds import one_tree_lower_bound
+from metrics import PORTFOLIO_RUNS, PORTFOLIO_WINS, size_bucket
+from solver import (
+    LOWER_BOUND_BUDGET_FRACTION,
+    SEARCH_CONFIGS,
+    default_search_config,
+    resolve_search_budget,
+    solve_tsp_distance_matrix,
+)
+
+logger = logging.getLogger("route_optimizer")
+
+# Configurations raced by "solver_portfolio": true, after the priority's
+# default; ordered so that small portfolios still mix metaheuristics and
+# first solutions.
+PORTFOLIO_ORDER = (
+    "gls_path_cheapest_arc",
+    "tabu_christofides",
+    "sa_savings",
+    "gls_parallel_insertion",
+    "tabu_path_cheapest_arc",
+    "sa_global_cheapest_arc",
+)
+
+# Runners per portfolio solve: one per core by default, up to four. Runners
+# share the batch process pool (ROUTE_BATCH_WORKERS) with batch items and
+# decomposed solves.
+DEFAULT_PORTFOLIO_RUNNERS = min(4, os.cpu_count() or 1)
+PORTFOLIO_RUNNERS = min(
+    len(SEARCH_CONFIGS),
+    max(1, int(os.environ.get("ROUTE_PORTFOLIO_RUNNERS", DEFAULT_PORTFOLIO_RUNNERS))),
+)
+
+# Least time the single search gets when no runner could start before the
+# deadline (e.g. while the pool is spawning); OR-Tools needs a moment to find
+# any route.
+_MIN_FALLBACK_SECONDS = 0.1
+
+
+def portfolio_enabled():
+    """Whether requests without preferences["solver_portfolio"] race a portfolio."""
+    return str(os.environ.get("ROUTE_SOLVER_PORTFOLIO", "false")).lower() in ("1", "true", "yes")
+
+
+def _in_pool_worker():
+    # Runners are processes; pool processes never start a pool of their own.
+    return multiprocessing.parent_process() is not None
+
+
+def resolve_portfolio(preferences):
+    """Return (configs, warning) for preferences["solver_portfolio"].
+
+    configs lists the SEARCH_CONFIGS names to race, or is None for a single
+    search. true races PORTFOLIO_RUNNERS configurations, starting with the
+    priority's default; a list names them explicitly (unknown names are
+    dropped with a warning). Without the preference ROUTE_SOLVER_PORTFOLIO
+    decides. Inside pool processes configs is always None.
+    """
+    preferences = preferences or {}
+    value = preferences.get("solver_portfolio")
+    explicit = value is not None
+    if not explicit:
+        value = portfolio_enabled()
+    if value is False:
+        return None, None
+    if _in_pool_worker():
+        warning = "solver_portfolio ignored: not available in pool processes"
+        return None, warning if explicit else None
+    if value is True:
+        if PORTFOLIO_RUNNERS < 2:
+            warning = "solver_portfolio ignored: fewer than 2 runners (ROUTE_PORTFOLIO_RUNNERS)"
+            return None, warning if explicit else None
+        first = default_search_config(preferences.get("priority") or "")
+        configs = [first] + [name for name in PORTFOLIO_ORDER if name != first]
+        return configs[:PORTFOLIO_RUNNERS], None
+    if isinstance(value, list):
+        configs, unknown = [], []
+        for name in value:
+            if name in SEARCH_CONFIGS:
+                if name not in configs:
+                    configs.append(name)
+            else:
+                unknown.append(str(name))
+        warning = None
+        if unknown:
+            warning = f"solver_portfolio: unknown configurations ignored: {', '.join(unknown)}"
+        return configs or None, warning
+    return None, "solver_portfolio ignored: expected true, false or a list of configurations"
+
+
+def _run_config(distance_matrix, start_index, preferences, config, lower_bound,
+                target_gap, deadline, stop_path):
+    """One portfolio runner, in a pool process; returns (route, status, stats).
+
+    deadline is wall-clock time (time.time()), shared by every runner.
+    Reaching the target gap creates stop_path so the other runners end too.
+    """
+    remaining = deadline - time.time()
+    if remaining <= 0 or os.path.exists(stop_path):
+        return None, "skipped", {}
+
+    def should_stop():
+        return os.path.exists(stop_path)
+
+    def on_solution(route, objective):
+        if lower_bound and objective - lower_bound <= target_gap * objective:
+            _touch(stop_path)
+
+    stats = {}
+    route, status = solve_tsp_distance_matrix(
+        distance_matrix,
+        start_index=start_index,
+        preferences={**preferences, "solver_time_limit_seconds": remaining},
+        should_stop=should_stop,
+        on_solution=on_solution,
+        stats=stats,
+        search_config=config,
+        lower_bound=lower_bound,
+    )
+    return route, status, stats
+
+
+def _touch(path):
+    try:
+        with open(path, "a"):
+            pass
+    except OSError:
+        pass
+
+
+def _race(distance_matrix, configs, start_index, preferences, lower_bound, target_gap,
+          deadline, stop_path, should_stop, on_solution):
+    """Run every configuration in the batch process pool; returns the
+    per-config results, or None when the pool broke."""
+    from batch import get_process_pool, reset_process_pool
+
+    results = [None] * len(configs)
+    best = None
+    pool = get_process_pool()
+    try:
+        futures = {
+            pool.submit(
+                _run_config, distance_matrix, start_index, preferences, config,
+                lower_bound, target_gap, deadline, stop_path,
+            ): i
+            for i, config in enumerate(configs)
+        }
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = futures[future]
+                results[i] = future.result()
+                route, status, runner_stats = results[i]
+                objective = runner_stats.get("objective")
+                if status != "solved" or objective is None:
+                    continue
+                if best is None or objective < best:
+                    best = objective
+                    if on_solution is not None:
+                        on_solution(route, objective)
+            if pending and should_stop is not None and should_stop():
+                _touch(stop_path)
+    except BrokenProcessPool:
+        reset_process_pool(pool)
+        logger.warning({"event": "portfolio_pool_broken", "fallback": "single_search"})
+        return None
+    return results
+
+
+def solve_portfolio(
+    distance_matrix,
+    configs,
+    start_index=0,
+    preferences=None,
+    should_stop=None,
+    on_solution=None,
+    stats=None,
+):
+    """Race the search configurations in configs; returns (route_indices, solver_status).
+
+    Arguments, statuses and stats keys follow solver.solve_tsp_distance_matrix
+    (stats["engine"] is "portfolio"), plus stats["portfolio"]: the winning
+    configuration and, per runner, its status ("skipped" when the deadline
+    passed before it started), objective, stop reason and improvement count.
+    Runners are separate processes, so on_solution sees each runner's final
+    route as it finishes, when it beats every route before it. If the
+    process pool breaks or no runner got to start, a single search with
+    configs[0] runs here instead.
+    """
+    size = len(distance_matrix)
+    preferences = preferences or {}
+    if stats is None:
+        stats = {}
+
+    budget = resolve_search_budget(size, preferences)
+    started_at = time.monotonic()
+    deadline = time.time() + budget["time_limit_seconds"]
+    lower_bound = None
+    if budget["target_gap"] is not None and size > 1:
+        lower_bound = one_tree_lower_bound(
+            distance_matrix,
+            root=start_index,
+            time_budget_seconds=LOWER_BOUND_BUDGET_FRACTION * budget["time_limit_seconds"],
+        )
+    # Each runner gets what is left of the one budget when it starts; the
+    # plateau window stays the one derived from the full budget.
+    runner_preferences = dict(preferences)
+    if budget["plateau_seconds"] is not None:
+        runner_preferences["solver_plateau_seconds"] = budget["plateau_seconds"]
+    target_gap = budget["target_gap"]
+
+    stop_path = os.path.join(
+        tempfile.gettempdir(), f"route-portfolio-{os.getpid()}-{uuid.uuid4().hex}.stop"
+    )
+    try:
+        results = _race(
+            distance_matrix, configs, start_index, runner_preferences, lower_bound,
+            target_gap, deadline, stop_path, should_stop, on_solution,
+        )
+        stopped = os.path.exists(stop_path)
+    finally:
+        try:
+            os.remove(stop_path)
+        except OSError:
+            pass
+    if results is None or all(result[1] == "skipped" for result in results):
+        # The pool broke, or was still starting when the deadline passed.
+        runner_preferences["solver_time_limit_seconds"] = max(
+            _MIN_FALLBACK_SECONDS, deadline - time.time()
+        )
+        return solve_tsp_distance_matrix(
+            distance_matrix,
+            start_index=start_index,
+            preferences=runner_preferences,
+            should_stop=should_stop,
+            on_solution=on_solution,
+            stats=stats,
+            search_config=configs[0],
+            lower_bound=lower_bound,
+        )
+    elapsed = time.monotonic() - started_at
+
+    solved = [i for i, (_, status, _) in enumerate(results) if status == "solved"]
+    if solved:
+        winner = min(solved, key=lambda i: (results[i][2]["objective"], i))
+    else:
+        winner = next(i for i, result in enumerate(results) if result[1] != "skipped")
+    route, status, winner_stats = results[winner]
+
+    size_label = size_bucket(size)
+    for config, (_, runner_status, _) in zip(configs, results):
+        if runner_status != "skipped":
+            PORTFOLIO_RUNS.labels(size=size_label, config=config).inc()
+    if solved:
+        PORTFOLIO_WINS.labels(size=size_label, config=configs[winner]).inc()
+
+    stop_reason = winner_stats.get("stop_reason")
+    if stopped:
+        gap_reached = any(r[2].get("stop_reason") == "gap" for r in results)
+        stop_reason = "gap" if gap_reached else "stopped"
+    stats.update(winner_stats)
+    stats.update({
+        "engine": "portfolio",
+        "time_limit_seconds": round(budget["time_limit_seconds"], 3),
+        "stop_reason": stop_reason,
+        "lower_bound": lower_bound,
+        "improvements": sum(r[2].get("improvements", 0) for r in results),
+        "portfolio": {
+            "winner": configs[winner] if solved else None,
+            "runners": [
+                {
+                    "config": config,
+                    "status": runner_status,
+                    "objective": runner_stats.get("objective"),
+                    "stop_reason": runner_stats.get("stop_reason"),
+                    "improvements": runner_stats.get("improvements", 0),
+                }
+                for config, (_, runner_status, runner_stats) in zip(configs, results)
+            ],
+        },
+    })
+    logger.info({
+        "event": "portfolio_outcome",
+        "status": status,
+        "elapsed_s": round(elapsed, 3),
+        "size": size,
+        "runners": len(configs),
+        "winner": stats["portfolio"]["winner"],
+        "objective": stats.get("objective"),
+        "stop_reason": stop_reason,
+    })
+    return route, status
+
+
+__all__ = [
+    "solve_portfolio",
+    "resolve_portfolio",
+    "portfolio_enabled",
+    "PORTFOLIO_ORDER",
+    "PORTFOLIO_RUNNERS",
+    "DEFAULT_PORTFOLIO_RUNNERS",
+]
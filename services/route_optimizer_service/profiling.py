@@ -0,0 +1,251 @@
+"""On-demand profiling of /optimize requests.
+
+POST /debug/profile arms a capture of the next N /optimize requests; GET
+/debug/profile/download returns what was captured. The session lives in
+ROUTE_PROFILE_DIR (default <ROUTE_LOG_DIR>/profiles) so every gunicorn
+worker and solver process sees it: a state file holds the remaining count,
+decremented under a file lock, and each capture is written there as its own
+file. While nothing is armed a request only pays one os.stat.
+
+Modes:
+  cprofile -- deterministic cProfile of the pipeline; downloads are the
+              merged pstats file (snakeviz, pstats) or a text summary;
+  sample   -- a thread samples the solving thread's stack every interval_ms;
+              downloads are collapsed stacks ("a;b;c count" lines), the
+              input format of flamegraph.pl and speedscope. Much lower
+              overhead, so timings stay representative.
+
+Captures are taken where the pipeline runs, i.e. inside the solver pool
+process when the pool is enabled.
+"""
+import cProfile
+import fcntl
+import io
+import itertools
+import json
+import logging
+import marshal
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger("route_optimizer")
+
+PROFILE_MODES = ("cprofile", "sample")
+MAX_PROFILE_REQUESTS = 100
+DEFAULT_SAMPLE_INTERVAL_MS = 5
+_MAX_STACK_DEPTH = 128
+
+_STATE_FILE = "session.json"
+_LOCK_FILE = "session.lock"
+_captures = itertools.count()
+
+
+def profiling_enabled():
+    return str(os.environ.get("ROUTE_PROFILING_ENABLED", "true")).lower() in ("1", "true", "yes")
+
+
+def profile_dir():
+    return os.environ.get("ROUTE_PROFILE_DIR") or os.path.join(
+        os.environ.get("ROUTE_LOG_DIR", "."), "profiles"
+    )
+
+
+@contextmanager
+def _locked_state():
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, _LOCK_FILE), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield os.path.join(directory, _STATE_FILE)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_state(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_state(path, state):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(state, fh)
+    os.replace(tmp, path)
+
+
+def _capture_files(session):
+    try:
+        names = os.listdir(profile_dir())
+    except OSError:
+        return []
+    return sorted(
+        os.path.join(profile_dir(), name) for name in names if name.startswith(f"{session}-")
+    )
+
+
+def _remove_captures():
+    try:
+        names = os.listdir(profile_dir())
+    except OSError:
+        return
+    for name in names:
+        if name.endswith((".prof", ".stacks")):
+            try:
+                os.remove(os.path.join(profile_dir(), name))
+            except OSError:
+                pass
+
+
+def arm(mode, requests, interval_ms=DEFAULT_SAMPLE_INTERVAL_MS):
+    """Start a new session for the next `requests` requests; drops older captures."""
+    state = {
+        "session": uuid.uuid4().hex[:12],
+        "mode": mode,
+        "interval_ms": interval_ms,
+        "requested": requests,
+        "remaining": requests,
+        "armed_at": time.time(),
+    }
+    with _locked_state() as path:
+        _remove_captures()
+        _write_state(path, state)
+    return status()
+
+
+def disarm():
+    with _locked_state() as path:
+        _remove_captures()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def status():
+    """The current session with its capture count, or None."""
+    state = _read_state(os.path.join(profile_dir(), _STATE_FILE))
+    if state is None:
+        return None
+    return {**state, "captured": len(_capture_files(state["session"]))}
+
+
+def claim():
+    """Profile settings for this request if a session has requests left, else None."""
+    path = os.path.join(profile_dir(), _STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with _locked_state() as path:
+        state = _read_state(path)
+        if not state or state.get("remaining", 0) <= 0:
+            return None
+        state["remaining"] -= 1
+        _write_state(path, state)
+    return {"session": state["session"], "mode": state["mode"], "interval_ms": state["interval_ms"]}
+
+
+class _StackSampler(threading.Thread):
+    """Counts collapsed stacks of one thread at a fixed interval."""
+
+    def __init__(self, thread_id, interval_seconds):
+        super().__init__(name="route-optimizer-profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval_seconds = interval_seconds
+        self.stacks = Counter()
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval_seconds):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None and len(names) < _MAX_STACK_DEPTH:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+
+def _save(settings, suffix, data):
+    name = f"{settings['session']}-{os.getpid()}-{next(_captures)}{suffix}"
+    path = os.path.join(profile_dir(), name)
+    try:
+        with tempfile.NamedTemporaryFile(dir=profile_dir(), delete=False) as fh:
+            fh.write(data)
+        os.replace(fh.name, path)
+    except OSError:
+        logger.exception("failed to save profile capture")
+
+
+def profile_call(settings, fn, *args, **kwargs):
+    """Run fn(*args, **kwargs) under the profiler in settings and save the capture."""
+    if settings["mode"] == "sample":
+        sampler = _StackSampler(threading.get_ident(), settings["interval_ms"] / 1000.0)
+        sampler.start()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            sampler.done.set()
+            sampler.join()
+            _save(settings, ".stacks", json.dumps(sampler.stacks).encode("utf-8"))
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        profiler.create_stats()
+        # The pstats file format: marshal of the stats dict.
+        _save(settings, ".prof", marshal.dumps(profiler.stats))
+
+
+def report(fmt=None):
+    """Merged captures of the current session as (data, mimetype, filename).
+
+    fmt is "pstats" (default for cprofile) or "text" for cprofile sessions;
+    sample sessions always return collapsed stacks. None if nothing was
+    captured.
+    """
+    state = status()
+    if state is None:
+        return None
+    files = _capture_files(state["session"])
+    if not files:
+        return None
+    session = state["session"]
+    if state["mode"] == "sample":
+        stacks = Counter()
+        for path in files:
+            with open(path, "rb") as fh:
+                stacks.update(json.load(fh))
+        lines = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        return lines.encode("utf-8"), "text/plain", f"optimize-{session}.stacks.txt"
+
+    text = io.StringIO()
+    stats = pstats.Stats(*files, stream=text)
+    if fmt == "text":
+        stats.sort_stats("cumulative").print_stats(60)
+        return text.getvalue().encode("utf-8"), "text/plain", f"optimize-{session}.txt"
+    return marshal.dumps(stats.stats), "application/octet-stream", f"optimize-{session}.prof"
+
+
+__all__ = [
+    "PROFILE_MODES",
+    "MAX_PROFILE_REQUESTS",
+    "DEFAULT_SAMPLE_INTERVAL_MS",
+    "profiling_enabled",
+    "arm",
+    "disarm",
+    "status",
+    "claim",
+    "profile_call",
+    "report",
+]
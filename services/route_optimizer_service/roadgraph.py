@@ -0,0 +1,315 @@
+"""Road-network distances from a preprocessed, memory-mapped graph.
+
+A graph directory is produced offline by roadgraph_build.py from an OSM
+extract and holds a contraction hierarchy (CH) as plain .npy arrays:
+
+  meta.json                      format version, counts, grid geometry, source
+  lat.npy, lng.npy               node coordinates (degrees, float64)
+  up_indptr/indices/weights      CSR of edges u -> v with rank[v] > rank[u]
+                                 (original edges and shortcuts, metres)
+  down_indptr/indices/weights    CSR of edges x -> u stored at u, with
+                                 rank[x] > rank[u] (for backward searches)
+  cell_keys/cell_starts/cell_nodes
+                                 grid index over the nodes for snapping stops
+
+Every array is opened with np.load(mmap_mode="r"), so all gunicorn workers
+(and batch/decompose pool processes) on a host share the same pages from
+the OS page cache instead of each holding a copy. Because live processes
+map the files, a build never rewrites them: roadgraph_build.py writes each
+build to its own <out>.<graph_id> directory and repoints the <out> symlink,
+and open_road_graph picks up the new target on the next request.
+
+Many-to-many distances use bucket-based CH search: one upward backward
+search per target fills per-node buckets, then one upward forward search per
+source scans them. For S sources and T targets this is S + T small searches
+instead of S full Dijkstra runs.
+"""
+import heapq
+import json
+import logging
+import math
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger("route_optimizer")
+
+GRAPH_FORMAT_VERSION = 1
+
+EARTH_RADIUS_METERS = 6_371_000.0
+
+# Stops farther than this from any graph node are not snapped; their legs
+# fall back to great-circle distance times UNREACHABLE_DETOUR_FACTOR.
+DEFAULT_MAX_SNAP_METERS = 500.0
+# Typical detour of street distance over great-circle distance in cities.
+UNREACHABLE_DETOUR_FACTOR = 1.3
+
+_ARRAYS = (
+    "lat", "lng",
+    "up_indptr", "up_indices", "up_weights",
+    "down_indptr", "down_indices", "down_weights",
+    "cell_keys", "cell_starts", "cell_nodes",
+)
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+def _haversine(lat1, lng1, lat2, lng2):
+    """Great-circle metres; accepts scalars or broadcastable arrays (degrees)."""
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    a = np.sin((phi2 - phi1) * 0.5) ** 2
+    a += np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lng2 - lng1) * 0.5) ** 2
+    return (2.0 * EARTH_RADIUS_METERS) * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _upward_search(indptr, indices, weights, source):
+    """Dijkstra restricted to upward edges; returns {node: distance}."""
+    settled = {}
+    best = {source: 0}
+    heap = [(0, source)]
+    while heap:
+        dist, node = heapq.heappop(heap)
+        if node in settled:
+            continue
+        settled[node] = dist
+        a, b = int(indptr[node]), int(indptr[node + 1])
+        if a == b:
+            continue
+        for succ, weight in zip(indices[a:b].tolist(), weights[a:b].tolist()):
+            candidate = dist + weight
+            if candidate < best.get(succ, math.inf):
+                best[succ] = candidate
+                heapq.heappush(heap, (candidate, succ))
+    return settled
+
+
+class RoadGraph:
+    """Read-only view of one graph directory."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as fh:
+            self.meta = json.load(fh)
+        if self.meta.get("format_version") != GRAPH_FORMAT_VERSION:
+            raise ValueError(
+                f"unsupported road graph format {self.meta.get('format_version')!r} in {path}"
+            )
+        for name in _ARRAYS:
+            mapped = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            # Plain ndarray view of the same mapping: slicing a np.memmap
+            # allocates a memmap object per slice, which dominates searches.
+            setattr(self, name, np.asarray(mapped))
+        self.node_count = int(self.meta["nodes"])
+        grid = self.meta["grid"]
+        self._cell_deg = float(grid["cell_degrees"])
+        self._min_lat = float(grid["min_lat"])
+        self._min_lng = float(grid["min_lng"])
+        self._columns = int(grid["columns"])
+        self._rows = int(grid["rows"])
+        # Identifies the graph build in cache keys.
+        self.graph_id = str(self.meta.get("graph_id") or self.meta.get("built_at"))
+
+    def _cell_nodes(self, row, col):
+        if row < 0 or col < 0 or row >= self._rows or col >= self._columns:
+            return None
+        key = row * self._columns + col
+        at = int(np.searchsorted(self.cell_keys, key))
+        if at >= self.cell_keys.size or int(self.cell_keys[at]) != key:
+            return None
+        return self.cell_nodes[int(self.cell_starts[at]):int(self.cell_starts[at + 1])]
+
+    def snap(self, lat, lng, max_meters=DEFAULT_MAX_SNAP_METERS):
+        """Nearest graph node to (lat, lng) as (node, metres), or (None, None)."""
+        row = int((lat - self._min_lat) // self._cell_deg)
+        col = int((lng - self._min_lng) // self._cell_deg)
+        # Cells are narrower in longitude by cos(lat); using that width as
+        # the per-ring distance keeps the early exit conservative.
+        cell_meters = math.radians(self._cell_deg) * EARTH_RADIUS_METERS * math.cos(math.radians(lat))
+        best_node, best_dist = None, math.inf
+        ring = 0
+        while ring <= max(self._rows, self._columns):
+            # Every node in ring r is at least (r - 1) cells away.
+            if ring > 0 and (ring - 1) * cell_meters > min(best_dist, max_meters):
+                break
+            parts = []
+            for r in range(row - ring, row + ring + 1):
+                for c in range(col - ring, col + ring + 1):
+                    if ring and r not in (row - ring, row + ring) and c not in (col - ring, col + ring):
+                        continue
+                    nodes = self._cell_nodes(r, c)
+                    if nodes is not None and nodes.size:
+                        parts.append(nodes)
+            if parts:
+                nodes = np.concatenate(parts)
+                dist = _haversine(lat, lng, self.lat[nodes], self.lng[nodes])
+                k = int(np.argmin(dist))
+                if dist[k] < best_dist:
+                    best_node, best_dist = int(nodes[k]), float(dist[k])
+            ring += 1
+        if best_node is None or best_dist > max_meters:
+            return None, None
+        return best_node, best_dist
+
+    def many_to_many(self, sources, targets):
+        """Shortest-path metres between graph nodes (float64, inf if unreachable)."""
+        out = np.full((len(sources), len(targets)), np.inf)
+        if not sources or not targets:
+            return out
+
+        # Buckets: (node, target, distance) from every backward search,
+        # grouped by node so a forward search can find its hits with one
+        # searchsorted.
+        bucket_nodes, bucket_targets, bucket_dists = [], [], []
+        for t_index, target in enumerate(targets):
+            space = _upward_search(self.down_indptr, self.down_indices, self.down_weights, target)
+            bucket_nodes.extend(space.keys())
+            bucket_dists.extend(space.values())
+            bucket_targets.extend([t_index] * len(space))
+        bucket_nodes = np.asarray(bucket_nodes, dtype=np.int64)
+        order = np.argsort(bucket_nodes, kind="stable")
+        bucket_nodes = bucket_nodes[order]
+        bucket_targets = np.asarray(bucket_targets, dtype=np.int64)[order]
+        bucket_dists = np.asarray(bucket_dists, dtype=np.float64)[order]
+        keys, starts, counts = np.unique(bucket_nodes, return_index=True, return_counts=True)
+
+        for s_index, source in enumerate(sources):
+            space = _upward_search(self.up_indptr, self.up_indices, self.up_weights, source)
+            nodes = np.fromiter(space.keys(), dtype=np.int64, count=len(space))
+            dists = np.fromiter(space.values(), dtype=np.float64, count=len(space))
+            at = np.minimum(np.searchsorted(keys, nodes), keys.size - 1)
+            hit = keys[at] == nodes
+            at, dists = at[hit], dists[hit]
+            sizes = counts[at]
+            total = int(sizes.sum())
+            if total == 0:
+                continue
+            # Expand each hit node into its bucket entries.
+            offsets = np.arange(total) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+            entries = np.repeat(starts[at], sizes) + offsets
+            np.minimum.at(
+                out[s_index],
+                bucket_targets[entries],
+                np.repeat(dists, sizes) + bucket_dists[entries],
+            )
+        return out
+
+
+def _graph_stamp(path):
+    """(directory, meta.json mtime, inode) of the build path currently names."""
+    directory = os.path.realpath(path)
+    stat = os.stat(os.path.join(directory, "meta.json"))
+    return directory, stat.st_mtime_ns, stat.st_ino
+
+
+def open_road_graph(path):
+    """Process-wide RoadGraph for path (memory-mapped, reopened after a rebuild).
+
+    Every call stats path's meta.json; when the symlink points at another
+    build, or meta.json was rewritten, the new build is opened. Callers
+    holding the previous RoadGraph keep a valid mapping of it. If meta.json
+    cannot be read (e.g. mid-deploy), the graph already open is kept.
+    """
+    path = os.path.abspath(path)
+    with _graphs_lock:
+        cached = _graphs.get(path)
+        try:
+            stamp = _graph_stamp(path)
+        except OSError:
+            if cached is None:
+                raise
+            return cached[1]
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        graph = RoadGraph(stamp[0])
+        _graphs[path] = (stamp, graph)
+        logger.info({
+            "event": "road_graph_loaded",
+            "path": path,
+            "directory": stamp[0],
+            "nodes": graph.node_count,
+            "graph_id": graph.graph_id,
+            "previous_graph_id": cached[1].graph_id if cached is not None else None,
+        })
+        return graph
+
+
+def _stop_arrays(locations):
+    size = len(locations)
+    lats = np.fromiter((float(loc["lat"]) for loc in locations), dtype=np.float64, count=size)
+    lngs = np.fromiter((float(loc["lng"]) for loc in locations), dtype=np.float64, count=size)
+    return lats, lngs
+
+
+def road_distance_block(graph, origins, destinations, max_snap_meters=DEFAULT_MAX_SNAP_METERS):
+    """len(origins) x len(destinations) street distances (int32 metres).
+
+    Each stop is snapped to its nearest graph node; a cell is the access
+    leg from the origin stop, the network distance and the access leg to
+    the destination stop, and never less than the great-circle distance.
+    Pairs with an unsnapped stop or no connecting path use the great-circle
+    distance times UNREACHABLE_DETOUR_FACTOR; stops at the same coordinates
+    are 0 apart. Returns (matrix, stats).
+    """
+    o_lat, o_lng = _stop_arrays(origins)
+    d_lat, d_lng = _stop_arrays(destinations)
+    direct = _haversine(o_lat[:, None], o_lng[:, None], d_lat[None, :], d_lng[None, :])
+
+    # Snap each distinct stop once (a full matrix has the same stops on
+    # both sides).
+    snaps = {}
+
+    def snap_all(lats, lngs):
+        snapped = []
+        for lat, lng in zip(lats.tolist(), lngs.tolist()):
+            if (lat, lng) not in snaps:
+                snaps[(lat, lng)] = graph.snap(lat, lng, max_snap_meters)
+            snapped.append(snaps[(lat, lng)])
+        ok = np.array([node is not None for node, _ in snapped], dtype=bool)
+        access = np.array([dist if dist is not None else 0.0 for _, dist in snapped])
+        nodes = [node for node, _ in snapped if node is not None]
+        return ok, access, nodes
+
+    o_ok, o_access, o_nodes = snap_all(o_lat, o_lng)
+    d_ok, d_access, d_nodes = snap_all(d_lat, d_lng)
+
+    matrix = direct * UNREACHABLE_DETOUR_FACTOR
+    unreachable = 0
+    if o_nodes and d_nodes:
+        # Stops sharing a node are searched once.
+        o_unique, o_inverse = np.unique(o_nodes, return_inverse=True)
+        d_unique, d_inverse = np.unique(d_nodes, return_inverse=True)
+        network = graph.many_to_many(o_unique.tolist(), d_unique.tolist())[
+            np.ix_(o_inverse, d_inverse)
+        ]
+        cells = np.ix_(np.flatnonzero(o_ok), np.flatnonzero(d_ok))
+        block = network + o_access[o_ok][:, None] + d_access[d_ok][None, :]
+        reachable = np.isfinite(block)
+        unreachable = int((~reachable).sum())
+        matrix[cells] = np.where(reachable, np.maximum(block, direct[cells]), matrix[cells])
+    matrix[direct == 0.0] = 0.0
+    snapped = [dist for _, dist in snaps.values() if dist is not None]
+    stats = {
+        "snapped": len(snapped),
+        "unsnapped": len(snaps) - len(snapped),
+        "unreachable_pairs": unreachable,
+        "max_snap_meters": round(max(snapped), 1) if snapped else 0.0,
+    }
+    return np.minimum(matrix, np.iinfo(np.int32).max).astype(np.int32), stats
+
+
+def road_distance_matrix(graph, locations, max_snap_meters=DEFAULT_MAX_SNAP_METERS):
+    """N*N street distances for the given stops; see road_distance_block."""
+    return road_distance_block(graph, locations, locations, max_snap_meters)
+
+
+__all__ = [
+    "RoadGraph",
+    "open_road_graph",
+    "road_distance_matrix",
+    "road_distance_block",
+    "GRAPH_FORMAT_VERSION",
+    "DEFAULT_MAX_SNAP_METERS",
+    "UNREACHABLE_DETOUR_FACTOR",
+]
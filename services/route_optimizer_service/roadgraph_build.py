@@ -0,0 +1,360 @@
+"""Offline builder for the road graphs read by roadgraph.py.
+
+    python roadgraph_build.py --osm amsterdam.osm.pbf --out graphs/amsterdam
+    python roadgraph_build.py --edges edges.csv --out graphs/amsterdam
+
+--osm reads an OSM extract with pyosmium (`pip install osmium`; needed
+only where graphs are built, not by the service) and keeps the ways a
+bicycle may use, honouring one-way tags. --edges reads a CSV with the
+header from_lat,from_lng,to_lat,to_lng and optional meters and oneway
+columns (edges are two-way unless oneway is 1/true/yes).
+
+The graph is contracted into a contraction hierarchy: nodes are
+contracted in order of edge difference (lazy updates), shortcuts are
+added unless a bounded witness search finds a path that is at least as
+short. Only the upward and reversed-downward CSR graphs, node
+coordinates and a grid index are written; see roadgraph.py for the
+layout. Building is single-threaded Python: a city extract takes minutes.
+
+Running workers memory-map the graph, so a build never touches files that
+may be mapped. It writes a new <out>.<graph_id> directory next to --out,
+then atomically repoints the --out symlink at it; workers open the new
+build on their next request. The newest KEEP_BUILDS builds are kept and
+older ones removed. A plain --out directory from an earlier build is moved
+aside as a build of its own first.
+"""
+import argparse
+import csv
+import heapq
+import json
+import math
+import os
+import re
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+from roadgraph import EARTH_RADIUS_METERS, GRAPH_FORMAT_VERSION
+
+# Highway values a bicycle may use (plus any way tagged bicycle=yes/designated).
+BICYCLE_HIGHWAYS = {
+    "cycleway", "path", "living_street", "residential", "service", "unclassified",
+    "track", "road", "tertiary", "tertiary_link", "secondary", "secondary_link",
+    "primary", "primary_link", "pedestrian", "bridleway",
+}
+
+# Witness searches stop after settling this many nodes; a missed witness only
+# adds a redundant shortcut, never a wrong distance.
+WITNESS_SETTLED_LIMIT = 60
+
+DEFAULT_CELL_DEGREES = 0.005
+
+# Builds kept next to --out: the published one and the one before it, which
+# workers that have not reopened the graph yet may still be reading.
+KEEP_BUILDS = 2
+
+
+def _meters(lat1, lng1, lat2, lng2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(max(0.0, min(1.0, a))))
+
+
+class _GraphBuilder:
+    """Collects nodes (deduplicated by key) and directed edges."""
+
+    def __init__(self):
+        self.index = {}
+        self.lats = []
+        self.lngs = []
+        self.edges = []
+
+    def node(self, key, lat, lng):
+        node = self.index.get(key)
+        if node is None:
+            node = len(self.lats)
+            self.index[key] = node
+            self.lats.append(lat)
+            self.lngs.append(lng)
+        return node
+
+    def edge(self, u, v, meters, oneway=False):
+        if u == v:
+            return
+        weight = max(1, int(round(meters)))
+        self.edges.append((u, v, weight))
+        if not oneway:
+            self.edges.append((v, u, weight))
+
+
+def load_osm(path):
+    try:
+        import osmium
+    except ImportError as exc:
+        raise SystemExit("reading OSM extracts requires pyosmium: pip install osmium") from exc
+
+    builder = _GraphBuilder()
+
+    class Handler(osmium.SimpleHandler):
+        def way(self, way):
+            tags = way.tags
+            bicycle = tags.get("bicycle")
+            if bicycle == "no":
+                return
+            allowed = bicycle in ("yes", "designated")
+            if not allowed and tags.get("highway") not in BICYCLE_HIGHWAYS:
+                return
+            if not allowed and tags.get("access") in ("no", "private"):
+                return
+            oneway = tags.get("oneway")
+            if tags.get("oneway:bicycle") == "no":
+                oneway = "no"
+            refs = []
+            for ref in way.nodes:
+                if not ref.location.valid():
+                    return
+                refs.append(builder.node(ref.ref, ref.location.lat, ref.location.lon))
+            if oneway == "-1":
+                refs.reverse()
+            for u, v in zip(refs, refs[1:]):
+                builder.edge(
+                    u, v,
+                    _meters(builder.lats[u], builder.lngs[u], builder.lats[v], builder.lngs[v]),
+                    oneway=oneway in ("yes", "1", "true", "-1"),
+                )
+
+    Handler().apply_file(path, locations=True)
+    return builder
+
+
+def load_edge_csv(path):
+    builder = _GraphBuilder()
+    with open(path, newline="", encoding="utf-8") as fh:
+        for row in csv.DictReader(fh):
+            coords = [float(row[k]) for k in ("from_lat", "from_lng", "to_lat", "to_lng")]
+            u = builder.node((round(coords[0], 7), round(coords[1], 7)), coords[0], coords[1])
+            v = builder.node((round(coords[2], 7), round(coords[3], 7)), coords[2], coords[3])
+            meters = row.get("meters")
+            builder.edge(
+                u, v,
+                float(meters) if meters not in (None, "") else _meters(*coords),
+                oneway=str(row.get("oneway") or "").lower() in ("1", "true", "yes"),
+            )
+    return builder
+
+
+def contract(node_count, edges):
+    """Contract the graph; returns (rank, up_edges, down_edges).
+
+    up_edges[u] lists (v, w) for edges u -> v to higher-ranked nodes;
+    down_edges[u] lists (x, w) for edges x -> u from higher-ranked nodes.
+    """
+    out = [dict() for _ in range(node_count)]
+    inc = [dict() for _ in range(node_count)]
+    for u, v, w in edges:
+        if w < out[u].get(v, math.inf):
+            out[u][v] = w
+            inc[v][u] = w
+
+    def witness_distances(source, exclude, limit):
+        settled = {}
+        best = {source: 0}
+        heap = [(0, source)]
+        while heap and len(settled) < WITNESS_SETTLED_LIMIT:
+            dist, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled[node] = dist
+            if dist > limit:
+                break
+            for succ, weight in out[node].items():
+                if succ == exclude:
+                    continue
+                candidate = dist + weight
+                if candidate < best.get(succ, math.inf):
+                    best[succ] = candidate
+                    heapq.heappush(heap, (candidate, succ))
+        return best
+
+    def shortcuts(u):
+        found = []
+        if not inc[u] or not out[u]:
+            return found
+        max_out = max(out[u].values())
+        for x, wx in inc[u].items():
+            dist = witness_distances(x, u, wx + max_out)
+            for y, wy in out[u].items():
+                if y != x and dist.get(y, math.inf) > wx + wy:
+                    found.append((x, y, wx + wy))
+        return found
+
+    deleted_neighbours = [0] * node_count
+
+    def priority(u):
+        found = shortcuts(u)
+        return len(found) - len(inc[u]) - len(out[u]) + deleted_neighbours[u], found
+
+    heap = [(priority(u)[0], u) for u in range(node_count)]
+    heapq.heapify(heap)
+    rank = np.full(node_count, -1, dtype=np.int64)
+    up_edges = [None] * node_count
+    down_edges = [None] * node_count
+    next_rank = 0
+    while heap:
+        _, u = heapq.heappop(heap)
+        if rank[u] >= 0:
+            continue
+        current, found = priority(u)
+        if heap and current > heap[0][0]:
+            heapq.heappush(heap, (current, u))
+            continue
+
+        rank[u] = next_rank
+        next_rank += 1
+        up_edges[u] = list(out[u].items())
+        down_edges[u] = list(inc[u].items())
+        for v in out[u]:
+            del inc[v][u]
+            deleted_neighbours[v] += 1
+        for x in inc[u]:
+            del out[x][u]
+            deleted_neighbours[x] += 1
+        out[u] = {}
+        inc[u] = {}
+        for x, y, w in found:
+            if w < out[x].get(y, math.inf):
+                out[x][y] = w
+                inc[y][x] = w
+    return rank, up_edges, down_edges
+
+
+def _csr(lists, node_count):
+    counts = np.fromiter((len(items) for items in lists), dtype=np.int64, count=node_count)
+    indptr = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    indices = np.fromiter((v for items in lists for v, _ in items), dtype=np.int32, count=int(indptr[-1]))
+    weights = np.fromiter((w for items in lists for _, w in items), dtype=np.int32, count=int(indptr[-1]))
+    return indptr, indices, weights
+
+
+def _grid_index(lats, lngs, cell_degrees):
+    min_lat, min_lng = float(lats.min()), float(lngs.min())
+    rows = int((lats.max() - min_lat) // cell_degrees) + 1
+    columns = int((lngs.max() - min_lng) // cell_degrees) + 1
+    keys = ((lats - min_lat) // cell_degrees).astype(np.int64) * columns + (
+        (lngs - min_lng) // cell_degrees
+    ).astype(np.int64)
+    order = np.argsort(keys, kind="stable")
+    cell_keys, starts = np.unique(keys[order], return_index=True)
+    cell_starts = np.append(starts, order.size).astype(np.int64)
+    grid = {
+        "cell_degrees": cell_degrees,
+        "min_lat": min_lat,
+        "min_lng": min_lng,
+        "rows": rows,
+        "columns": columns,
+    }
+    return cell_keys, cell_starts, order.astype(np.int32), grid
+
+
+def _build_dirs(out_dir):
+    """Build directories of out_dir ("<out>.<graph_id>"), oldest first."""
+    parent, base = os.path.split(out_dir)
+    pattern = re.compile(re.escape(base) + r"\.[0-9a-f]{12}$")
+    builds = [
+        os.path.join(parent, name)
+        for name in os.listdir(parent)
+        if pattern.match(name) and os.path.isfile(os.path.join(parent, name, "meta.json"))
+    ]
+    return sorted(builds, key=lambda path: os.stat(os.path.join(path, "meta.json")).st_mtime_ns)
+
+
+def _publish(out_dir, build_dir, keep=KEEP_BUILDS):
+    """Point the out_dir symlink at build_dir atomically and prune old builds."""
+    if os.path.isdir(out_dir) and not os.path.islink(out_dir):
+        # Written in place by an earlier version: rename it into a build so
+        # the symlink can take its name (renaming keeps live mappings valid).
+        try:
+            with open(os.path.join(out_dir, "meta.json"), "r", encoding="utf-8") as fh:
+                legacy_id = json.load(fh).get("graph_id") or ""
+        except (OSError, ValueError):
+            legacy_id = ""
+        if not re.fullmatch(r"[0-9a-f]{12}", legacy_id):
+            legacy_id = uuid.uuid4().hex[:12]
+        os.rename(out_dir, f"{out_dir}.{legacy_id}")
+    link = f"{out_dir}.link-{os.getpid()}"
+    os.symlink(os.path.basename(build_dir), link)
+    os.replace(link, out_dir)
+    # Removing a directory leaves existing mappings of its files intact.
+    for old_build in _build_dirs(out_dir)[:-keep]:
+        if os.path.realpath(old_build) != os.path.realpath(build_dir):
+            shutil.rmtree(old_build, ignore_errors=True)
+
+
+def write_graph(builder, out_dir, source, cell_degrees=DEFAULT_CELL_DEGREES):
+    """Build the graph into a new versioned directory and publish it as out_dir."""
+    node_count = len(builder.lats)
+    if node_count == 0:
+        raise SystemExit("no usable edges found")
+    started = time.monotonic()
+    rank, up_edges, down_edges = contract(node_count, builder.edges)
+    contracted_s = time.monotonic() - started
+
+    lats = np.asarray(builder.lats, dtype=np.float64)
+    lngs = np.asarray(builder.lngs, dtype=np.float64)
+    up_indptr, up_indices, up_weights = _csr(up_edges, node_count)
+    down_indptr, down_indices, down_weights = _csr(down_edges, node_count)
+    cell_keys, cell_starts, cell_nodes, grid = _grid_index(lats, lngs, cell_degrees)
+
+    out_dir = os.path.abspath(out_dir.rstrip(os.sep))
+    graph_id = uuid.uuid4().hex[:12]
+    build_dir = f"{out_dir}.{graph_id}"
+    os.makedirs(build_dir)
+    arrays = {
+        "lat": lats, "lng": lngs,
+        "up_indptr": up_indptr, "up_indices": up_indices, "up_weights": up_weights,
+        "down_indptr": down_indptr, "down_indices": down_indices, "down_weights": down_weights,
+        "cell_keys": cell_keys, "cell_starts": cell_starts, "cell_nodes": cell_nodes,
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(build_dir, f"{name}.npy"), array)
+    meta = {
+        "format_version": GRAPH_FORMAT_VERSION,
+        "graph_id": graph_id,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "source": os.path.basename(source),
+        "nodes": node_count,
+        "edges": len(builder.edges),
+        "up_edges": int(up_indices.size),
+        "down_edges": int(down_indices.size),
+        "contraction_seconds": round(contracted_s, 1),
+        "grid": grid,
+    }
+    # meta.json last: its presence marks a complete graph directory.
+    with open(os.path.join(build_dir, "meta.json"), "w", encoding="utf-8") as fh:
+        json.dump(meta, fh, indent=2)
+    _publish(out_dir, build_dir)
+    return meta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--osm", help="OSM extract (.osm.pbf / .osm)")
+    source.add_argument("--edges", help="edge list CSV")
+    parser.add_argument("--out", required=True, help="graph path (a symlink to the newest build)")
+    parser.add_argument("--cell-degrees", type=float, default=DEFAULT_CELL_DEGREES)
+    args = parser.parse_args(argv)
+
+    builder = load_osm(args.osm) if args.osm else load_edge_csv(args.edges)
+    meta = write_graph(builder, args.out, args.osm or args.edges, args.cell_degrees)
+    print(json.dumps(meta, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,20 +3,36 @@
 This module enforces hard constraints and performs simple transformations needed
 before passing locations to the solver. Keep rules deterministic and auditable.
 """
-from typing import Dict, List, Tuple, Any
+import math
+import os
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Any
 
 # Hard upper bound on locations accepted by the solver. The proxy layer
 # enforces 80; this is defence-in-depth at the service boundary.
 MAX_LOCATIONS = 100
 
+# Proximity merging (preferences["merge_radius_meters"]) is meant for stops
+# on the same corner; larger radii would hide real travel from the solver.
+MAX_MERGE_RADIUS_METERS = 200.0
+DEFAULT_MERGE_RADIUS_METERS = float(os.environ.get("ROUTE_MERGE_RADIUS_METERS", 0))
 
-def enforce_rules(payload: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[str]]:
+_EARTH_RADIUS_METERS = 6_371_000.0
+_METERS_PER_DEGREE = math.pi * _EARTH_RADIUS_METERS / 180.0
+
+
+def enforce_rules(
+    payload: Dict[str, Any], stats: Optional[Dict[str, Any]] = None
+) -> Tuple[List[Dict[str, Any]], List[str]]:
     """Apply hard business rules to locations.
 
     Returns (locations, warnings)
     - Ensures lat/lng present and numeric
     - Enforces max_duration (if provided) by adding a warning (solver must respect separately)
     - Removes exact-duplicate coordinates
+
+    When stats is given, stats["kept_indices"] lists the position in
+    payload["locations"] of each returned stop (an inserted rest stop has
+    none, so the list is then one shorter).
     """
     locations = payload.get("locations") or []
     preferences = payload.get("preferences", {}) or {}
@@ -24,9 +40,10 @@ def enforce_rules(payload: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[s
     include_rest_stops = bool(preferences.get("include_rest_stops"))
     seen = set()
     out: List[Dict[str, Any]] = []
+    kept: List[int] = []
     warnings: List[str] = []
 
-    for loc in locations:
+    for index, loc in enumerate(locations):
         try:
             lat = float(loc.get("lat"))
             lng = float(loc.get("lng"))
@@ -41,6 +58,7 @@ def enforce_rules(payload: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[s
         seen.add(key)
         normalized = {**loc, "lat": lat, "lng": lng}
         out.append(normalized)
+        kept.append(index)
 
     if max_duration is not None:
         warnings.append(f"max_duration_minutes constraint: {max_duration}")
@@ -57,15 +75,17 @@ def enforce_rules(payload: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[s
             out.append(rest_stop)
             warnings.append("rest_stop_inserted")
 
-    # Validate optional edge-penalty matrix dimensions (if provided)
+    # Validate optional edge-penalty matrix dimensions (if provided). Binary
+    # (array) penalties are indexed like the request locations and are
+    # shape-checked in pipeline.prepare_problem instead.
     edge_penalties = preferences.get("edge_penalties")
-    if edge_penalties is not None:
+    if edge_penalties is not None and not hasattr(edge_penalties, "shape"):
         if not isinstance(edge_penalties, list):
             warnings.append("edge_penalties invalid: expected list of lists")
         else:
             size = len(out)
             valid = True
-            if size == 0:
+            if size == 0 or len(edge_penalties) != size:
                 valid = False
             for row in edge_penalties:
                 if not isinstance(row, list) or len(row) != size:
@@ -85,7 +105,131 @@ def enforce_rules(payload: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[s
         if key in preferences:
             warnings.append(f"preference received: {key}={preferences.get(key)}")
 
+    if stats is not None:
+        stats["kept_indices"] = kept
     return out, warnings
 
 
-__all__ = ["enforce_rules", "MAX_LOCATIONS"]
+def resolve_merge_radius(preferences: Optional[Dict[str, Any]]) -> Tuple[float, Optional[str]]:
+    """Merge radius in metres (0 = off) and an optional warning."""
+    value = (preferences or {}).get("merge_radius_meters")
+    if value is None:
+        return DEFAULT_MERGE_RADIUS_METERS, None
+    if (
+        isinstance(value, bool)
+        or not isinstance(value, (int, float))
+        or not 0 <= value <= MAX_MERGE_RADIUS_METERS
+    ):
+        return DEFAULT_MERGE_RADIUS_METERS, (
+            f"merge_radius_meters invalid: expected 0-{MAX_MERGE_RADIUS_METERS:g}"
+        )
+    return float(value), None
+
+
+def _distance_meters(a: Dict[str, Any], b: Dict[str, Any]) -> float:
+    phi1, phi2 = math.radians(a["lat"]), math.radians(b["lat"])
+    h = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(b["lng"] - a["lng"]) / 2) ** 2
+    )
+    return 2 * _EARTH_RADIUS_METERS * math.asin(math.sqrt(min(1.0, h)))
+
+
+def merge_nearby_stops(
+    locations: List[Dict[str, Any]],
+    radius_meters: float,
+    keep_index: int = 0,
+    fixed: Sequence[int] = (),
+) -> List[List[int]]:
+    """Group stops lying within radius_meters of a group leader.
+
+    Returns one list of indices into locations per group, ordered by leader
+    index; each group starts with its leader and continues with the members
+    in nearest-neighbour order from it. Stops are taken in input order with
+    keep_index first (so it always leads its group) and join the nearest
+    leader within the radius, else lead a new group. The stops in fixed
+    (e.g. rider starts) are taken right after keep_index and always lead a
+    group of their own. Leaders are bucketed in a grid of radius-sized
+    cells, so each stop is only compared with leaders in the 3x3 cells
+    around it.
+    """
+    if radius_meters <= 0 or len(locations) < 2:
+        return [[i] for i in range(len(locations))]
+    # Scale longitude by the highest-latitude cosine: projected distances
+    # then never exceed true ones and neighbours are at most one cell away.
+    lng_scale = math.cos(math.radians(min(89.0, max(abs(loc["lat"]) for loc in locations))))
+    cell_degrees = radius_meters / _METERS_PER_DEGREE
+
+    def cell(loc):
+        return (
+            math.floor(loc["lat"] / cell_degrees),
+            math.floor(loc["lng"] * lng_scale / cell_degrees),
+        )
+
+    leaders_by_cell: Dict[Tuple[int, int], List[int]] = {}
+    groups: Dict[int, List[int]] = {}
+    leading = list(dict.fromkeys([keep_index, *fixed]))
+    always_lead = set(leading)
+    order = leading + [i for i in range(len(locations)) if i not in always_lead]
+    for i in order:
+        loc = locations[i]
+        cy, cx = cell(loc)
+        best, best_distance = None, radius_meters
+        if i not in always_lead:
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    for leader in leaders_by_cell.get((cy + dy, cx + dx), ()):
+                        distance = _distance_meters(locations[leader], loc)
+                        if distance <= best_distance:
+                            best, best_distance = leader, distance
+        if best is None:
+            leaders_by_cell.setdefault((cy, cx), []).append(i)
+            groups[i] = [i]
+        else:
+            groups[best].append(i)
+
+    result = []
+    for leader in sorted(groups):
+        members, chain = groups[leader][1:], [leader]
+        while members:
+            nearest = min(members, key=lambda m: _distance_meters(locations[chain[-1]], locations[m]))
+            members.remove(nearest)
+            chain.append(nearest)
+        result.append(chain)
+    return result
+
+
+def expand_merged_route(
+    route: List[int], groups: List[List[int]], seen: Optional[Set[int]] = None
+) -> List[int]:
+    """Map a route over group leaders back to every stop.
+
+    route indexes groups; each group is visited as a whole on its first
+    occurrence, later occurrences (the return to the start of a closed
+    tour) emit only the leader. Pass the same seen set for the routes of
+    several riders so a shared start group is expanded once.
+    """
+    expanded: List[int] = []
+    if seen is None:
+        seen = set()
+    for k in route:
+        expanded.extend(groups[k] if k not in seen else groups[k][:1])
+        seen.add(k)
+    return expanded
+
+
+def group_walk_meters(locations: List[Dict[str, Any]], group: List[int]) -> int:
+    """Great-circle length of the walk through a merged group, in metres."""
+    return int(sum(_distance_meters(locations[a], locations[b]) for a, b in zip(group, group[1:])))
+
+
+__all__ = [
+    "enforce_rules",
+    "resolve_merge_radius",
+    "merge_nearby_stops",
+    "expand_merged_route",
+    "group_walk_meters",
+    "MAX_LOCATIONS",
+    "MAX_MERGE_RADIUS_METERS",
+    "DEFAULT_MERGE_RADIUS_METERS",
+]
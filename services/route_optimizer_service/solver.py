@@ -3,28 +3,106 @@
 All distances are in metres (haversine). The solver returns a
 (route_indices, solver_status) tuple so callers can distinguish a real
 solution from the input-order fallback.
+
+Distance matrices are NumPy int32 arrays built with broadcasted array
+maths; no per-pair Python code runs while building them.
 """
+import functools
 import math
 import time
 import logging
 
+import numpy as np
+
 try:
     from ortools.constraint_solver import pywrapcp
     from ortools.constraint_solver import routing_enums_pb2
+    from ortools.constraint_solver import routing_parameters_pb2
 except Exception:
     raise
 
+from bounds import one_tree_lower_bound
+from fastpath import HELD_KARP_MAX_STOPS, held_karp, local_search_tour
+from timing import phase
+
 logger = logging.getLogger("route_optimizer")
 
 # Default solver wall-clock budget in seconds (applied when the caller does
 # not supply solver_time_limit_seconds).
 DEFAULT_SOLVER_TIME_LIMIT_SECONDS = 5
 
+# Budget used instead of the default when the search is seeded with a
+# warm-start route; local search only has to repair the seed.
+DEFAULT_WARM_START_TIME_LIMIT_SECONDS = 1
+
+# Adaptive budget policy (preferences["solver_budget"] = "adaptive", the
+# default). Without an explicit solver_time_limit_seconds the budget is
+# ADAPTIVE_BASE_SECONDS + ADAPTIVE_SECONDS_PER_STOP * N, capped at the
+# default limit: ~0.26 s for 4 stops, ~4.1 s for 100. Within any budget the
+# search also stops when the best objective has not improved for the
+# plateau window (a fraction of the budget, at least
+# MIN_PLATEAU_SECONDS), or when it is within DEFAULT_TARGET_GAP of the
+# Held-Karp lower bound. "fixed" restores the plain time-limited search.
+ADAPTIVE_BASE_SECONDS = 0.1
+ADAPTIVE_SECONDS_PER_STOP = 0.04
+DEFAULT_PLATEAU_FRACTION = 0.35
+MIN_PLATEAU_SECONDS = 0.1
+DEFAULT_TARGET_GAP = 0.01
+# Share of the budget the lower-bound computation may use.
+LOWER_BOUND_BUDGET_FRACTION = 0.1
+
 # Assumed average cycling speed used to convert max_duration_minutes to
 # max_distance_meters for the OR-Tools Distance dimension constraint.
 DEFAULT_AVG_SPEED_KMH = 15.0
 _AVG_SPEED_MPS = DEFAULT_AVG_SPEED_KMH * 1000.0 / 3600.0  # ~4.167 m/s
 
+EARTH_RADIUS_METERS = 6_371_000.0
+
+# Distance modes accepted via preferences["distance_mode"].
+#   "haversine"       -- great-circle distance (default, exact on the sphere).
+#   "equirectangular" -- planar projection around the stop set's mean
+#                        latitude; no per-pair trigonometry. The relative error
+#                        versus haversine is roughly tan(lat) * (lat span / 2):
+#                        under 0.35% for stop sets spanning <= 25 km at
+#                        latitudes below 60 degrees, under 0.7% at 50 km. Use it
+#                        only for city-scale routes.
+DISTANCE_MODE_HAVERSINE = "haversine"
+DISTANCE_MODE_EQUIRECTANGULAR = "equirectangular"
+DISTANCE_MODES = (DISTANCE_MODE_HAVERSINE, DISTANCE_MODE_EQUIRECTANGULAR)
+
+# Upper bound on cells evaluated per broadcast block. Keeps temporary arrays
+# at a few MB regardless of stop count.
+_MATRIX_BLOCK_CELLS = 1 << 20
+
+# Upper clamp for caller-supplied edge-penalty factors.
+MAX_EDGE_PENALTY_FACTOR = 10.0
+
+# Multi-rider solves (solve_fleet_distance_matrix): cost per metre of the
+# longest rider route (the Distance dimension's global span), added to the
+# total distance. preferences["rider_balance"] overrides it; values below the
+# rider count let one rider take most stops, and 0 minimizes the total
+# distance alone, which may leave riders idle.
+DEFAULT_RIDER_BALANCE_COEFFICIENT = 100
+
+_FIRST_SOLUTION = routing_enums_pb2.FirstSolutionStrategy
+_METAHEURISTIC = routing_enums_pb2.LocalSearchMetaheuristic
+
+# Named OR-Tools search configurations: (first-solution strategy,
+# metaheuristic). Single searches use default_search_config(priority);
+# portfolio solves (portfolio.py) race several of them.
+SEARCH_CONFIGS = {
+    "gls_path_cheapest_arc": (_FIRST_SOLUTION.PATH_CHEAPEST_ARC, _METAHEURISTIC.GUIDED_LOCAL_SEARCH),
+    "gls_parallel_insertion": (
+        _FIRST_SOLUTION.PARALLEL_CHEAPEST_INSERTION, _METAHEURISTIC.GUIDED_LOCAL_SEARCH
+    ),
+    "sa_savings": (_FIRST_SOLUTION.SAVINGS, _METAHEURISTIC.SIMULATED_ANNEALING),
+    "tabu_christofides": (_FIRST_SOLUTION.CHRISTOFIDES, _METAHEURISTIC.TABU_SEARCH),
+    "tabu_path_cheapest_arc": (_FIRST_SOLUTION.PATH_CHEAPEST_ARC, _METAHEURISTIC.TABU_SEARCH),
+    "sa_global_cheapest_arc": (
+        _FIRST_SOLUTION.GLOBAL_CHEAPEST_ARC, _METAHEURISTIC.SIMULATED_ANNEALING
+    ),
+}
+
 
 def haversine_meters(lat1: float, lng1: float, lat2: float, lng2: float) -> int:
     """Great-circle distance in whole metres (WGS-84 sphere approximation)."""
@@ -39,22 +117,126 @@ def haversine_meters(lat1: float, lng1: float, lat2: float, lng2: float) -> int:
     return int(2 * R * math.asin(math.sqrt(max(0.0, min(1.0, a)))))
 
 
-def compute_distance_matrix(locations, preferences=None):
-    """Build an N*N haversine distance matrix (values in metres).
+def coordinate_arrays(locations):
+    """Return (lat_radians, lng_radians) float64 arrays for the given stops."""
+    size = len(locations)
+    lats = np.fromiter((float(loc["lat"]) for loc in locations), dtype=np.float64, count=size)
+    lngs = np.fromiter((float(loc["lng"]) for loc in locations), dtype=np.float64, count=size)
+    return np.radians(lats), np.radians(lngs)
+
+
+def _symmetric_matrix(size, block_fn):
+    """Fill an N*N int32 matrix from its upper triangle, one row block at a time.
+
+    block_fn(i0, i1) must return the float distances for rows i0:i1 against
+    columns i0:size. Each block is written to the upper triangle and mirrored
+    into the lower one, so every unordered pair is evaluated once (plus the
+    small diagonal square of each block).
+    """
+    matrix = np.zeros((size, size), dtype=np.int32)
+    if size < 2:
+        return matrix
+    rows_per_block = max(1, _MATRIX_BLOCK_CELLS // size)
+    for i0 in range(0, size, rows_per_block):
+        i1 = min(size, i0 + rows_per_block)
+        # astype truncates toward zero, matching int() in haversine_meters.
+        block = block_fn(i0, i1).astype(np.int32)
+        matrix[i0:i1, i0:] = block
+        matrix[i0:, i0:i1] = block.T
+    return matrix
+
+
+def haversine_matrix(phi, lam):
+    """Symmetric haversine matrix (int32 metres) from radian coordinate arrays."""
+    cos_phi = np.cos(phi)
+
+    def block(i0, i1):
+        dphi = phi[i0:] - phi[i0:i1, None]
+        dlam = lam[i0:] - lam[i0:i1, None]
+        a = np.sin(dphi * 0.5) ** 2
+        a += cos_phi[i0:i1, None] * cos_phi[i0:] * np.sin(dlam * 0.5) ** 2
+        np.clip(a, 0.0, 1.0, out=a)
+        return (2.0 * EARTH_RADIUS_METERS) * np.arcsin(np.sqrt(a))
+
+    return _symmetric_matrix(phi.size, block)
+
+
+def equirectangular_matrix(phi, lam):
+    """Symmetric equirectangular matrix (int32 metres); see DISTANCE_MODES."""
+    if phi.size == 0:
+        return np.zeros((0, 0), dtype=np.int32)
+    x = lam * (math.cos(float(phi.mean())) * EARTH_RADIUS_METERS)
+    y = phi * EARTH_RADIUS_METERS
+
+    def block(i0, i1):
+        return np.hypot(x[i0:] - x[i0:i1, None], y[i0:] - y[i0:i1, None])
+
+    return _symmetric_matrix(phi.size, block)
+
+
+def great_circle_matrix(locations, preferences=None):
+    """Raw N*N great-circle matrix (int32 metres), before edge penalties.
+
+    Uses a broadcasted haversine by default; preferences["distance_mode"] set
+    to "equirectangular" selects the cheaper planar approximation.
+    """
+    phi, lam = coordinate_arrays(locations)
+    if (preferences or {}).get("distance_mode") == DISTANCE_MODE_EQUIRECTANGULAR:
+        return equirectangular_matrix(phi, lam)
+    return haversine_matrix(phi, lam)
+
+
+def raw_distance_matrix(locations, preferences=None, provider=None, stats=None):
+    """N*N matrix of real metres (int32), before preference scaling.
+
+    provider is a distance provider from distance_providers (None for the
+    built-in great-circle distances); provider stats are copied into stats
+    when given. Reported route distances are sums of these cells.
+    """
+    preferences = preferences or {}
+    with phase("matrix"):
+        if provider is None:
+            return great_circle_matrix(locations, preferences)
+        matrix, provider_stats = provider.matrix(locations, preferences)
+        if stats is not None:
+            stats.update(provider_stats)
+        return matrix
+
+
+def compute_distance_matrix(locations, preferences=None, provider=None, stats=None):
+    """Build the N*N matrix the solver searches (int32 NumPy array).
 
+    raw_distance_matrix with apply_preferences_to_matrix applied: the cells
+    are metres scaled by the preference multipliers and edge penalties.
     Replaces the old Euclidean approach which was systematically wrong at
     non-equatorial latitudes.
     """
-    coords = [(float(loc["lat"]), float(loc["lng"])) for loc in locations]
-    size = len(coords)
-    matrix = [[0] * size for _ in range(size)]
-    for i in range(size):
-        for j in range(size):
-            if i != j:
-                matrix[i][j] = haversine_meters(
-                    coords[i][0], coords[i][1], coords[j][0], coords[j][1]
-                )
-    return apply_preferences_to_matrix(matrix, preferences or {})
+    matrix = raw_distance_matrix(locations, preferences, provider=provider, stats=stats)
+    with phase("preferences"):
+        return apply_preferences_to_matrix(matrix, preferences or {})
+
+
+def pair_distances(phi, lam, rows, cols, distance_mode=None):
+    """Distances (int64 metres) for the node pairs rows[i] -> cols[i].
+
+    Same values as the matching compute_distance_matrix cells, computed only
+    for the requested pairs. phi/lam come from coordinate_arrays over the
+    whole stop set (the equirectangular projection uses its mean latitude).
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    if distance_mode == DISTANCE_MODE_EQUIRECTANGULAR:
+        scale = math.cos(float(phi.mean())) * EARTH_RADIUS_METERS if phi.size else 0.0
+        dist = np.hypot(
+            (lam[cols] - lam[rows]) * scale,
+            (phi[cols] - phi[rows]) * EARTH_RADIUS_METERS,
+        )
+    else:
+        a = np.sin((phi[cols] - phi[rows]) * 0.5) ** 2
+        a += np.cos(phi[rows]) * np.cos(phi[cols]) * np.sin((lam[cols] - lam[rows]) * 0.5) ** 2
+        dist = (2.0 * EARTH_RADIUS_METERS) * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+    # Truncate toward zero, as the int32 matrices do.
+    return dist.astype(np.int64)
 
 
 def compute_euclidean_matrix(locations, preferences=None):
@@ -62,19 +244,60 @@ def compute_euclidean_matrix(locations, preferences=None):
     return compute_distance_matrix(locations, preferences)
 
 
+def _safe_float(value):
+    try:
+        return float(value)
+    except Exception:
+        return math.nan
+
+
+_safe_float_ufunc = np.frompyfunc(_safe_float, 1, 1)
+
+
+def edge_penalty_factors(edge_penalties, size):
+    """Validate an edge-penalty matrix and return it as an N*N float64 array.
+
+    Accepts an N*N list of lists or NumPy array (the binary request format)
+    and returns None for anything else. Cells that are non-numeric,
+    non-finite or <= 0 are masked to 1.0 in bulk; factors above
+    MAX_EDGE_PENALTY_FACTOR are clamped so a bad cell cannot overflow the
+    int32 matrix.
+    """
+    if isinstance(edge_penalties, np.ndarray):
+        if size == 0 or edge_penalties.shape != (size, size):
+            return None
+        factors = edge_penalties.astype(np.float64)
+    elif not isinstance(edge_penalties, list) or size == 0 or len(edge_penalties) != size:
+        return None
+    elif not all(isinstance(row, list) and len(row) == size for row in edge_penalties):
+        return None
+    else:
+        try:
+            factors = np.asarray(edge_penalties, dtype=np.float64)
+        except (TypeError, ValueError):
+            # Mixed or non-numeric cells: convert leniently, bad cells become
+            # NaN and are masked below together with the numeric outliers.
+            factors = _safe_float_ufunc(np.asarray(edge_penalties, dtype=object)).astype(np.float64)
+
+    valid = np.isfinite(factors) & (factors > 0)
+    return np.where(valid, np.minimum(factors, MAX_EDGE_PENALTY_FACTOR), 1.0)
+
+
 def apply_preferences_to_matrix(distance_matrix, preferences):
     """Scale matrix cells by preference-derived multipliers.
 
     The matrix is in metres; multipliers are dimensionless so the output
-    remains in metres.
+    remains in metres. Accepts any N*N array-like and returns an int32 array.
+    Ratio scaling, the time-of-day multiplier and edge penalties are applied
+    as whole-array operations; zero cells stay zero.
     """
-    if not distance_matrix:
-        return distance_matrix
+    matrix = np.asarray(distance_matrix, dtype=np.int32)
+    if matrix.size == 0:
+        return matrix
 
-    flat = [v for row in distance_matrix for v in row if v]
-    max_distance = max(flat) if flat else 0
+    max_distance = int(matrix.max())
     if max_distance == 0:
-        return distance_matrix
+        return matrix
 
     avoid_traffic = bool(preferences.get("avoid_traffic"))
     weather = bool(preferences.get("weather_consideration"))
@@ -98,45 +321,152 @@ def apply_preferences_to_matrix(distance_matrix, preferences):
     elif priority == "coverage":
         penalty_strength = max(0.0, penalty_strength - 0.05)
 
-    adjusted = []
-    for row in distance_matrix:
-        new_row = []
-        for dist in row:
-            if dist == 0:
-                new_row.append(0)
-                continue
-            ratio = dist / max_distance
-            multiplier = (1.0 + penalty_strength * ratio) * peak_multiplier
-            new_row.append(int(dist * multiplier))
-        adjusted.append(new_row)
-
-    if isinstance(edge_penalties, list):
-        size = len(adjusted)
-        if size > 0 and all(
-            isinstance(r, list) and len(r) == size for r in edge_penalties
-        ):
-            penalized = []
-            for i in range(size):
-                row = []
-                for j in range(size):
-                    base = adjusted[i][j]
-                    if base == 0:
-                        row.append(0)
-                        continue
-                    try:
-                        factor_value = float(edge_penalties[i][j])
-                    except Exception:
-                        factor_value = 1.0
-                    if factor_value <= 0:
-                        factor_value = 1.0
-                    row.append(int(base * factor_value))
-                penalized.append(row)
-            return penalized
-
-    return adjusted
-
-
-def solve_tsp_distance_matrix(distance_matrix, start_index=0, preferences=None):
+    factors = edge_penalty_factors(edge_penalties, matrix.shape[0])
+    if penalty_strength == 0.0 and peak_multiplier == 1.0 and factors is None:
+        return matrix
+
+    dist = matrix.astype(np.float64)
+    adjusted = dist
+    if penalty_strength != 0.0 or peak_multiplier != 1.0:
+        multiplier = (1.0 + penalty_strength * (dist / max_distance)) * peak_multiplier
+        # Truncate like int() so results match the scalar implementation.
+        adjusted = np.trunc(dist * multiplier)
+    if factors is not None:
+        adjusted = np.trunc(adjusted * factors)
+
+    np.clip(adjusted, 0, np.iinfo(np.int32).max, out=adjusted)
+    return adjusted.astype(np.int32)
+
+
+def cheapest_insertion(route, nodes, distance_matrix):
+    """Insert nodes one by one into a closed tour at their cheapest position.
+
+    route is a list of node indices whose first element stays first (the
+    tour implicitly returns to it); returns a new list.
+    """
+    matrix = np.asarray(distance_matrix)
+    tour = list(route)
+    for node in nodes:
+        if not tour:
+            tour.append(node)
+            continue
+        prev = np.asarray(tour)
+        nxt = np.roll(prev, -1)
+        delta = matrix[prev, node] + matrix[node, nxt] - matrix[prev, nxt]
+        tour.insert(int(np.argmin(delta)) + 1, node)
+    return tour
+
+
+def _current_route(routing, manager):
+    """Read the route of vehicle 0 from the assignment being explored."""
+    index = routing.Start(0)
+    route = []
+    while not routing.IsEnd(index):
+        route.append(manager.IndexToNode(index))
+        index = routing.NextVar(index).Value()
+    route.append(manager.IndexToNode(index))
+    return route
+
+
+def _positive_number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return float(value) if value > 0 else None
+
+
+def max_distance_for_preferences(preferences):
+    """max_duration_minutes -> metre cap at the average cycling speed, or None."""
+    max_duration_minutes = (preferences or {}).get("max_duration_minutes")
+    if isinstance(max_duration_minutes, (int, float)) and max_duration_minutes > 0:
+        return int(max_duration_minutes * 60.0 * _AVG_SPEED_MPS)
+    return None
+
+
+def resolve_search_budget(size, preferences, warm_start=False):
+    """Return the search budget policy for a problem of the given size.
+
+    Keys: time_limit_seconds (float, sub-second values kept), adaptive,
+    plateau_seconds and target_gap (both None for the fixed policy).
+    """
+    preferences = preferences or {}
+    adaptive = preferences.get("solver_budget") != "fixed"
+
+    time_limit = _positive_number(preferences.get("solver_time_limit_seconds"))
+    if time_limit is None:
+        time_limit = float(
+            DEFAULT_WARM_START_TIME_LIMIT_SECONDS if warm_start
+            else DEFAULT_SOLVER_TIME_LIMIT_SECONDS
+        )
+        if adaptive:
+            time_limit = min(time_limit, ADAPTIVE_BASE_SECONDS + ADAPTIVE_SECONDS_PER_STOP * size)
+
+    if not adaptive:
+        return {
+            "time_limit_seconds": time_limit,
+            "adaptive": False,
+            "plateau_seconds": None,
+            "target_gap": None,
+        }
+
+    plateau = _positive_number(preferences.get("solver_plateau_seconds"))
+    if plateau is None:
+        plateau = max(MIN_PLATEAU_SECONDS, DEFAULT_PLATEAU_FRACTION * time_limit)
+    target_gap = preferences.get("solver_target_gap")
+    if isinstance(target_gap, bool) or not isinstance(target_gap, (int, float)) or target_gap < 0:
+        target_gap = DEFAULT_TARGET_GAP
+    return {
+        "time_limit_seconds": time_limit,
+        "adaptive": True,
+        "plateau_seconds": plateau,
+        "target_gap": float(target_gap),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _search_parameters_template(first_solution_strategy, metaheuristic):
+    params = pywrapcp.DefaultRoutingSearchParameters()
+    params.first_solution_strategy = first_solution_strategy
+    # A metaheuristic always runs to improve past the greedy solution; the
+    # time limit bounds how long improvement runs.
+    params.local_search_metaheuristic = metaheuristic
+    return params
+
+
+def default_search_config(priority):
+    """SEARCH_CONFIGS name used for priority when no configuration is requested."""
+    # Coverage uses insertion for geographic spread.
+    if priority == "coverage":
+        return "gls_parallel_insertion"
+    return "gls_path_cheapest_arc"
+
+
+def routing_search_parameters(priority, search_config=None):
+    """A fresh RoutingSearchParameters for priority, without a time limit.
+
+    search_config, a SEARCH_CONFIGS name, overrides the configuration
+    chosen from priority. Built once per process and option set, then
+    copied per solve. The RoutingModel itself cannot be reused: it is
+    closed by the first solve and its arc costs are fixed when registered.
+    """
+    strategy, metaheuristic = SEARCH_CONFIGS.get(search_config) or SEARCH_CONFIGS[
+        default_search_config(priority)
+    ]
+    params = routing_parameters_pb2.RoutingSearchParameters()
+    params.CopyFrom(_search_parameters_template(strategy, metaheuristic))
+    return params
+
+
+def solve_tsp_distance_matrix(
+    distance_matrix,
+    start_index=0,
+    preferences=None,
+    should_stop=None,
+    on_solution=None,
+    initial_route=None,
+    stats=None,
+    search_config=None,
+    lower_bound=None,
+):
     """Solve the TSP and return (route_indices, solver_status).
 
     solver_status values:
@@ -147,6 +477,25 @@ def solve_tsp_distance_matrix(distance_matrix, start_index=0, preferences=None):
     The distance_matrix must be in metres (integers). max_duration_minutes is
     converted to a metre cap using DEFAULT_AVG_SPEED_KMH so the OR-Tools
     Distance dimension constraint is dimensionally correct.
+
+    should_stop, when given, is polled at every solution the search accepts;
+    returning True ends the search early and the best route so far is
+    returned. on_solution(route_indices, objective) is called each time the
+    search finds a route cheaper than any before it.
+
+    initial_route, a permutation of all nodes starting at start_index, seeds
+    the search instead of the first-solution heuristic. Without an explicit
+    solver_time_limit_seconds a seeded search uses
+    DEFAULT_WARM_START_TIME_LIMIT_SECONDS. A seed OR-Tools rejects (e.g.
+    one that breaks the distance cap) falls back to a cold start.
+
+    The budget follows resolve_search_budget. When stats is a dict it is
+    filled with time_limit_seconds, stop_reason ("time_limit", "completed",
+    "plateau", "gap" or "stopped"), objective, lower_bound and gap.
+
+    search_config picks a SEARCH_CONFIGS entry instead of the one for the
+    priority; lower_bound, when given, is used instead of computing the
+    1-tree bound (portfolio runners share one).
     """
     size = len(distance_matrix)
     if size == 0:
@@ -155,27 +504,50 @@ def solve_tsp_distance_matrix(distance_matrix, start_index=0, preferences=None):
     preferences = preferences or {}
     priority = preferences.get("priority") or ""
 
-    # Time limit: caller value or module default -- always applied.
-    time_limit_seconds = preferences.get("solver_time_limit_seconds")
-    if not isinstance(time_limit_seconds, (int, float)) or time_limit_seconds <= 0:
-        time_limit_seconds = DEFAULT_SOLVER_TIME_LIMIT_SECONDS
+    if stats is None:
+        stats = {}
 
-    # max_duration -> metre cap using average cycling speed (not arbitrary units).
-    max_duration_minutes = preferences.get("max_duration_minutes")
-    max_distance_meters = None
-    if isinstance(max_duration_minutes, (int, float)) and max_duration_minutes > 0:
-        max_distance_meters = int(max_duration_minutes * 60.0 * _AVG_SPEED_MPS)
+    warm_start = (
+        initial_route is not None
+        and len(initial_route) == size
+        and initial_route[0] == start_index
+        and sorted(initial_route) == list(range(size))
+    )
+    # Time limit: caller value or size-scaled default -- always applied.
+    budget = resolve_search_budget(size, preferences, warm_start=warm_start)
+    time_limit_seconds = budget["time_limit_seconds"]
+    stats.update({
+        "engine": "ortools",
+        "time_limit_seconds": round(time_limit_seconds, 3),
+        "stop_reason": None,
+        "objective": None,
+        "lower_bound": None,
+        "gap": None,
+    })
+
+    max_distance_meters = max_distance_for_preferences(preferences)
+
+    # RegisterTransitMatrix takes nested lists of Python ints.
+    costs = np.asarray(distance_matrix, dtype=np.int64).tolist()
+
+    budget_started_at = time.monotonic()
+    if budget["target_gap"] is None:
+        lower_bound = None
+    elif lower_bound is None and size > 1:
+        lower_bound = one_tree_lower_bound(
+            distance_matrix,
+            root=start_index,
+            time_budget_seconds=LOWER_BOUND_BUDGET_FRACTION * time_limit_seconds,
+        )
+    stats["lower_bound"] = lower_bound
 
     try:
         manager = pywrapcp.RoutingIndexManager(size, 1, start_index)
         routing = pywrapcp.RoutingModel(manager)
 
-        def distance_callback(from_index, to_index):
-            from_node = manager.IndexToNode(from_index)
-            to_node = manager.IndexToNode(to_index)
-            return distance_matrix[from_node][to_node]
-
-        transit_callback_index = routing.RegisterTransitCallback(distance_callback)
+        # Arc costs are looked up in C++; a Python transit callback would be
+        # called across the language boundary for every arc the search tries.
+        transit_callback_index = routing.RegisterTransitMatrix(costs)
         routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
         # Distance dimension for max_duration enforcement (now in real metres).
@@ -188,27 +560,63 @@ def solve_tsp_distance_matrix(distance_matrix, start_index=0, preferences=None):
                 "Distance",
             )
 
-        search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-
-        # First-solution strategy: coverage uses insertion for geographic spread.
-        if priority == "coverage":
-            search_parameters.first_solution_strategy = (
-                routing_enums_pb2.FirstSolutionStrategy.PARALLEL_CHEAPEST_INSERTION
-            )
-        else:
-            search_parameters.first_solution_strategy = (
-                routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
+        plateau_seconds = budget["plateau_seconds"]
+        target_gap = budget["target_gap"]
+        if (
+            should_stop is not None
+            or on_solution is not None
+            or plateau_seconds is not None
+            or lower_bound
+        ):
+            best_objective = [None]
+            last_improvement = [time.monotonic()]
+
+            def finish(reason):
+                stats["stop_reason"] = reason
+                routing.solver().FinishCurrentSearch()
+
+            def solution_callback():
+                now = time.monotonic()
+                objective = routing.CostVar().Value()
+                if best_objective[0] is None or objective < best_objective[0]:
+                    best_objective[0] = objective
+                    last_improvement[0] = now
+                    stats["improvements"] = stats.get("improvements", 0) + 1
+                    if on_solution is not None:
+                        on_solution(_current_route(routing, manager), objective)
+                    if lower_bound and objective - lower_bound <= target_gap * objective:
+                        finish("gap")
+                        return
+                elif plateau_seconds is not None and now - last_improvement[0] >= plateau_seconds:
+                    finish("plateau")
+                    return
+                if should_stop is not None and should_stop():
+                    finish("stopped")
+
+            routing.AddAtSolutionCallback(solution_callback)
+
+        search_parameters = routing_search_parameters(priority, search_config)
+        # Milliseconds so sub-second budgets are honoured; time spent on the
+        # lower bound comes out of the same budget.
+        remaining = time_limit_seconds - (time.monotonic() - budget_started_at)
+        search_parameters.time_limit.FromMilliseconds(max(1, int(remaining * 1000)))
+
+        initial_assignment = None
+        if warm_start and size > 1:
+            routing.CloseModelWithParameters(search_parameters)
+            initial_assignment = routing.ReadAssignmentFromRoutes(
+                [list(initial_route[1:])], True
             )
-
-        # Always apply GUIDED_LOCAL_SEARCH to improve past the greedy solution.
-        # The time limit bounds how long improvement runs.
-        search_parameters.local_search_metaheuristic = (
-            routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
-        )
-        search_parameters.time_limit.FromSeconds(int(time_limit_seconds))
+            if initial_assignment is None:
+                logger.info({"event": "warm_start_rejected", "size": size})
 
         t0 = time.monotonic()
-        solution = routing.SolveWithParameters(search_parameters)
+        if initial_assignment is not None:
+            solution = routing.SolveFromAssignmentWithParameters(
+                initial_assignment, search_parameters
+            )
+        else:
+            solution = routing.SolveWithParameters(search_parameters)
         elapsed = time.monotonic() - t0
 
         if solution:
@@ -218,34 +626,342 @@ def solve_tsp_distance_matrix(distance_matrix, start_index=0, preferences=None):
                 route.append(manager.IndexToNode(index))
                 index = solution.Value(routing.NextVar(index))
             route.append(manager.IndexToNode(index))
-            logger.info(
-                '{"event":"solver_outcome","status":"solved","elapsed_s":%.3f,'
-                '"size":%d,"priority":"%s","time_limit_s":%d}',
-                elapsed, size, priority, int(time_limit_seconds),
-            )
+            objective = solution.ObjectiveValue()
+            if stats["stop_reason"] is None:
+                # Tiny instances can exhaust the search before the limit.
+                exhausted = elapsed < 0.9 * remaining
+                stats["stop_reason"] = "completed" if exhausted else "time_limit"
+            stats["objective"] = objective
+            stats["neighbors_accepted"] = routing.solver().AcceptedNeighbors()
+            if lower_bound is not None and objective > 0:
+                stats["gap"] = round(max(0.0, (objective - lower_bound) / objective), 4)
+            logger.info({
+                "event": "solver_outcome",
+                "status": "solved",
+                "elapsed_s": round(elapsed, 3),
+                "size": size,
+                "priority": priority,
+                "time_limit_s": round(time_limit_seconds, 3),
+                "warm_start": initial_assignment is not None,
+                "stop_reason": stats["stop_reason"],
+                "gap": stats["gap"],
+                "neighbors_accepted": stats["neighbors_accepted"],
+            })
             return route, "solved"
 
         # No solution found within time/distance constraints.
-        logger.warning(
-            '{"event":"solver_outcome","status":"fallback","elapsed_s":%.3f,'
-            '"size":%d,"priority":"%s"}',
-            elapsed, size, priority,
-        )
+        logger.warning({
+            "event": "solver_outcome",
+            "status": "fallback",
+            "elapsed_s": round(elapsed, 3),
+            "size": size,
+            "priority": priority,
+        })
         return list(range(size)), "fallback"
 
     except Exception:
-        logger.exception(
-            '{"event":"solver_outcome","status":"failed","size":%d}', size
-        )
+        logger.exception({"event": "solver_outcome", "status": "failed", "size": size})
         return list(range(size)), "failed"
 
 
+def _fallback_fleet_routes(size, starts):
+    """Input-order split of the non-start stops into one closed route per rider."""
+    others = [node for node in range(size) if node not in set(starts)]
+    chunk = -(-len(others) // len(starts)) if others else 0
+    return [
+        [start] + others[k * chunk:(k + 1) * chunk] + [start]
+        for k, start in enumerate(starts)
+    ]
+
+
+def solve_fleet_distance_matrix(
+    distance_matrix,
+    starts,
+    preferences=None,
+    should_stop=None,
+    stats=None,
+):
+    """Route several riders in one OR-Tools model; returns (routes, solver_status).
+
+    starts holds each rider's start node (riders may share one); routes has
+    one closed route per rider, start first and last, and every other node
+    appears in exactly one of them. The max_duration_minutes cap applies to
+    each rider's route, and workloads are balanced through a global span
+    cost on the Distance dimension (see DEFAULT_RIDER_BALANCE_COEFFICIENT).
+
+    Statuses, should_stop and the budget follow solve_tsp_distance_matrix;
+    there is no lower bound, so the adaptive search stops on its plateau
+    window or time limit. On "fallback"/"failed" the stops are split across
+    riders in input order.
+    """
+    size = len(distance_matrix)
+    starts = [int(start) for start in starts]
+    preferences = preferences or {}
+    priority = preferences.get("priority") or ""
+    if stats is None:
+        stats = {}
+
+    budget = resolve_search_budget(size, preferences)
+    time_limit_seconds = budget["time_limit_seconds"]
+    plateau_seconds = budget["plateau_seconds"]
+    stats.update({
+        "engine": "ortools_fleet",
+        "time_limit_seconds": round(time_limit_seconds, 3),
+        "stop_reason": None,
+        "objective": None,
+        "lower_bound": None,
+        "gap": None,
+    })
+
+    balance = preferences.get("rider_balance")
+    if isinstance(balance, bool) or not isinstance(balance, (int, float)) or balance < 0:
+        balance = DEFAULT_RIDER_BALANCE_COEFFICIENT
+    matrix = np.asarray(distance_matrix, dtype=np.int64)
+    max_distance_meters = max_distance_for_preferences(preferences)
+    # Without a cap the dimension still needs a bound no route can exceed.
+    capacity = max_distance_meters or int(matrix.max(initial=0)) * size + 1
+
+    try:
+        manager = pywrapcp.RoutingIndexManager(size, len(starts), starts, starts)
+        routing = pywrapcp.RoutingModel(manager)
+        transit_callback_index = routing.RegisterTransitMatrix(matrix.tolist())
+        routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+        routing.AddDimension(transit_callback_index, 0, capacity, True, "Distance")
+        if balance:
+            routing.GetDimensionOrDie("Distance").SetGlobalSpanCostCoefficient(int(balance))
+
+        if should_stop is not None or plateau_seconds is not None:
+            best_objective = [None]
+            last_improvement = [time.monotonic()]
+
+            def solution_callback():
+                now = time.monotonic()
+                objective = routing.CostVar().Value()
+                if best_objective[0] is None or objective < best_objective[0]:
+                    best_objective[0] = objective
+                    last_improvement[0] = now
+                    stats["improvements"] = stats.get("improvements", 0) + 1
+                elif plateau_seconds is not None and now - last_improvement[0] >= plateau_seconds:
+                    stats["stop_reason"] = "plateau"
+                    routing.solver().FinishCurrentSearch()
+                    return
+                if should_stop is not None and should_stop():
+                    stats["stop_reason"] = "stopped"
+                    routing.solver().FinishCurrentSearch()
+
+            routing.AddAtSolutionCallback(solution_callback)
+
+        search_parameters = routing_search_parameters(priority)
+        search_parameters.time_limit.FromMilliseconds(max(1, int(time_limit_seconds * 1000)))
+
+        t0 = time.monotonic()
+        solution = routing.SolveWithParameters(search_parameters)
+        elapsed = time.monotonic() - t0
+
+        if solution:
+            routes = []
+            for vehicle in range(len(starts)):
+                index = routing.Start(vehicle)
+                route = []
+                while not routing.IsEnd(index):
+                    route.append(manager.IndexToNode(index))
+                    index = solution.Value(routing.NextVar(index))
+                route.append(manager.IndexToNode(index))
+                routes.append(route)
+            if stats["stop_reason"] is None:
+                stats["stop_reason"] = "completed" if elapsed < 0.9 * time_limit_seconds else "time_limit"
+            stats["objective"] = solution.ObjectiveValue()
+            stats["neighbors_accepted"] = routing.solver().AcceptedNeighbors()
+            logger.info({
+                "event": "solver_outcome",
+                "status": "solved",
+                "engine": "ortools_fleet",
+                "elapsed_s": round(elapsed, 3),
+                "size": size,
+                "riders": len(starts),
+                "priority": priority,
+                "time_limit_s": round(time_limit_seconds, 3),
+                "stop_reason": stats["stop_reason"],
+                "neighbors_accepted": stats["neighbors_accepted"],
+            })
+            return routes, "solved"
+
+        logger.warning({
+            "event": "solver_outcome",
+            "status": "fallback",
+            "engine": "ortools_fleet",
+            "elapsed_s": round(elapsed, 3),
+            "size": size,
+            "riders": len(starts),
+            "priority": priority,
+        })
+        return _fallback_fleet_routes(size, starts), "fallback"
+
+    except Exception:
+        logger.exception({
+            "event": "solver_outcome",
+            "status": "failed",
+            "engine": "ortools_fleet",
+            "size": size,
+        })
+        return _fallback_fleet_routes(size, starts), "failed"
+
+
+def solve_route(
+    distance_matrix,
+    start_index=0,
+    preferences=None,
+    should_stop=None,
+    on_solution=None,
+    initial_route=None,
+    stats=None,
+    portfolio=None,
+):
+    """Solve with the cheapest engine that fits; returns (route_indices, solver_status).
+
+    Dispatch (preferences["solver_engine"]: "auto" by default):
+      - up to 2 stops: the route is fixed, no search needed;
+      - up to HELD_KARP_MAX_STOPS stops: exact Held-Karp (provably optimal),
+        unless "ortools" is requested;
+      - "heuristic": nearest neighbour + 2-opt/Or-opt for symmetric
+        matrices, handing over to OR-Tools if it breaks the distance cap;
+      - everything else: solve_tsp_distance_matrix.
+
+    Same arguments, statuses and stats keys as solve_tsp_distance_matrix,
+    plus stats["engine"]. A fast-path route longer than the
+    max_duration_minutes cap is infeasible and returns "fallback", as
+    OR-Tools would.
+
+    portfolio, a list of SEARCH_CONFIGS names (see
+    portfolio.resolve_portfolio), races those configurations instead of a
+    single OR-Tools search; searches seeded with initial_route keep the
+    single configuration.
+    """
+    matrix = np.asarray(distance_matrix)
+    size = matrix.shape[0] if matrix.ndim == 2 else len(distance_matrix)
+    preferences = preferences or {}
+    if stats is None:
+        stats = {}
+    engine = preferences.get("solver_engine") or "auto"
+    priority = preferences.get("priority") or ""
+
+    fast_engine = None
+    if 0 < size <= 2 or (0 < size <= HELD_KARP_MAX_STOPS and engine != "ortools"):
+        fast_engine = "held_karp" if size > 2 else "trivial"
+    elif engine == "heuristic" and size > 2 and np.array_equal(matrix, matrix.T):
+        fast_engine = "heuristic"
+
+    if fast_engine is None and portfolio and initial_route is None:
+        # portfolio imports this module.
+        from portfolio import solve_portfolio
+
+        return solve_portfolio(
+            distance_matrix,
+            portfolio,
+            start_index=start_index,
+            preferences=preferences,
+            should_stop=should_stop,
+            on_solution=on_solution,
+            stats=stats,
+        )
+    if fast_engine is None:
+        return solve_tsp_distance_matrix(
+            distance_matrix,
+            start_index=start_index,
+            preferences=preferences,
+            should_stop=should_stop,
+            on_solution=on_solution,
+            initial_route=initial_route,
+            stats=stats,
+        )
+
+    budget = resolve_search_budget(size, preferences)
+    t0 = time.monotonic()
+    if fast_engine == "heuristic":
+        route, cost = local_search_tour(
+            matrix, start_index, time_limit_seconds=budget["time_limit_seconds"]
+        )
+        stop_reason = "local_optimum"
+        lower_bound = None
+    else:
+        route, cost = held_karp(matrix, start_index)
+        stop_reason = "optimal"
+        lower_bound = cost
+    elapsed = time.monotonic() - t0
+
+    max_distance_meters = max_distance_for_preferences(preferences)
+    if max_distance_meters is not None and cost > max_distance_meters:
+        if fast_engine == "heuristic":
+            return solve_tsp_distance_matrix(
+                distance_matrix,
+                start_index=start_index,
+                preferences=preferences,
+                should_stop=should_stop,
+                on_solution=on_solution,
+                initial_route=initial_route,
+                stats=stats,
+            )
+        # The optimal tour already breaks the cap, so no route satisfies it.
+        stats.update({"engine": fast_engine, "time_limit_seconds": None,
+                      "stop_reason": "infeasible", "objective": None,
+                      "lower_bound": lower_bound, "gap": None})
+        logger.warning({
+            "event": "solver_outcome",
+            "status": "fallback",
+            "engine": fast_engine,
+            "elapsed_s": round(elapsed, 3),
+            "size": size,
+            "priority": priority,
+        })
+        return list(range(size)), "fallback"
+
+    if on_solution is not None:
+        on_solution(route, cost)
+    stats.update({
+        "engine": fast_engine,
+        "time_limit_seconds": round(budget["time_limit_seconds"], 3),
+        "stop_reason": stop_reason,
+        "objective": cost,
+        "improvements": 1,
+        "lower_bound": lower_bound,
+        "gap": 0.0 if lower_bound is not None else None,
+    })
+    logger.info({
+        "event": "solver_outcome",
+        "status": "solved",
+        "engine": fast_engine,
+        "elapsed_s": round(elapsed, 3),
+        "size": size,
+        "priority": priority,
+    })
+    return route, "solved"
+
+
 __all__ = [
     "compute_distance_matrix",
+    "raw_distance_matrix",
+    "great_circle_matrix",
     "compute_euclidean_matrix",
     "apply_preferences_to_matrix",
+    "edge_penalty_factors",
     "solve_tsp_distance_matrix",
+    "solve_fleet_distance_matrix",
+    "routing_search_parameters",
+    "default_search_config",
+    "SEARCH_CONFIGS",
+    "solve_route",
+    "coordinate_arrays",
+    "pair_distances",
+    "max_distance_for_preferences",
     "haversine_meters",
+    "haversine_matrix",
+    "equirectangular_matrix",
+    "DISTANCE_MODES",
+    "cheapest_insertion",
+    "resolve_search_budget",
     "DEFAULT_SOLVER_TIME_LIMIT_SECONDS",
+    "DEFAULT_WARM_START_TIME_LIMIT_SECONDS",
+    "DEFAULT_TARGET_GAP",
     "DEFAULT_AVG_SPEED_KMH",
+    "DEFAULT_RIDER_BALANCE_COEFFICIENT",
 ]
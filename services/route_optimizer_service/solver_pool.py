@@ -0,0 +1,341 @@
+"""Pre-forked solver processes for POST /optimize.
+
+A solve used to run inside the gunicorn thread serving the request, so a
+slow or stuck search held that thread and nothing bounded how many searches
+ran at once. SolverPool keeps a fixed set of solver processes per gunicorn
+worker, started (and OR-Tools imported) when the app loads:
+
+  - admission: a request waits for an idle solver for at most
+    ROUTE_SOLVER_QUEUE_TIMEOUT_SECONDS, and is rejected straight away when
+    ROUTE_SOLVER_MAX_QUEUE requests are already waiting (SolverOverloaded,
+    answered with 503 + Retry-After);
+  - deadline: a solve still running after ROUTE_SOLVER_DEADLINE_SECONDS has
+    its process killed and replaced (SolverDeadlineExceeded, 504), and
+    solver_time_limit_seconds values that cannot finish before it are
+    rejected up front (budget_error).
+
+Pool processes are daemonic and cannot start processes of their own, so
+decomposed and portfolio solves, which fan out over the batch process pool,
+run in the gunicorn worker under reserve(): they hold a solver slot for
+admission and stop at the deadline (stop_at_deadline) instead of being
+killed. Streams and jobs, which need should_stop and on_solution callbacks,
+solve in their own threads the same way; a stream holds its slot with
+hold() because the search outlives the request handler.
+
+Processes use the "spawn" start method (forking a threaded server is
+unsafe). They share the result cache and remembered routes through the
+SQLite file in ROUTE_CACHE_PATH; without one, the pool creates a private
+file in a temporary directory so repeat requests still hit whichever process
+solved them first. The pool must be created after gunicorn forks its
+workers, so do not run with --preload.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import (
+    mark_process_dead,
+    SOLVER_QUEUE_DEPTH,
+    SOLVER_QUEUE_WAIT,
+    SOLVER_REJECTIONS,
+    SOLVER_WORKER_RESTARTS,
+)
+
+from timing import phase
+
+logger = logging.getLogger("route_optimizer")
+
+DEFAULT_SOLVER_WORKERS = 2
+DEFAULT_SOLVER_MAX_QUEUE = 8
+DEFAULT_SOLVER_QUEUE_TIMEOUT_SECONDS = 10.0
+DEFAULT_SOLVER_DEADLINE_SECONDS = 30.0
+
+# Share of the deadline left for matrix building, rules and encoding when
+# checking a requested solver time limit against it.
+_DEADLINE_HEADROOM = 0.1
+
+# Time allowed for a fresh process to import the solver stack; not counted
+# against the request deadline.
+_STARTUP_TIMEOUT_SECONDS = 60.0
+
+
+class SolverOverloaded(Exception):
+    """No solver became available; reason is "queue_full" or "queue_timeout"."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class SolverDeadlineExceeded(Exception):
+    """The solve overran the hard deadline and its process was killed."""
+
+
+class SolverCrashed(Exception):
+    """The solver process exited while handling the request."""
+
+
+def _worker_main(conn, cache_path):
+    os.environ["ROUTE_CACHE_PATH"] = cache_path
+    # Import the whole solver stack up front so the first request is warm.
+    import logging_setup  # noqa: F401
+    from cache import build_result_cache
+    from pipeline import run_optimize
+    from profiling import profile_call
+
+    cache = build_result_cache()
+    conn.send(("ready", None))
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        payload, trace_id, started_at_offset, profile = message
+        started_at = time.monotonic() - started_at_offset
+        try:
+            if profile is None:
+                result = run_optimize(
+                    payload, trace_id, started_at=started_at, cache=cache, timings=True
+                )
+            else:
+                result = profile_call(
+                    profile, run_optimize, payload, trace_id,
+                    started_at=started_at, cache=cache, timings=True,
+                )
+        except Exception as exc:
+            logging.getLogger("route_optimizer").exception("solver worker failed")
+            result = ({"error": "internal_error", "type": type(exc).__name__}, 500)
+        conn.send(("result", result))
+
+
+class _Worker:
+    def __init__(self, context, cache_path):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, cache_path), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def wait_ready(self):
+        if self.ready:
+            return True
+        if not self.conn.poll(_STARTUP_TIMEOUT_SECONDS):
+            return False
+        kind, _ = self.conn.recv()
+        self.ready = kind == "ready"
+        return self.ready
+
+    def stop(self):
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=5)
+
+
+class SolverPool:
+    """Fixed set of solver processes with a bounded wait queue."""
+
+    def __init__(
+        self,
+        workers=DEFAULT_SOLVER_WORKERS,
+        max_queue=DEFAULT_SOLVER_MAX_QUEUE,
+        queue_timeout_seconds=DEFAULT_SOLVER_QUEUE_TIMEOUT_SECONDS,
+        deadline_seconds=DEFAULT_SOLVER_DEADLINE_SECONDS,
+    ):
+        self.workers = max(1, int(workers))
+        self.max_queue = max(0, int(max_queue))
+        self.queue_timeout_seconds = float(queue_timeout_seconds)
+        self.deadline_seconds = float(deadline_seconds)
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self.cache_path = os.environ.get("ROUTE_CACHE_PATH") or os.path.join(
+            tempfile.mkdtemp(prefix="route-solver-"), "cache.sqlite"
+        )
+        for _ in range(self.workers):
+            self._idle.put(_Worker(self._context, self.cache_path))
+
+    def _replace(self, worker, reason):
+        worker.stop()
+        mark_process_dead(worker.process.pid)
+        SOLVER_WORKER_RESTARTS.labels(reason=reason).inc()
+        logger.warning({
+            "event": "solver_worker_restarted",
+            "reason": reason,
+            "pid": worker.process.pid,
+            "exitcode": worker.process.exitcode,
+        })
+        return _Worker(self._context, self.cache_path)
+
+    def _check_queue(self):
+        # Caller holds self._lock.
+        if self._waiting >= self.max_queue and self._idle.empty():
+            SOLVER_REJECTIONS.labels(reason="queue_full").inc()
+            raise SolverOverloaded("queue_full", retry_after=1)
+
+    def _acquire(self):
+        with self._lock:
+            self._check_queue()
+            self._waiting += 1
+            SOLVER_QUEUE_DEPTH.set(self._waiting)
+        t0 = time.monotonic()
+        try:
+            worker = self._idle.get(timeout=self.queue_timeout_seconds)
+        except queue.Empty:
+            SOLVER_REJECTIONS.labels(reason="queue_timeout").inc()
+            raise SolverOverloaded("queue_timeout", retry_after=max(1, int(self.deadline_seconds / 2)))
+        finally:
+            with self._lock:
+                self._waiting -= 1
+                SOLVER_QUEUE_DEPTH.set(self._waiting)
+        SOLVER_QUEUE_WAIT.observe(time.monotonic() - t0)
+        return worker
+
+    def budget_error(self, preferences):
+        """Why the requested solver time limit cannot finish before the
+        deadline, or None. Decomposed solves give it to every cluster, so
+        it must fit even then."""
+        limit = (preferences or {}).get("solver_time_limit_seconds")
+        if isinstance(limit, bool) or not isinstance(limit, (int, float)):
+            return None
+        allowed = self.deadline_seconds * (1.0 - _DEADLINE_HEADROOM)
+        if limit > allowed:
+            return (
+                f"solver_time_limit_seconds must be at most {allowed:g} "
+                f"(solver deadline {self.deadline_seconds:g}s)"
+            )
+        return None
+
+    def check_admission(self):
+        """Raise SolverOverloaded("queue_full") if a solve would be rejected
+        right now; for work that queues elsewhere before taking a slot."""
+        with self._lock:
+            self._check_queue()
+
+    def stop_at_deadline(self, started_at):
+        """should_stop callback for a solve outside the pool processes: true
+        once the deadline, counted from started_at, has passed."""
+        deadline = started_at + self.deadline_seconds
+
+        def past_deadline():
+            return time.monotonic() >= deadline
+
+        return past_deadline
+
+    def hold(self):
+        """Take a solver slot for a solve that outlives the caller's frame.
+
+        Admission is the same as run() (raises SolverOverloaded). Returns a
+        release() callable that is safe to call more than once.
+        """
+        with phase("queue"):
+            worker = self._acquire()
+        lock = threading.Lock()
+        released = False
+
+        def release():
+            nonlocal released
+            with lock:
+                if released:
+                    return
+                released = True
+            self._idle.put(worker)
+
+        return release
+
+    @contextmanager
+    def reserve(self):
+        """Hold a solver slot while the caller solves in its own process;
+        the slot's process stays idle until the block exits."""
+        release = self.hold()
+        try:
+            yield
+        finally:
+            release()
+
+    def run(self, payload, trace_id, started_at=None, profile=None):
+        """Solve payload in a pool process; returns (response_body, status_code).
+
+        The body carries the pipeline's phase "timings"; profile is a
+        profiling.claim() result to capture this solve in the pool process.
+        Raises SolverOverloaded, SolverDeadlineExceeded or SolverCrashed.
+        """
+        if started_at is None:
+            started_at = time.monotonic()
+        with phase("queue"):
+            worker = self._acquire()
+        try:
+            startup_t0 = time.monotonic()
+            if not worker.wait_ready():
+                worker = self._replace(worker, "startup_timeout")
+                raise SolverCrashed("solver process did not start")
+            # The deadline counts from started_at, queue wait included, as
+            # in stop_at_deadline; only a respawned process's startup is not
+            # charged to the request.
+            deadline = started_at + self.deadline_seconds + (time.monotonic() - startup_t0)
+            # Monotonic clocks are per process: pass the elapsed time instead.
+            worker.conn.send((payload, trace_id, time.monotonic() - started_at, profile))
+            if not worker.conn.poll(max(0.0, deadline - time.monotonic())):
+                worker = self._replace(worker, "deadline")
+                raise SolverDeadlineExceeded(trace_id)
+            _, result = worker.conn.recv()
+            return result
+        except (EOFError, OSError):
+            worker = self._replace(worker, "crashed")
+            raise SolverCrashed(trace_id)
+        finally:
+            self._idle.put(worker)
+
+    def shutdown(self):
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                return
+
+
+def build_solver_pool():
+    """Create the process-wide SolverPool from ROUTE_SOLVER_* env vars.
+
+    Returns None when ROUTE_SOLVER_WORKERS=0 (solve in the request thread)
+    and inside multiprocessing children, which must never start a pool of
+    their own when they import the app module.
+    """
+    workers = int(os.environ.get("ROUTE_SOLVER_WORKERS", DEFAULT_SOLVER_WORKERS))
+    if workers <= 0 or multiprocessing.parent_process() is not None:
+        return None
+    return SolverPool(
+        workers=workers,
+        max_queue=int(os.environ.get("ROUTE_SOLVER_MAX_QUEUE", DEFAULT_SOLVER_MAX_QUEUE)),
+        queue_timeout_seconds=float(
+            os.environ.get("ROUTE_SOLVER_QUEUE_TIMEOUT_SECONDS", DEFAULT_SOLVER_QUEUE_TIMEOUT_SECONDS)
+        ),
+        deadline_seconds=float(
+            os.environ.get("ROUTE_SOLVER_DEADLINE_SECONDS", DEFAULT_SOLVER_DEADLINE_SECONDS)
+        ),
+    )
+
+
+__all__ = [
+    "SolverPool",
+    "SolverOverloaded",
+    "SolverDeadlineExceeded",
+    "SolverCrashed",
+    "build_solver_pool",
+    "DEFAULT_SOLVER_WORKERS",
+    "DEFAULT_SOLVER_MAX_QUEUE",
+    "DEFAULT_SOLVER_QUEUE_TIMEOUT_SECONDS",
+    "DEFAULT_SOLVER_DEADLINE_SECONDS",
+]
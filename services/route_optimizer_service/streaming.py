@@ -0,0 +1,117 @@
+"""Streaming (anytime) optimize responses.
+
+The solver runs in a background thread and reports every improving route
+through its on_solution hook; the request thread relays those as events:
+
+  solution  -- {"seq", "objective", "elapsed_seconds", "route"}
+  heartbeat -- {"elapsed_seconds"}; sent while the search is on a plateau
+  result    -- the exact /optimize response body (always the last event)
+  error     -- {"error": ...} if the solve raised
+
+Events are NDJSON lines ({"event": ..., "data": ...}) or, when the client
+accepts text/event-stream, server-sent events. Closing the connection stops
+the search at its next accepted solution.
+
+The search thread starts when stream_optimize is called, not when the
+response is first read, so on_done (which releases a held solver slot) runs
+even if the response is never iterated.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+
+from pipeline import solve_problem
+
+logger = logging.getLogger("route_optimizer")
+
+# Interval between heartbeats while no solution arrives. Writing a heartbeat
+# is also how a disconnected client is noticed.
+HEARTBEAT_INTERVAL_SECONDS = 1.0
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+SSE_MIMETYPE = "text/event-stream"
+
+
+def format_event(event, data, sse=False):
+    body = json.dumps(data, separators=(",", ":"))
+    if sse:
+        return f"event: {event}\ndata: {body}\n\n"
+    return json.dumps({"event": event, "data": data}, separators=(",", ":")) + "\n"
+
+
+def stream_optimize(
+    problem, trace_id, started_at=None, cache=None, sse=False, should_stop=None, on_done=None
+):
+    """Start solving one prepared problem; returns a generator of formatted
+    events. should_stop also ends the search (e.g. at the solver deadline);
+    on_done is called once the search thread finishes."""
+    if started_at is None:
+        started_at = time.monotonic()
+    locations = problem["locations"]
+    events = queue.Queue()
+    stop = threading.Event()
+    seq = [0]
+
+    def on_solution(route, objective):
+        seq[0] += 1
+        events.put(("solution", {
+            "seq": seq[0],
+            "objective": objective,
+            "elapsed_seconds": round(time.monotonic() - started_at, 3),
+            "route": [locations[i] for i in route],
+        }))
+
+    def stopped():
+        return stop.is_set() or (should_stop is not None and should_stop())
+
+    def worker():
+        try:
+            response = solve_problem(
+                problem,
+                trace_id,
+                started_at=started_at,
+                cache=cache,
+                should_stop=stopped,
+                on_solution=on_solution,
+            )
+            events.put(("result", response))
+        except Exception:
+            logger.exception({"trace_id": trace_id, "event": "optimize_stream_failed"})
+            events.put(("error", {"error": "internal_error", "trace_id": trace_id}))
+        finally:
+            if on_done is not None:
+                on_done()
+            events.put(None)
+
+    thread = threading.Thread(target=worker, name="optimize-stream", daemon=True)
+    thread.start()
+    return _relay(events, stop, thread, trace_id, started_at, sse)
+
+
+def _relay(events, stop, thread, trace_id, started_at, sse):
+    try:
+        while True:
+            try:
+                item = events.get(timeout=HEARTBEAT_INTERVAL_SECONDS)
+            except queue.Empty:
+                yield format_event(
+                    "heartbeat",
+                    {"elapsed_seconds": round(time.monotonic() - started_at, 3)},
+                    sse=sse,
+                )
+                continue
+            if item is None:
+                break
+            event, data = item
+            yield format_event(event, data, sse=sse)
+    finally:
+        # Reached on normal completion and when the client disconnects
+        # (the server closes the generator); either way end the search.
+        stop.set()
+        if thread.is_alive():
+            logger.info({"trace_id": trace_id, "event": "optimize_stream_stopped"})
+
+
+__all__ = ["stream_optimize", "format_event", "NDJSON_MIMETYPE", "SSE_MIMETYPE"]
@@ -0,0 +1,100 @@
+"""Audit queries: the sidecar index, rotation, compaction and the scan fallback."""
+import logging
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import audit_log
+from audit_log import append_index, index_path, query_events
+from logging_setup import AuditIndexingFileHandler, formatter
+
+EVENT = "previous_token_used"
+# Whole seconds in the past, so asctime round-trips for the scan.
+BASE = int(time.time()) - 1000
+
+
+def record(n, audit=True):
+    message = f'{{"event":"{EVENT}","n":{n}}}' if audit else f'{{"event":"optimize","n":{n}}}'
+    rec = logging.makeLogRecord({"msg": message, "levelno": logging.INFO, "levelname": "INFO"})
+    rec.created = BASE + n
+    if audit:
+        rec.audit_event = EVENT
+    return rec
+
+
+class AuditLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "service.log")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, count, max_bytes=0, backup_count=5):
+        handler = AuditIndexingFileHandler(
+            self.path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+        handler.setFormatter(formatter)
+        try:
+            for n in range(count):
+                handler.handle(record(n, audit=False))
+                handler.handle(record(n))
+        finally:
+            handler.close()
+
+    def numbers(self, **kwargs):
+        entries, source = query_events(self.path, EVENT, **kwargs)
+        return [entry["n"] for entry in entries], source
+
+    def test_index_query(self):
+        self.write(20)
+        self.assertEqual(self.numbers(limit=3), ([19, 18, 17], "index"))
+        self.assertEqual(
+            self.numbers(since=BASE + 5, until=BASE + 8), ([8, 7, 6, 5], "index")
+        )
+        self.assertEqual(self.numbers(until=BASE + 1)[0], [1, 0])
+
+    def test_every_index_entry_points_at_its_line(self):
+        self.write(10)
+        with open(self.path, "rb") as fh:
+            data = fh.read()
+        offsets = [offset for _, _, offset in audit_log._reverse_index(index_path(self.path, EVENT))]
+        self.assertEqual(len(offsets), 10)
+        for offset in offsets:
+            self.assertEqual(data[offset - 1:offset], b"\n")
+            line = data[offset:data.index(b"\n", offset)]
+            self.assertIn(EVENT.encode(), line)
+
+    def test_reads_across_rotated_files(self):
+        self.write(40, max_bytes=1000, backup_count=10)
+        self.assertTrue(os.path.exists(f"{self.path}.2"))
+        self.assertEqual(
+            self.numbers(limit=100, backup_count=10), (list(range(39, -1, -1)), "index")
+        )
+        # Files past backup_count are skipped, not misread.
+        newest, _ = self.numbers(limit=100, backup_count=1)
+        self.assertEqual(newest, list(range(39, 39 - len(newest), -1)))
+        self.assertLess(len(newest), 40)
+
+    def test_scan_fallback(self):
+        self.write(20, max_bytes=1000, backup_count=10)
+        os.remove(index_path(self.path, EVENT))
+        self.assertEqual(self.numbers(limit=3), ([19, 18, 17], "scan"))
+        self.assertEqual(self.numbers(since=BASE + 5, until=BASE + 8), ([8, 7, 6, 5], "scan"))
+        self.assertEqual(self.numbers(limit=100, backup_count=10)[0], list(range(19, -1, -1)))
+
+    def test_compaction_keeps_newest_records(self):
+        size = audit_log._INDEX_RECORD.size
+        with mock.patch.object(audit_log, "MAX_INDEX_BYTES", 10 * size):
+            for n in range(25):
+                append_index(self.path, EVENT, BASE + n, 1, n)
+            records = list(audit_log._reverse_index(index_path(self.path, EVENT)))
+        self.assertLessEqual(len(records), 10)
+        offsets = [offset for _, _, offset in records]
+        self.assertEqual(offsets, list(range(24, 24 - len(offsets), -1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
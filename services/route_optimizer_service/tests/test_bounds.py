@@ -0,0 +1,57 @@
+"""one_tree_lower_bound never exceeds the optimal tour, checked by brute force."""
+import itertools
+import unittest
+
+import numpy as np
+
+from bounds import one_tree_lower_bound
+
+
+def optimal_tour_cost(matrix, start=0):
+    others = [i for i in range(len(matrix)) if i != start]
+    best = None
+    for perm in itertools.permutations(others):
+        tour = (start,) + perm + (start,)
+        cost = int(sum(matrix[a, b] for a, b in zip(tour, tour[1:])))
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def euclidean_matrix(rng, size):
+    points = rng.uniform(0, 10_000, size=(size, 2))
+    return np.rint(np.linalg.norm(points[:, None] - points[None, :], axis=2)).astype(np.int64)
+
+
+class OneTreeLowerBoundTest(unittest.TestCase):
+    def test_below_optimum_on_euclidean_instances(self):
+        rng = np.random.default_rng(8)
+        for size in range(3, 9):
+            for _ in range(5):
+                matrix = euclidean_matrix(rng, size)
+                optimum = optimal_tour_cost(matrix)
+                bound = one_tree_lower_bound(matrix)
+                self.assertLessEqual(bound, optimum)
+                # Held-Karp bounds are close on metric instances.
+                self.assertGreaterEqual(bound, 0.8 * optimum)
+
+    def test_below_optimum_on_asymmetric_instances(self):
+        rng = np.random.default_rng(9)
+        for size in range(3, 8):
+            matrix = rng.integers(1, 1_000, size=(size, size))
+            np.fill_diagonal(matrix, 0)
+            for root in (0, size - 1):
+                self.assertLessEqual(one_tree_lower_bound(matrix, root=root), optimal_tour_cost(matrix))
+
+    def test_valid_when_the_budget_is_spent(self):
+        matrix = euclidean_matrix(np.random.default_rng(10), 8)
+        bound = one_tree_lower_bound(matrix, time_budget_seconds=0)
+        self.assertLessEqual(bound, optimal_tour_cost(matrix))
+        self.assertLessEqual(bound, one_tree_lower_bound(matrix))
+
+    def test_tiny_instances(self):
+        self.assertEqual(one_tree_lower_bound(np.zeros((1, 1))), 0)
+        self.assertEqual(one_tree_lower_bound(np.array([[0, 7], [5, 0]])), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
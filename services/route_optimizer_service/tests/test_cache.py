@@ -0,0 +1,65 @@
+"""problem_fingerprint: equal problems hash equal, different ones do not."""
+import unittest
+
+import numpy as np
+
+from cache import problem_fingerprint
+
+LOCATIONS = [
+    {"id": "a", "lat": 52.3702, "lng": 4.8952},
+    {"id": "b", "lat": 52.3791, "lng": 4.9003},
+    {"id": "c", "lat": 52.3600, "lng": 4.8852},
+]
+
+
+class ProblemFingerprintTest(unittest.TestCase):
+    def test_ignores_key_order(self):
+        reordered = [{"lng": loc["lng"], "lat": loc["lat"], "id": loc["id"]} for loc in LOCATIONS]
+        self.assertEqual(
+            problem_fingerprint(LOCATIONS, 0, {"priority": "fast", "solver_budget": "fixed"}),
+            problem_fingerprint(reordered, 0, {"solver_budget": "fixed", "priority": "fast"}),
+        )
+
+    def test_repeatable(self):
+        key = problem_fingerprint(LOCATIONS, 1, {"priority": "fast"}, distance_provider="road:abc")
+        self.assertEqual(len(key), 64)
+        self.assertEqual(
+            key, problem_fingerprint(LOCATIONS, 1, {"priority": "fast"}, distance_provider="road:abc")
+        )
+
+    def test_no_preferences_same_as_empty(self):
+        self.assertEqual(
+            problem_fingerprint(LOCATIONS, 0, None), problem_fingerprint(LOCATIONS, 0, {})
+        )
+
+    def test_changes_with_problem(self):
+        base = problem_fingerprint(LOCATIONS, 0, {})
+        moved = [dict(LOCATIONS[0], lat=52.3703)] + LOCATIONS[1:]
+        variants = [
+            problem_fingerprint(moved, 0, {}),
+            problem_fingerprint(LOCATIONS[::-1], 0, {}),
+            problem_fingerprint(LOCATIONS, 1, {}),
+            problem_fingerprint(LOCATIONS, 0, {"priority": "fast"}),
+            problem_fingerprint(LOCATIONS, 0, {}, distance_provider="road:abc"),
+            problem_fingerprint(LOCATIONS, 0, {}, merge_radius_meters=25.0),
+            problem_fingerprint(LOCATIONS, 0, {}, riders=[{"start_index": 0}]),
+        ]
+        self.assertEqual(len(set(variants + [base])), len(variants) + 1)
+
+    def test_array_penalties_hash_every_cell(self):
+        # str() elides the middle of large arrays; the fingerprint must not.
+        penalties = np.zeros((40, 40), dtype=np.int32)
+        changed = penalties.copy()
+        changed[20, 20] = 1
+        self.assertEqual(
+            problem_fingerprint(LOCATIONS, 0, {"edge_penalties": penalties}),
+            problem_fingerprint(LOCATIONS, 0, {"edge_penalties": penalties.copy()}),
+        )
+        self.assertNotEqual(
+            problem_fingerprint(LOCATIONS, 0, {"edge_penalties": penalties}),
+            problem_fingerprint(LOCATIONS, 0, {"edge_penalties": changed}),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
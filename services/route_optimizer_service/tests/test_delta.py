@@ -0,0 +1,90 @@
+"""Delta edits: cheapest insertion and run_delta on an inline route."""
+import random
+import unittest
+
+from cache import ResultCache
+from delta import _insert_stops, run_delta
+from solver import compute_distance_matrix, coordinate_arrays
+
+
+def random_stops(seed, count):
+    rng = random.Random(seed)
+    return [
+        {"id": f"s{i}", "lat": 52.3 + rng.uniform(0, 0.1), "lng": 4.8 + rng.uniform(0, 0.15)}
+        for i in range(count)
+    ]
+
+
+def closed_cost(matrix, tour):
+    return int(sum(matrix[a, b] for a, b in zip(tour, tour[1:] + tour[:1])))
+
+
+class InsertStopsTest(unittest.TestCase):
+    def test_each_stop_goes_to_its_cheapest_position(self):
+        locations = random_stops(23, 30)
+        matrix = compute_distance_matrix(locations)
+        phi, lam = coordinate_arrays(locations)
+        tour = list(range(20))
+        expected = list(tour)
+        pairs = _insert_stops(tour, range(20, 30), phi, lam, None)
+        for node in range(20, 30):
+            # Reference: try every position on the full matrix.
+            options = [expected[:i + 1] + [node] + expected[i + 1:] for i in range(len(expected))]
+            expected = min(options, key=lambda candidate: closed_cost(matrix, candidate))
+        self.assertEqual(closed_cost(matrix, tour), closed_cost(matrix, expected))
+        self.assertEqual(tour[0], 0)
+        self.assertEqual(sorted(tour), list(range(30)))
+        self.assertEqual(pairs, 20 + sum(range(20, 30)))
+
+    def test_single_stop_tour(self):
+        locations = random_stops(24, 3)
+        phi, lam = coordinate_arrays(locations)
+        tour = [0]
+        _insert_stops(tour, [1, 2], phi, lam, None)
+        self.assertEqual(sorted(tour), [0, 1, 2])
+        self.assertEqual(tour[0], 0)
+
+
+class RunDeltaTest(unittest.TestCase):
+    def test_add_and_remove(self):
+        stops = random_stops(25, 15)
+        payload = {
+            "route": stops[:12],
+            "add": stops[12:] + [dict(stops[3], id="dup")],
+            "remove": ["s5", "s0", "missing"],
+            "cache": False,
+        }
+        body, status = run_delta(payload, "t")
+        self.assertEqual(status, 200)
+        ids = [loc["id"] for loc in body["route"]]
+        self.assertEqual(ids[0], "s0")
+        self.assertEqual(ids[-1], "s0")
+        expected = {f"s{i}" for i in range(15)} - {"s5"}
+        self.assertEqual(sorted(ids[:-1]), sorted(expected))
+        self.assertEqual(len(ids) - 1, len(expected))
+        self.assertIn("remove ignored: s0 is the start stop", body["warnings"])
+        self.assertIn("remove ignored: unknown stop missing", body["warnings"])
+        self.assertIn("duplicate stop removed: dup", body["warnings"])
+        self.assertEqual(body["metrics"]["delta"]["added"], 3)
+        self.assertEqual(body["metrics"]["delta"]["removed"], 1)
+
+        route = body["route"]
+        matrix = compute_distance_matrix(route)
+        legs = sum(int(matrix[i, i + 1]) for i in range(len(route) - 1))
+        self.assertEqual(body["metrics"]["distance_meters"], legs)
+
+    def test_chained_through_the_cache(self):
+        cache = ResultCache()
+        stops = random_stops(26, 10)
+        first, _ = run_delta({"route": stops[:8], "add": [stops[8]]}, "t", cache=cache)
+        second, status = run_delta({"cache_key": first["cache_key"], "add": [stops[9]]}, "t", cache=cache)
+        self.assertEqual(status, 200)
+        self.assertEqual(sorted(loc["id"] for loc in second["route"][:-1]), sorted(s["id"] for s in stops))
+        again, _ = run_delta({"cache_key": first["cache_key"], "add": [stops[9]]}, "t", cache=cache)
+        self.assertTrue(again["cached"])
+        missing, status = run_delta({"cache_key": "nope", "add": []}, "t", cache=cache)
+        self.assertEqual(status, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+"""held_karp matches brute force; local_search_tour only improves its seed."""
+import itertools
+import unittest
+
+import numpy as np
+
+from fastpath import held_karp, local_search_tour, nearest_neighbour_tour, tour_cost
+
+
+def brute_force(matrix, start):
+    others = [i for i in range(len(matrix)) if i != start]
+    return min(
+        tour_cost(matrix, (start,) + perm + (start,))
+        for perm in itertools.permutations(others)
+    )
+
+
+def assert_closed_tour(test, route, size, start):
+    test.assertEqual(route[0], start)
+    test.assertEqual(route[-1], start)
+    test.assertEqual(sorted(route[:-1]), list(range(size)))
+
+
+class HeldKarpTest(unittest.TestCase):
+    def test_optimal_on_random_instances(self):
+        rng = np.random.default_rng(9)
+        for size in range(2, 9):
+            for symmetric in (True, False):
+                matrix = rng.integers(1, 5_000, size=(size, size))
+                if symmetric:
+                    matrix = np.minimum(matrix, matrix.T)
+                np.fill_diagonal(matrix, 0)
+                start = int(rng.integers(size))
+                route, cost = held_karp(matrix, start_index=start)
+                assert_closed_tour(self, route, size, start)
+                self.assertEqual(cost, tour_cost(matrix, route))
+                self.assertEqual(cost, brute_force(matrix, start))
+
+    def test_single_stop(self):
+        self.assertEqual(held_karp(np.zeros((1, 1), dtype=np.int64)), ([0, 0], 0))
+
+
+class LocalSearchTourTest(unittest.TestCase):
+    def test_improves_on_nearest_neighbour(self):
+        rng = np.random.default_rng(10)
+        points = rng.uniform(0, 10_000, size=(30, 2))
+        matrix = np.rint(np.linalg.norm(points[:, None] - points[None, :], axis=2)).astype(np.int64)
+        route, cost = local_search_tour(matrix, start_index=4)
+        assert_closed_tour(self, route, 30, 4)
+        self.assertEqual(cost, tour_cost(matrix, route))
+        seed = nearest_neighbour_tour(matrix, 4) + [4]
+        self.assertLessEqual(cost, tour_cost(matrix, seed))
+
+
+if __name__ == "__main__":
+    unittest.main()
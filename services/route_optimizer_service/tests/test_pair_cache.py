@@ -0,0 +1,84 @@
+"""PairDistanceCache: lookups, LRU eviction and the row-count side table."""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from pair_cache import PairDistanceCache
+
+
+def store_pairs(cache, first, count, provider="p"):
+    """Store count pairs (k, 0) -> (k, 1) with k metres, one write."""
+    origins = [(k, 0) for k in range(first, first + count)]
+    block = np.zeros((count, count), dtype=np.int32)
+    np.fill_diagonal(block, np.arange(first, first + count))
+    cache.store(provider, origins, [(k, 1) for k in range(first, first + count)], block, block > 0)
+
+
+class PairCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "pairs.db")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def counts(self, cache):
+        conn = cache._conn()
+        stored = conn.execute("SELECT rows FROM pair_distances_count").fetchone()[0]
+        actual = conn.execute("SELECT COUNT(*) FROM pair_distances").fetchone()[0]
+        return stored, actual
+
+    def stored_meters(self, cache):
+        rows = cache._conn().execute("SELECT meters FROM pair_distances").fetchall()
+        return sorted(meters for meters, in rows)
+
+    def test_lookup_round_trip(self):
+        cache = PairDistanceCache(self.path)
+        keys = [(1, 1), (2, 2), (3, 3)]
+        block = np.array([[0, 5, 7], [6, 0, 0], [0, 0, 0]], dtype=np.int32)
+        cache.store("p", keys, keys, block, block > 0)
+        matrix, known = cache.lookup("p", keys)
+        np.testing.assert_array_equal(matrix, block)
+        np.testing.assert_array_equal(known, (block > 0) | np.eye(3, dtype=bool))
+        _, known = cache.lookup("other", keys)
+        np.testing.assert_array_equal(known, np.eye(3, dtype=bool))
+
+    def test_count_ignores_duplicates(self):
+        cache = PairDistanceCache(self.path)
+        store_pairs(cache, 1, 5)
+        store_pairs(cache, 3, 5)
+        self.assertEqual(self.counts(cache), (7, 7))
+        # Reopening keeps the side table instead of recounting.
+        self.assertEqual(self.counts(PairDistanceCache(self.path)), (7, 7))
+
+    def test_evicts_least_recently_used(self):
+        cache = PairDistanceCache(self.path, max_entries=10)
+        store_pairs(cache, 1, 8)
+        cache._conn().execute("UPDATE pair_distances SET accessed_at = meters")
+        cache._conn().commit()
+        store_pairs(cache, 101, 4)
+        # 12 rows go down to 90% of the limit, oldest first.
+        self.assertEqual(self.counts(cache), (9, 9))
+        self.assertEqual(self.stored_meters(cache), [4, 5, 6, 7, 8, 101, 102, 103, 104])
+
+    def test_cutoff_tie(self):
+        cache = PairDistanceCache(self.path, max_entries=10)
+        # One write: every row shares the cutoff timestamp.
+        store_pairs(cache, 1, 12)
+        self.assertEqual(self.counts(cache), (9, 9))
+
+    def test_count_resync(self):
+        cache = PairDistanceCache(self.path, max_entries=10)
+        store_pairs(cache, 1, 10)
+        cache._conn().execute("DELETE FROM pair_distances")
+        cache._conn().commit()
+        self.assertEqual(self.counts(cache), (10, 0))
+        store_pairs(cache, 101, 1)
+        self.assertEqual(self.counts(cache), (1, 1))
+        self.assertEqual(self.stored_meters(cache), [101])
+
+
+if __name__ == "__main__":
+    unittest.main()
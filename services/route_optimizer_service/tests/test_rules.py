@@ -0,0 +1,95 @@
+"""Proximity merging: groups partition the stops and expand back losslessly."""
+import math
+import random
+import unittest
+
+from rules import expand_merged_route, group_walk_meters, merge_nearby_stops
+
+
+def haversine(a, b):
+    phi1, phi2 = math.radians(a["lat"]), math.radians(b["lat"])
+    h = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(b["lng"] - a["lng"]) / 2) ** 2
+    )
+    return 2 * 6_371_000.0 * math.asin(math.sqrt(min(1.0, h)))
+
+
+def clustered_stops(seed, corners=12, per_corner=4):
+    rng = random.Random(seed)
+    stops = []
+    for _ in range(corners):
+        lat, lng = 52.3 + rng.uniform(0, 0.1), 4.8 + rng.uniform(0, 0.15)
+        for _ in range(rng.randint(1, per_corner)):
+            stops.append({"lat": lat + rng.uniform(-1e-4, 1e-4), "lng": lng + rng.uniform(-1e-4, 1e-4)})
+    rng.shuffle(stops)
+    return stops
+
+
+class MergeNearbyStopsTest(unittest.TestCase):
+    def test_groups_partition_the_stops(self):
+        stops = clustered_stops(22)
+        groups = merge_nearby_stops(stops, 50.0, keep_index=5)
+        members = [i for group in groups for i in group]
+        self.assertEqual(sorted(members), list(range(len(stops))))
+        self.assertLess(len(groups), len(stops))
+        self.assertEqual([group[0] for group in groups], sorted(group[0] for group in groups))
+        for group in groups:
+            for member in group[1:]:
+                self.assertLessEqual(haversine(stops[group[0]], stops[member]), 50.0)
+
+    def test_keep_index_and_fixed_lead(self):
+        stops = clustered_stops(23)
+        fixed = [1, 2]
+        groups = merge_nearby_stops(stops, 50.0, keep_index=7, fixed=fixed)
+        leaders = {group[0] for group in groups}
+        # Other stops may join them, but they never join another leader.
+        self.assertTrue({7, *fixed} <= leaders)
+
+        same_corner = [{"lat": 52.3, "lng": 4.9}] * 3
+        self.assertEqual(merge_nearby_stops(same_corner, 50.0), [[0, 1, 2]])
+        groups = merge_nearby_stops(same_corner, 50.0, keep_index=1, fixed=[2])
+        self.assertEqual(sorted(group[0] for group in groups), [1, 2])
+
+    def test_zero_radius_keeps_every_stop(self):
+        stops = clustered_stops(24)
+        self.assertEqual(merge_nearby_stops(stops, 0.0), [[i] for i in range(len(stops))])
+
+    def test_far_apart_stops_stay_separate(self):
+        stops = [{"lat": 52.3 + i * 0.01, "lng": 4.9} for i in range(5)]
+        self.assertEqual(merge_nearby_stops(stops, 200.0), [[i] for i in range(5)])
+
+
+class ExpandMergedRouteTest(unittest.TestCase):
+    def test_round_trip(self):
+        stops = clustered_stops(25)
+        groups = merge_nearby_stops(stops, 50.0, keep_index=3)
+        start = next(k for k, group in enumerate(groups) if group[0] == 3)
+        order = [start] + [k for k in range(len(groups)) if k != start]
+        route = expand_merged_route(order + [start], groups)
+        self.assertEqual(route[0], 3)
+        self.assertEqual(route[-1], 3)
+        self.assertEqual(sorted(route[:-1]), list(range(len(stops))))
+        # Each group is walked in place, in its own order.
+        position = 0
+        for k in order:
+            self.assertEqual(route[position:position + len(groups[k])], groups[k])
+            position += len(groups[k])
+
+    def test_shared_start_expanded_once(self):
+        groups = [[0, 4], [1], [2, 5], [3]]
+        seen = set()
+        first = expand_merged_route([0, 1, 0], groups, seen)
+        second = expand_merged_route([0, 2, 3, 0], groups, seen)
+        self.assertEqual(first, [0, 4, 1, 0])
+        self.assertEqual(second, [0, 2, 5, 3, 0])
+
+    def test_group_walk_meters(self):
+        stops = [{"lat": 52.3, "lng": 4.9}, {"lat": 52.3001, "lng": 4.9}, {"lat": 52.3002, "lng": 4.9}]
+        walk = group_walk_meters(stops, [0, 1, 2])
+        self.assertEqual(walk, int(haversine(stops[0], stops[1]) + haversine(stops[1], stops[2])))
+        self.assertEqual(group_walk_meters(stops, [1]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+"""SolverPool: admission, reserved slots, budgets and the hard deadline."""
+import random
+import time
+import unittest
+
+from solver_pool import SolverDeadlineExceeded, SolverOverloaded, SolverPool
+
+
+def random_stops(seed, count):
+    rng = random.Random(seed)
+    return [
+        {"id": f"s{i}", "lat": 52.3 + rng.uniform(0, 0.1), "lng": 4.8 + rng.uniform(0, 0.15)}
+        for i in range(count)
+    ]
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = SolverPool(workers=1, max_queue=0, queue_timeout_seconds=0.05, deadline_seconds=20)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_queue_full(self):
+        with self.pool.reserve():
+            with self.assertRaises(SolverOverloaded) as caught:
+                self.pool.check_admission()
+            self.assertEqual(caught.exception.reason, "queue_full")
+            self.assertEqual(caught.exception.retry_after, 1)
+            with self.assertRaises(SolverOverloaded):
+                self.pool.hold()
+        self.pool.check_admission()
+
+    def test_queue_timeout(self):
+        self.pool.max_queue = 1
+        release = self.pool.hold()
+        t0 = time.monotonic()
+        with self.assertRaises(SolverOverloaded) as caught:
+            self.pool.hold()
+        self.assertEqual(caught.exception.reason, "queue_timeout")
+        self.assertEqual(caught.exception.retry_after, 10)
+        self.assertLess(time.monotonic() - t0, 1.0)
+        release()
+        release()
+        # Released once: exactly one slot is back.
+        self.pool.hold()
+        with self.assertRaises(SolverOverloaded):
+            self.pool.hold()
+
+    def test_budget_error(self):
+        self.assertIsNone(self.pool.budget_error(None))
+        self.assertIsNone(self.pool.budget_error({"solver_time_limit_seconds": 18}))
+        self.assertIsNone(self.pool.budget_error({"solver_time_limit_seconds": True}))
+        error = self.pool.budget_error({"solver_time_limit_seconds": 18.5})
+        self.assertIn("at most 18", error)
+
+    def test_stop_at_deadline(self):
+        self.assertFalse(self.pool.stop_at_deadline(time.monotonic())())
+        self.assertTrue(self.pool.stop_at_deadline(time.monotonic() - 20)())
+
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = SolverPool(workers=1, max_queue=1, deadline_seconds=3)
+        # Warm the process so its startup is out of the way.
+        body, status = self.pool.run({"locations": random_stops(1, 5), "cache": False}, "warm")
+        self.assertEqual(status, 200, body)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def idle_pid(self):
+        with self.pool.reserve():
+            pass
+        worker = self.pool._idle.get()
+        self.pool._idle.put(worker)
+        return worker.process.pid
+
+    def test_killed_and_respawned(self):
+        pid = self.idle_pid()
+        payload = {
+            "locations": random_stops(2, 100),
+            "preferences": {"solver_time_limit_seconds": 30, "solver_budget": "fixed"},
+            "cache": False,
+        }
+        t0 = time.monotonic()
+        with self.assertRaises(SolverDeadlineExceeded):
+            self.pool.run(payload, "slow")
+        self.assertLess(time.monotonic() - t0, 10)
+        self.assertNotEqual(self.idle_pid(), pid)
+        body, status = self.pool.run({"locations": random_stops(3, 5), "cache": False}, "after")
+        self.assertEqual(status, 200, body)
+
+    def test_deadline_counts_from_started_at(self):
+        payload = {"locations": random_stops(4, 5), "cache": False}
+        with self.assertRaises(SolverDeadlineExceeded):
+            self.pool.run(payload, "late", started_at=time.monotonic() - 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+"""RTOB binary requests: round trips and malformed bodies."""
+import struct
+import unittest
+
+import numpy as np
+
+from wire import (
+    WireFormatError,
+    decode_request,
+    distance_matrix_array,
+    encode_request,
+    select_stops,
+)
+
+PAYLOAD = {
+    "locations": [{"id": str(i), "lat": 52.37 + i / 1000, "lng": 4.89} for i in range(3)],
+    "preferences": {"priority": "fast"},
+}
+
+
+class RoundTripTest(unittest.TestCase):
+    def test_header_only(self):
+        self.assertEqual(decode_request(encode_request(PAYLOAD)), PAYLOAD)
+
+    def test_matrices(self):
+        penalties = np.arange(9, dtype=np.float32).reshape(3, 3) / 4
+        distances = np.arange(9, dtype=np.int32).reshape(3, 3) * 1000
+        payload = decode_request(encode_request(PAYLOAD, penalties, distances))
+        self.assertEqual(payload["locations"], PAYLOAD["locations"])
+        self.assertEqual(payload["preferences"]["priority"], "fast")
+        np.testing.assert_array_equal(payload["preferences"]["edge_penalties"], penalties)
+        np.testing.assert_array_equal(payload["distance_matrix"], distances)
+        self.assertEqual(payload["distance_matrix"].dtype, np.dtype("<i4"))
+
+    def test_header_padding(self):
+        # Header lengths that do and do not need padding to 4 bytes.
+        for name in ("a", "ab", "abc", "abcd"):
+            payload = {"locations": [], "name": name}
+            matrix = np.full((2, 2), 7, dtype=np.int32)
+            decoded = decode_request(encode_request(payload, distance_matrix=matrix))
+            self.assertEqual(decoded["name"], name)
+            np.testing.assert_array_equal(decoded["distance_matrix"], matrix)
+
+    def test_encode_rejects_non_square(self):
+        with self.assertRaises(ValueError):
+            encode_request(PAYLOAD, distance_matrix=np.zeros((2, 3)))
+
+
+class MalformedTest(unittest.TestCase):
+    def assert_rejected(self, body, message):
+        with self.assertRaises(WireFormatError) as caught:
+            decode_request(body)
+        self.assertIn(message, str(caught.exception))
+
+    def test_preamble(self):
+        body = encode_request(PAYLOAD)
+        self.assert_rejected(body[:6], "truncated preamble")
+        self.assert_rejected(b"XXXX" + body[4:], "bad magic")
+        self.assert_rejected(body[:4] + struct.pack("<H", 2) + body[6:], "unsupported version")
+        self.assert_rejected(body[:20], "truncated header")
+
+    def test_header(self):
+        header = b"[1]"
+        self.assert_rejected(
+            b"RTOB" + struct.pack("<HHI", 1, 0, len(header)) + header, "must be a JSON object"
+        )
+        self.assert_rejected(b"RTOB" + struct.pack("<HHI", 1, 0, 3) + b"{x}", "invalid header")
+
+    def test_blocks(self):
+        body = encode_request(PAYLOAD, distance_matrix=np.zeros((3, 3), dtype=np.int32))
+        self.assert_rejected(body[:-4], "truncated distance_matrix block")
+        block = body[-(8 + 36):]
+        self.assert_rejected(body + block, "duplicate distance_matrix block")
+        self.assert_rejected(body + struct.pack("<B3xI", 9, 1) + b"\0" * 4, "unknown block tag")
+        self.assert_rejected(body + b"\x01\0", "truncated block header")
+
+
+class MatrixHelpersTest(unittest.TestCase):
+    def test_select_stops(self):
+        matrix = np.arange(16, dtype=np.int32).reshape(4, 4)
+        self.assertIs(select_stops(matrix, [0, 1, 2, 3], 4), matrix)
+        np.testing.assert_array_equal(select_stops(matrix, [0, 2], 4), [[0, 2], [8, 10]])
+        self.assertIsNone(select_stops(matrix, [0, 1], 3))
+
+    def test_distance_matrix_array(self):
+        cells = distance_matrix_array([[0, 1.6], [2.2, 0]])
+        self.assertEqual(cells.dtype, np.int32)
+        np.testing.assert_array_equal(cells, [[0, 1], [2, 0]])
+        self.assertIsNone(distance_matrix_array([[0, -1], [1, 0]]))
+        self.assertIsNone(distance_matrix_array([[0, float("nan")], [1, 0]]))
+        self.assertIsNone(distance_matrix_array([[0, 1, 2]]))
+        self.assertIsNone(distance_matrix_array("nope"))
+
+
+if __name__ == "__main__":
+    unittest.main()
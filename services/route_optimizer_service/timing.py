@@ -0,0 +1,84 @@
+"""Per-request phase timing.
+
+A request handler opens request_timer(); code anywhere below it wraps a step
+in `with phase("rules"):` and the elapsed time is added to that request's
+timer (phases with the same name add up). Without an open timer, phase() only
+costs a context-variable lookup, so batch items, jobs and streams are not
+affected.
+
+The pipeline runs in solver pool processes too: run_optimize(..., timings=True)
+returns the phases it measured in body["timings"] (milliseconds), and the
+handler merges them back with PhaseTimer.merge_ms before answering with a
+Server-Timing header and observing route_opt_phase_duration_seconds.
+"""
+import contextvars
+import time
+from contextlib import contextmanager
+
+from metrics import PHASE_DURATION
+
+_current = contextvars.ContextVar("route_optimizer_phase_timer", default=None)
+
+
+class PhaseTimer:
+    """Seconds per named phase, in first-seen order."""
+
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def merge_ms(self, phases_ms):
+        for name, ms in (phases_ms or {}).items():
+            self.add(name, ms / 1000.0)
+
+    def milliseconds(self):
+        return {name: round(seconds * 1000.0, 3) for name, seconds in self.phases.items()}
+
+    def server_timing(self):
+        """Server-Timing header value (durations in milliseconds)."""
+        return ", ".join(
+            f"{name};dur={seconds * 1000.0:.2f}" for name, seconds in self.phases.items()
+        )
+
+    def observe(self):
+        for name, seconds in self.phases.items():
+            PHASE_DURATION.labels(phase=name).observe(seconds)
+
+
+@contextmanager
+def request_timer():
+    """Make a fresh PhaseTimer current for the enclosed block."""
+    timer = PhaseTimer()
+    token = _current.set(timer)
+    try:
+        yield timer
+    finally:
+        _current.reset(token)
+
+
+def current_timer():
+    return _current.get()
+
+
+@contextmanager
+def phase(name):
+    """Add the block's wall-clock time to the current timer, if any."""
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - t0)
+
+
+__all__ = [
+    "PhaseTimer",
+    "request_timer",
+    "current_timer",
+    "phase",
+]
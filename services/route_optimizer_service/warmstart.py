@@ -0,0 +1,99 @@
+"""Warm-start support for re-optimizing known routes.
+
+A route hint is an ordered list of stop keys (the location id, or
+"lat,lng" rounded to 6 decimals for stops without an id). Hints come from
+the caller ("initial_route") or from the last solved route remembered under
+a caller-chosen "route_id". map_route_hint projects a hint onto the current
+location set: stops that disappeared are dropped, new stops are placed by
+cheapest insertion, and the tour is rotated to begin at start_index.
+"""
+import os
+
+from cache import ResultCache
+from solver import cheapest_insertion
+
+DEFAULT_ROUTE_HINT_MAX_ENTRIES = 1024
+DEFAULT_ROUTE_HINT_TTL_SECONDS = 7 * 24 * 3600
+
+_route_hints = None
+
+
+def stop_key(location):
+    loc_id = location.get("id")
+    if loc_id is not None:
+        return str(loc_id)
+    return f"{round(float(location['lat']), 6)},{round(float(location['lng']), 6)}"
+
+
+def route_hint_store():
+    """Process-wide store of remembered routes (shares ROUTE_CACHE_PATH)."""
+    global _route_hints
+    if _route_hints is None:
+        _route_hints = ResultCache(
+            max_entries=int(os.environ.get("ROUTE_HINT_MAX_ENTRIES", DEFAULT_ROUTE_HINT_MAX_ENTRIES)),
+            ttl_seconds=float(os.environ.get("ROUTE_HINT_TTL_SECONDS", DEFAULT_ROUTE_HINT_TTL_SECONDS)),
+            path=os.environ.get("ROUTE_CACHE_PATH") or None,
+            name="route_hint",
+        )
+    return _route_hints
+
+
+def remember_route(route_id, ordered_locations):
+    """Store the solved stop order (closing return leg excluded) for route_id."""
+    keys = [stop_key(loc) for loc in ordered_locations]
+    if len(keys) > 1 and keys[0] == keys[-1]:
+        keys = keys[:-1]
+    route_hint_store().put(str(route_id), {"route": keys})
+
+
+def lookup_route(route_id):
+    entry = route_hint_store().get(str(route_id))
+    if not entry:
+        return None
+    return entry.get("route")
+
+
+def map_route_hint(hint, locations, start_index, distance_matrix):
+    """Map a hint onto the current locations.
+
+    Returns (route_nodes, stats). route_nodes is a permutation of all
+    location indices starting at start_index, or None when fewer than two
+    hinted stops are still present. stats counts kept, added and removed
+    stops relative to the hint.
+    """
+    index_by_key = {}
+    for index, location in enumerate(locations):
+        index_by_key.setdefault(stop_key(location), index)
+
+    kept = []
+    seen = set()
+    for key in hint:
+        index = index_by_key.get(str(key))
+        if index is not None and index not in seen:
+            kept.append(index)
+            seen.add(index)
+
+    stats = {"kept": len(kept), "removed": len(hint) - len(kept), "added": 0}
+    if len(kept) < 2:
+        return None, stats
+
+    if start_index in seen:
+        pivot = kept.index(start_index)
+        kept = kept[pivot:] + kept[:pivot]
+    else:
+        kept.insert(0, start_index)
+        seen.add(start_index)
+        stats["added"] += 1
+
+    missing = [i for i in range(len(locations)) if i not in seen]
+    stats["added"] += len(missing)
+    return cheapest_insertion(kept, missing, distance_matrix), stats
+
+
+__all__ = [
+    "stop_key",
+    "route_hint_store",
+    "remember_route",
+    "lookup_route",
+    "map_route_hint",
+]
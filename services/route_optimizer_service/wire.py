@@ -0,0 +1,170 @@
+"""Binary request format for POST /optimize.
+
+An edge-penalty matrix sent as JSON is N*N text numbers that are parsed one
+by one and then checked cell by cell. With Content-Type BINARY_MIMETYPE the
+body is instead a small JSON header followed by raw little-endian matrices,
+decoded as NumPy views of the request bytes (no per-cell work) and
+shape-checked once:
+
+    offset 0   4s   magic b"RTOB"
+           4   u16  version (1)
+           6   u16  flags (0)
+           8   u32  header length H
+          12   H    UTF-8 JSON: the usual /optimize body without the matrices
+                    zero padding to a multiple of 4 bytes
+    then any number of blocks, each
+               u8   tag: 1 = edge_penalties (float32 factors)
+                         2 = distance_matrix (int32 metres)
+               3x   padding
+               u32  N
+               N*N  cells, row-major, 4 bytes each
+
+Matrices are indexed like the request's "locations" (N must equal its
+length); pipeline.prepare_problem keeps the rows and columns of the stops
+that survive rules.enforce_rules. A JSON body may carry distance_matrix as a
+list of lists with the same meaning.
+"""
+import json
+import struct
+
+import numpy as np
+
+BINARY_MIMETYPE = "application/vnd.movrr.optimize+binary"
+WIRE_MAGIC = b"RTOB"
+WIRE_VERSION = 1
+
+TAG_EDGE_PENALTIES = 1
+TAG_DISTANCE_MATRIX = 2
+_BLOCKS = {
+    TAG_EDGE_PENALTIES: ("edge_penalties", np.dtype("<f4")),
+    TAG_DISTANCE_MATRIX: ("distance_matrix", np.dtype("<i4")),
+}
+
+_PREAMBLE = struct.Struct("<4sHHI")
+_BLOCK_HEADER = struct.Struct("<B3xI")
+
+
+class WireFormatError(ValueError):
+    """The binary request body is malformed."""
+
+
+def _padded(length):
+    return (length + 3) & ~3
+
+
+def decode_request(data):
+    """Decode a binary /optimize body into a payload dict.
+
+    edge_penalties lands in payload["preferences"], distance_matrix at the
+    top level, both as read-only N*N arrays backed by data.
+    """
+    view = memoryview(data)
+    if len(view) < _PREAMBLE.size:
+        raise WireFormatError("truncated preamble")
+    magic, version, _flags, header_len = _PREAMBLE.unpack_from(view, 0)
+    if magic != WIRE_MAGIC:
+        raise WireFormatError("bad magic")
+    if version != WIRE_VERSION:
+        raise WireFormatError(f"unsupported version {version}")
+    offset = _PREAMBLE.size + header_len
+    if offset > len(view):
+        raise WireFormatError("truncated header")
+    try:
+        payload = json.loads(bytes(view[_PREAMBLE.size:offset]).decode("utf-8")) if header_len else {}
+    except (UnicodeDecodeError, ValueError) as exc:
+        raise WireFormatError(f"invalid header: {exc}") from exc
+    if not isinstance(payload, dict):
+        raise WireFormatError("header must be a JSON object")
+    offset = _padded(offset)
+
+    arrays = {}
+    while offset < len(view):
+        if offset + _BLOCK_HEADER.size > len(view):
+            raise WireFormatError("truncated block header")
+        tag, size = _BLOCK_HEADER.unpack_from(view, offset)
+        offset += _BLOCK_HEADER.size
+        if tag not in _BLOCKS:
+            raise WireFormatError(f"unknown block tag {tag}")
+        name, dtype = _BLOCKS[tag]
+        if name in arrays:
+            raise WireFormatError(f"duplicate {name} block")
+        nbytes = size * size * dtype.itemsize
+        if offset + nbytes > len(view):
+            raise WireFormatError(f"truncated {name} block")
+        arrays[name] = np.frombuffer(view, dtype=dtype, count=size * size, offset=offset).reshape(size, size)
+        offset += nbytes
+
+    if "edge_penalties" in arrays:
+        preferences = payload.get("preferences")
+        payload["preferences"] = {
+            **(preferences if isinstance(preferences, dict) else {}),
+            "edge_penalties": arrays["edge_penalties"],
+        }
+    if "distance_matrix" in arrays:
+        payload["distance_matrix"] = arrays["distance_matrix"]
+    return payload
+
+
+def encode_request(payload, edge_penalties=None, distance_matrix=None):
+    """Binary body for payload plus optional N*N matrices (for clients and tests)."""
+    header = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    parts = [_PREAMBLE.pack(WIRE_MAGIC, WIRE_VERSION, 0, len(header)), header]
+    parts.append(b"\0" * (_padded(_PREAMBLE.size + len(header)) - _PREAMBLE.size - len(header)))
+    for tag, matrix in ((TAG_EDGE_PENALTIES, edge_penalties), (TAG_DISTANCE_MATRIX, distance_matrix)):
+        if matrix is None:
+            continue
+        _, dtype = _BLOCKS[tag]
+        cells = np.ascontiguousarray(matrix, dtype=dtype)
+        if cells.ndim != 2 or cells.shape[0] != cells.shape[1]:
+            raise ValueError("matrices must be N*N")
+        parts.append(_BLOCK_HEADER.pack(tag, cells.shape[0]))
+        parts.append(cells.tobytes())
+    return b"".join(parts)
+
+
+def select_stops(matrix, kept, raw_count):
+    """Rows/columns of matrix for the kept stops, or None on a shape mismatch.
+
+    matrix is indexed by the request's locations (raw_count of them); kept
+    lists the raw index of each normalized stop in order. No copy is made
+    when every stop was kept.
+    """
+    if not isinstance(matrix, np.ndarray) or matrix.shape != (raw_count, raw_count):
+        return None
+    if len(kept) == raw_count:
+        return matrix
+    index = np.asarray(kept, dtype=np.intp)
+    return matrix[np.ix_(index, index)]
+
+
+def distance_matrix_array(value):
+    """A caller distance matrix (array or list of lists) as int32 metres, or None.
+
+    Negative and non-finite cells make the whole matrix invalid.
+    """
+    if isinstance(value, np.ndarray):
+        cells = value
+    else:
+        try:
+            cells = np.asarray(value, dtype=np.float64)
+        except (TypeError, ValueError):
+            return None
+    if cells.ndim != 2 or cells.shape[0] != cells.shape[1]:
+        return None
+    if cells.dtype.kind == "f":
+        if not np.isfinite(cells).all():
+            return None
+        cells = np.minimum(cells, np.iinfo(np.int32).max)
+    if cells.size and cells.min() < 0:
+        return None
+    return cells if cells.dtype == np.int32 else cells.astype(np.int32)
+
+
+__all__ = [
+    "BINARY_MIMETYPE",
+    "WireFormatError",
+    "decode_request",
+    "encode_request",
+    "select_stops",
+    "distance_matrix_array",
+]